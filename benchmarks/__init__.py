@@ -0,0 +1,5 @@
+"""Benchmarks for the borough_map data pipeline and rendering.
+
+Run the scripts as modules from the repository root, e.g.
+python -m benchmarks.parallel_ingest data/pp-complete.csv.gz
+"""
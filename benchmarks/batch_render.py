@@ -0,0 +1,85 @@
+"""Benchmark of rendering several videos as a batch against one run per video.
+
+Uses the synthetic files of benchmarks.end_to_end (written if missing, the aggregates
+are cached before timing). The videos are the mean, median and count of every month and
+the median of flats. Separately, each video is a python process of its own (as one run
+of python -m borough_map per video) that builds a headless Controller, reading the
+cached aggregates and the geometry, and renders; as a batch one Controller computes the
+values of all of them and render_batch renders them over --processes. The seconds of
+both are printed as json.
+
+python -m benchmarks.batch_render --rows 1000000 --processes 4
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+from benchmarks.end_to_end import SHP_FILE_NAME, prepare_work_directory
+from borough_map.batch import RenderSpec
+from borough_map.controller import Controller
+
+SPECS = [
+    dict(file_name="mean_prices.mp4", stat="mean"),
+    dict(file_name="median_prices.mp4", stat="median"),
+    dict(file_name="counts.mp4", stat="count", color_limits=(0, 500)),
+    dict(file_name="flat_prices.mp4", selectors={"property_type": "F"}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument(
+        "--work-directory",
+        default=os.path.join("data", "benchmark"),
+        help="directory for the synthetic files, caches and videos",
+    )
+    args = parser.parse_args()
+
+    work_directory = os.path.abspath(args.work_directory)
+    price_paid_file_name = prepare_work_directory(work_directory, args.rows, args.seed)
+    os.chdir(os.path.join(work_directory, "run"))
+    arguments = dict(
+        raw_price_paid_file_name=price_paid_file_name,
+        shp_file_name=SHP_FILE_NAME,
+        facets=True,
+        headless=True,
+    )
+    Controller(**arguments)  # builds the caches
+    results = dict(rows=args.rows, videos=len(SPECS), processes=args.processes)
+
+    start = time.perf_counter()
+    for spec in SPECS:
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from borough_map.batch import RenderSpec\n"
+                "from borough_map.controller import Controller\n"
+                "Controller(**{!r}).render_batch([RenderSpec(**{!r})], processes=1)".format(
+                    arguments, spec
+                ),
+            ],
+            check=True,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+        )
+    results["separate_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    controller = Controller(**arguments)
+    results["batch_setup_seconds"] = time.perf_counter() - start
+    controller.render_batch(
+        [RenderSpec(**spec) for spec in SPECS], processes=args.processes
+    )
+    results["batch_seconds"] = time.perf_counter() - start
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Micro-benchmark of the fixed width date parsing against pandas.to_datetime.
+
+Times deriving year and month (and the full set of derived columns) from
+"YYYY-MM-DD 00:00" strings both ways and checks they agree (year, month, day and
+epoch_seconds). One json line per method is printed.
+
+python -m benchmarks.dates --rows 5000000
+"""
+
+import time
+import json
+import argparse
+
+import numpy
+import pandas
+
+from borough_map.dates import add_fast_date_columns, epoch_seconds
+
+
+def make_date_strings(rows: int, seed: int = 0) -> pandas.Series:
+    """Random Land Registry style timestamps between 1995 and 2019."""
+    random = numpy.random.RandomState(seed)
+    days = random.randint(0, 25 * 365, size=rows).astype("timedelta64[D]")
+    dates = numpy.datetime64("1995-01-01") + days
+    return pandas.Series(numpy.datetime_as_string(dates)).add(" 00:00").astype(object)
+
+
+def to_datetime_columns(date_strings: pandas.Series) -> pandas.DataFrame:
+    """The original implementation: parse with inference then derive each column."""
+    df = pandas.DataFrame({"date_time": pandas.to_datetime(date_strings)})
+    df["year"] = df["date_time"].dt.year
+    df["month"] = df["date_time"].dt.month
+    df["day"] = df["date_time"].dt.day
+    df["epoch_seconds"] = epoch_seconds(df["date_time"])
+    return df
+
+
+def time_it(function, repeat: int) -> float:
+    """Best wall clock time of a few calls."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=5000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    date_strings = make_date_strings(args.rows)
+    expected = to_datetime_columns(date_strings)
+    fast = add_fast_date_columns(
+        pandas.DataFrame({"date_time": date_strings}), ("day", "epoch_seconds")
+    )
+    for column in ["year", "month", "day", "epoch_seconds"]:
+        numpy.testing.assert_array_equal(fast[column], expected[column])
+
+    methods = {
+        "to_datetime": lambda: to_datetime_columns(date_strings),
+        "fast_year_month": lambda: add_fast_date_columns(
+            pandas.DataFrame({"date_time": date_strings})
+        ),
+        "fast_all_columns": lambda: add_fast_date_columns(
+            pandas.DataFrame({"date_time": date_strings}),
+            ("date_time", "day", "epoch_seconds"),
+        ),
+    }
+    baseline = None
+    for name, function in methods.items():
+        seconds = time_it(function, args.repeat)
+        baseline = baseline or seconds
+        print(
+            json.dumps(
+                {
+                    "method": name,
+                    "rows": args.rows,
+                    "seconds": seconds,
+                    "speedup": baseline / seconds,
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
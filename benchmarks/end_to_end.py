@@ -0,0 +1,226 @@
+"""End-to-end benchmark of the pipeline on synthetic price paid data.
+
+For each row count a deterministic synthetic price paid file and borough shape file
+are written to a work directory (and reused on later runs), then each stage is
+timed and its peak resident memory recorded:
+
+    load_data, update_data_for_london_analysis, compact, aggregate_data, cache_save,
+    cache_load, controller_init, frame_update, frame_draw and render (only if ffmpeg
+    is on the path).
+
+The results are written as json so runs of different versions can be compared.
+
+python -m benchmarks.end_to_end --rows 1000000 10000000 30000000 --output results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import threading
+from contextlib import contextmanager
+
+import numpy
+import pandas
+import matplotlib
+
+matplotlib.use("Agg")
+
+from benchmarks.synthetic import write_borough_shape_file, write_price_paid_file
+from borough_map.controller import Controller
+from borough_map.data_loader import DataLoader
+from borough_map.instrumentation import current_rss
+
+SHP_FILE_NAME = "London_Borough_Synthetic.shp"
+
+
+class StageRecorder:
+    """Times stages and samples the resident memory in a thread to find each stage's peak."""
+
+    def __init__(self, interval: float = 0.005):
+        """Instantiate the recorder.
+
+        :param interval: seconds between memory samples
+        """
+        self.interval = interval
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str, **extra):
+        """Record the wall clock time and peak memory of the enclosed block.
+
+        :param name: stage name
+        :param extra: additional values stored with the stage (e.g. frames)
+        """
+        start_rss = current_rss()
+        peak = [start_rss]
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(self.interval):
+                peak[0] = max(peak[0], current_rss())
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stop.set()
+            sampler.join()
+            peak[0] = max(peak[0], current_rss())
+            self.stages[name] = dict(
+                seconds=seconds,
+                peak_rss_bytes=peak[0],
+                peak_rss_increase_bytes=peak[0] - start_rss,
+                **extra
+            )
+            print(json.dumps({"stage": name, **self.stages[name]}), file=sys.stderr)
+
+
+def prepare_work_directory(work_directory: str, rows: int, seed: int) -> str:
+    """Write the synthetic files if missing.
+
+    The DataLoader and MapView read from ../data relative to the working directory,
+    so the files go in <work_directory>/data and the benchmark runs in
+    <work_directory>/run.
+
+    :return: the price paid file name
+    """
+    data_directory = os.path.join(work_directory, "data")
+    os.makedirs(data_directory, exist_ok=True)
+    os.makedirs(os.path.join(work_directory, "run"), exist_ok=True)
+    price_paid_file_name = "pp-synthetic-{}-{}.csv.gz".format(rows, seed)
+    price_paid_path = os.path.join(data_directory, price_paid_file_name)
+    if not os.path.exists(price_paid_path):
+        start = time.perf_counter()
+        partial_path = os.path.join(data_directory, "partial-" + price_paid_file_name)
+        write_price_paid_file(partial_path, rows, seed)
+        os.replace(partial_path, price_paid_path)
+        print(
+            "wrote {} rows in {:.1f}s".format(rows, time.perf_counter() - start),
+            file=sys.stderr,
+        )
+    if not os.path.exists(os.path.join(data_directory, SHP_FILE_NAME)):
+        write_borough_shape_file(os.path.join(data_directory, SHP_FILE_NAME))
+    return price_paid_file_name
+
+
+def benchmark(price_paid_file_name: str, frames: int) -> dict:
+    """Run every stage once (in the run directory) and return the stage records."""
+    recorder = StageRecorder()
+    data_loader = DataLoader(price_paid_file_name)
+    with recorder.stage("load_data"):
+        data_loader._raw_df = data_loader._load_data(data_loader._price_paid_data_path)
+    raw_rows = len(data_loader._raw_df)
+    with recorder.stage("update_data_for_london_analysis"):
+        data_loader._raw_df = data_loader._update_data_for_london_analysis()
+    london_rows = len(data_loader._raw_df)
+    with recorder.stage("compact"):
+        data_loader._raw_df = data_loader._compact(data_loader._raw_df)
+    with recorder.stage("aggregate_data"):
+        data_loader._borough_data, data_loader._aggregated_data = (
+            data_loader._aggregate_data()
+        )
+    with recorder.stage("cache_save"):
+        data_loader._save_data_to_disk()
+    with recorder.stage("cache_load"):
+        data_loader._load_cached_data()
+    del data_loader
+
+    with recorder.stage("controller_init"):
+        controller = Controller(price_paid_file_name, SHP_FILE_NAME)
+    frames = min(frames, controller._frames)
+    map_view = controller.map_view
+    map_view.initial_draw()
+    map_view.draw_text_on_axis(0, 0)
+    with recorder.stage("frame_update", frames=frames):
+        for i in range(frames):
+            controller._update(i)
+    recorder.stages["frame_update"]["seconds_per_frame"] = (
+        recorder.stages["frame_update"]["seconds"] / frames
+    )
+
+    # the blitting of render_to_ffmpeg without the encoding
+    animated_artists = [map_view.patch_collection, map_view.text_on_axis, map_view.line]
+    for artist in animated_artists:
+        artist.set_animated(True)
+    canvas = map_view.fig.canvas
+    canvas.draw()
+    background = canvas.copy_from_bbox(map_view.fig.bbox)
+    with recorder.stage("frame_draw", frames=frames):
+        for i in range(frames):
+            canvas.restore_region(background)
+            controller._update(i)
+            for artist in animated_artists:
+                map_view.fig.draw_artist(artist)
+            canvas.buffer_rgba()
+    recorder.stages["frame_draw"]["seconds_per_frame"] = (
+        recorder.stages["frame_draw"]["seconds"] / frames
+    )
+
+    if shutil.which("ffmpeg"):
+        controller = Controller(price_paid_file_name, SHP_FILE_NAME)
+        with recorder.stage("render", frames=frames):
+            controller.map_view.render_to_ffmpeg(
+                controller._update, frames, file_name="benchmark.mp4"
+            )
+        recorder.stages["render"]["seconds_per_frame"] = (
+            recorder.stages["render"]["seconds"] / frames
+        )
+        os.remove("benchmark.mp4")
+    else:
+        print("ffmpeg not found, skipping the render stage", file=sys.stderr)
+    return dict(raw_rows=raw_rows, london_rows=london_rows, stages=recorder.stages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[1000000], help="synthetic row counts"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--frames", type=int, default=60, help="frames to draw")
+    parser.add_argument(
+        "--work-directory",
+        default=os.path.join("data", "benchmark"),
+        help="directory for the synthetic files and caches",
+    )
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output)
+    work_directory = os.path.abspath(args.work_directory)
+
+    results = dict(
+        created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        numpy=numpy.__version__,
+        pandas=pandas.__version__,
+        matplotlib=matplotlib.__version__,
+        seed=args.seed,
+        runs=[],
+    )
+    cwd = os.getcwd()
+    for rows in args.rows:
+        price_paid_file_name = prepare_work_directory(work_directory, rows, args.seed)
+        os.chdir(os.path.join(work_directory, "run"))
+        try:
+            results["runs"].append(
+                dict(rows=rows, **benchmark(price_paid_file_name, args.frames))
+            )
+        finally:
+            os.chdir(cwd)
+        with open(output_path, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Benchmark of the import time of the data-only, query, service and render paths.
+
+Each path is imported in a fresh interpreter with python -X importtime, repeated a
+number of times, and the best total is kept. The slowest top level packages of the
+best run and whether the heavy dependencies (pandas, matplotlib, pyplot, pyshp) were
+imported at all are printed as json.
+
+python -m benchmarks.import_time --repeats 5
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+import collections
+from typing import Dict, List, Tuple
+
+PATHS = {
+    "package": "import borough_map",
+    "query": "from borough_map.cube import AggregateCube",
+    "geometry": "from borough_map.geometry import GeometryStore",
+    "data": "from borough_map.data_loader import DataLoader",
+    "service": "from borough_map.service import QueryService",
+    "render": "from borough_map.controller import Controller",
+    # what a MapView that is not headless adds on its creation
+    "render_window": "from borough_map.controller import Controller; "
+    "import matplotlib.pyplot, pandas.plotting",
+}
+
+HEAVY_MODULES = ("pandas", "matplotlib", "matplotlib.pyplot", "shapefile")
+
+
+def import_times(statement: str) -> List[Tuple[str, int, int]]:
+    """Import times of a statement in a fresh interpreter.
+
+    :param statement: python code run with -X importtime
+    :return: list of (module, self microseconds, cumulative microseconds) in import order
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:") :].split("|")
+        times.append((module.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def summary(times: List[Tuple[str, int, int]], top: int) -> dict:
+    """Total milliseconds, the slowest top level packages and the heavy modules imported."""
+    modules = {module for module, _, _ in times}
+    by_package: Dict[str, int] = collections.Counter()
+    for module, self_us, _ in times:
+        by_package[module.split(".")[0]] += self_us
+    return dict(
+        total_ms=sum(self_us for _, self_us, _ in times) / 1000,
+        modules=len(modules),
+        slowest_packages_ms={
+            package: self_us / 1000 for package, self_us in by_package.most_common(top)
+        },
+        imports={module: module in modules for module in HEAVY_MODULES},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="slowest packages shown")
+    parser.add_argument("--paths", nargs="*", default=list(PATHS), choices=list(PATHS))
+    args = parser.parse_args()
+
+    results = {}
+    for path in args.paths:
+        runs = [import_times(PATHS[path]) for _ in range(args.repeats)]
+        best = min(runs, key=lambda times: sum(self_us for _, self_us, _ in times))
+        results[path] = dict(statement=PATHS[path], **summary(best, args.top))
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
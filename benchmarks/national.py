@@ -0,0 +1,80 @@
+"""Benchmark of the national (all districts) aggregation and of region subsets.
+
+A synthetic price paid file with the london boroughs plus --districts other districts
+is written to a work directory (and reused on later runs). The aggregates of all the
+regions are built in one pass over the file, then read back from the cache, and a
+subset is selected for every single region and for london. None of the subsets read
+the file again (their exact medians come from the row store of the regions). The
+timings are printed as json.
+
+python -m benchmarks.national --rows 1000000 --districts 350
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+
+from benchmarks.synthetic import (
+    london_boroughs,
+    synthetic_districts,
+    write_price_paid_file,
+)
+from borough_map.data_loader import DataLoader
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--districts", type=int, default=350)
+    parser.add_argument(
+        "--work-dir", default="benchmark_national", help="synthetic data directory"
+    )
+    args = parser.parse_args()
+
+    data_directory = os.path.join(os.path.abspath(args.work_dir), "data")
+    run_directory = os.path.join(os.path.abspath(args.work_dir), "run")
+    os.makedirs(data_directory, exist_ok=True)
+    os.makedirs(run_directory, exist_ok=True)
+    file_name = "pp-national-{}-{}.csv.gz".format(args.rows, args.districts)
+    path = os.path.join(data_directory, file_name)
+    if not os.path.exists(path):
+        write_price_paid_file(
+            path, args.rows, other_districts=synthetic_districts(args.districts)
+        )
+    for cache in os.listdir(data_directory):
+        if cache.startswith("national_"):
+            cache_path = os.path.join(data_directory, cache)
+            if os.path.isdir(cache_path):
+                shutil.rmtree(cache_path)
+            else:
+                os.remove(cache_path)
+    os.chdir(run_directory)  # the data directory is ../data
+
+    results = dict(rows=args.rows, districts=args.districts)
+    start = time.perf_counter()
+    data_loader = DataLoader(file_name, regions="all", row_store=True)
+    data_loader.load_prepare_and_aggregate_data()
+    results["aggregate_all_seconds"] = time.perf_counter() - start
+    results["regions"] = len(data_loader.boroughs)
+    results["cube_bytes"] = data_loader._cube.values.nbytes
+
+    start = time.perf_counter()
+    data_loader = DataLoader(file_name, regions="all", row_store=True)
+    data_loader.load_prepare_and_aggregate_data()
+    results["cache_load_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for region in data_loader.boroughs:
+        data_loader.select_regions([region])
+    results["select_each_region_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data_loader.select_regions(london_boroughs())
+    results["select_london_seconds"] = time.perf_counter() - start
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Scaling benchmark of the parallel ingest (DataLoader workers) against the serial path.
+
+For each worker count the raw file is aggregated by the workers (each filters and
+aggregates its shard, the partial aggregates are merged), timed, and checked to give
+the same aggregates as the serial path (to floating point rounding of the means). With
+--rows the workers return the prepared london rows instead, aggregated in this process
+as when a ledger, facets or row store keep them. One json line per run is printed.
+
+python -m benchmarks.parallel_ingest data/pp-complete.csv.gz --workers 1 2 4 8 16
+"""
+
+import time
+import json
+import argparse
+
+import pandas
+
+from borough_map.data_loader import DataLoader
+from borough_map.parallel import load_london_data_in_parallel
+
+
+def prepare_serial(data_loader: DataLoader, path: str) -> pandas.DataFrame:
+    """Prepare the london rows in a single process (the serial path)."""
+    data_loader._raw_df = data_loader._load_data(path)
+    return data_loader._update_data_for_london_analysis()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="price paid file (.csv.gz or .csv)")
+    parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="worker counts"
+    )
+    parser.add_argument(
+        "--rows",
+        action="store_true",
+        help="ship the prepared rows from the workers rather than partial aggregates",
+    )
+    args = parser.parse_args()
+
+    data_loader = DataLoader(args.path)
+    start = time.perf_counter()
+    data_loader._raw_df = data_loader._compact(prepare_serial(data_loader, args.path))
+    serial_borough_df, serial_aggregated_df = data_loader._aggregate_data()
+    serial_seconds = time.perf_counter() - start
+    print(json.dumps({"mode": "serial", "workers": 1, "seconds": serial_seconds}))
+
+    for workers in args.workers:
+        start = time.perf_counter()
+        data_loader.workers = workers
+        if args.rows:
+            data_loader._raw_df = data_loader._compact(
+                load_london_data_in_parallel(
+                    data_loader._row_preparation(), args.path, workers
+                )
+            )
+            borough_df, aggregated_df = data_loader._aggregate_data()
+        else:
+            borough_df, aggregated_df = data_loader._aggregate_london_data_in_parallel(
+                args.path
+            )
+        seconds = time.perf_counter() - start
+        pandas.testing.assert_frame_equal(
+            borough_df, serial_borough_df, check_exact=False
+        )
+        pandas.testing.assert_frame_equal(
+            aggregated_df, serial_aggregated_df, check_exact=False
+        )
+        print(
+            json.dumps(
+                {
+                    "mode": "parallel_rows" if args.rows else "parallel",
+                    "workers": workers,
+                    "seconds": seconds,
+                    "speedup": serial_seconds / seconds,
+                    "matches_serial": True,
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
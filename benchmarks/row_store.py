@@ -0,0 +1,99 @@
+"""Benchmark of re-aggregating the london rows from the memory mapped row store.
+
+Uses the synthetic files of benchmarks.end_to_end (written if missing). The aggregates
+are built once from the raw file, writing the row store, then rebuilt with a lower
+max_price from the store and, for comparison, from the raw file. Opening the store and
+a few ad-hoc aggregations of it are timed too. The timings are printed as json.
+
+python -m benchmarks.row_store --rows 1000000
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+
+from benchmarks.end_to_end import prepare_work_directory
+from borough_map.data_loader import DataLoader
+
+
+def remove_caches(data_directory: str, row_store: bool) -> None:
+    """Remove the london aggregate caches (and the row store if row_store)."""
+    for name in os.listdir(data_directory):
+        if "_row_store" in name and not row_store:
+            continue
+        if name.startswith(("london_", "yearly_london_")):
+            path = os.path.join(data_directory, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def timed_build(price_paid_file_name: str, max_price: float, row_store: bool) -> float:
+    """Seconds to build the aggregates (the caller removes the caches first)."""
+    start = time.perf_counter()
+    data_loader = DataLoader(
+        price_paid_file_name, chunk_size=1000000, row_store=row_store
+    )
+    data_loader.max_price = max_price
+    data_loader.load_prepare_and_aggregate_data()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--work-directory",
+        default=os.path.join("data", "benchmark"),
+        help="directory for the synthetic files and caches",
+    )
+    args = parser.parse_args()
+
+    work_directory = os.path.abspath(args.work_directory)
+    price_paid_file_name = prepare_work_directory(work_directory, args.rows, args.seed)
+    data_directory = os.path.join(work_directory, "data")
+    os.chdir(os.path.join(work_directory, "run"))
+    results = dict(rows=args.rows)
+
+    remove_caches(data_directory, row_store=True)
+    results["build_from_raw_with_store_seconds"] = timed_build(
+        price_paid_file_name, 100e6, row_store=True
+    )
+    remove_caches(data_directory, row_store=False)
+    results["rebuild_from_store_seconds"] = timed_build(
+        price_paid_file_name, 1e6, row_store=True
+    )
+    remove_caches(data_directory, row_store=False)
+    results["rebuild_from_raw_seconds"] = timed_build(
+        price_paid_file_name, 1e6, row_store=False
+    )
+
+    start = time.perf_counter()
+    store = DataLoader(price_paid_file_name).open_row_store()
+    results["open_seconds"] = time.perf_counter() - start
+    results["store_rows"] = len(store)
+    results["store_bytes"] = sum(
+        os.path.getsize(os.path.join(store.path, name))
+        for name in os.listdir(store.path)
+    )
+    for name, keys, selectors in [
+        ("borough_month", ["year", "month", "address_county_1"], {}),
+        ("flat_district_year", ["year", "postcode_district"], {"property_type": "F"}),
+        (
+            "new_build_tenure_month",
+            ["year", "month", "is_new_build", "estate_type"],
+            {},
+        ),
+    ]:
+        start = time.perf_counter()
+        cells = store.aggregate(keys, max_price=2e6, **selectors)
+        results[name] = dict(seconds=time.perf_counter() - start, cells=len(cells))
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
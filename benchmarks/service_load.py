@@ -0,0 +1,168 @@
+"""Load test of the query service (python -m borough_map serve).
+
+A number of keep alive connections send a mix of series, snapshot and png snapshot
+requests (random boroughs, months and statistics) as fast as the service answers
+them. The latency percentiles (p50, p90, p99 in milliseconds), requests/second and
+status counts are printed as json, overall and per path.
+
+python -m borough_map serve &
+python -m benchmarks.service_load --requests 5000 --connections 16
+"""
+
+import time
+import json
+import random
+import asyncio
+import argparse
+import collections
+import urllib.request
+from typing import Dict, List, Tuple
+
+import numpy
+
+
+async def fetch(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, target: str
+) -> int:
+    """Send one GET on a keep alive connection and read the whole response.
+
+    :return: the status code
+    """
+    writer.write(
+        "GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(target).encode("latin-1")
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+def make_targets(
+    metadata: dict, requests: int, png_fraction: float, seed: int
+) -> List[Tuple[str, str]]:
+    """Random (path, target) pairs over the boroughs, months and statistics served."""
+    rng = random.Random(seed)
+    first_year, first_month = map(int, metadata["start"].split("-"))
+    last_year, last_month = map(int, metadata["end"].split("-"))
+    months = [
+        divmod(month_number, 12)
+        for month_number in range(
+            first_year * 12 + first_month - 1, last_year * 12 + last_month
+        )
+    ]
+    targets = []
+    for _ in range(requests):
+        year, month_index = rng.choice(months)
+        stat = rng.choice(["mean", "median"])
+        draw = rng.random()
+        if draw < png_fraction:
+            path = "/snapshot.png"
+            target = "{}?year={}&month={}&stat={}".format(
+                path, year, month_index + 1, stat
+            )
+        elif draw < (1 + png_fraction) / 2:
+            path = "/snapshot"
+            target = "{}?year={}&month={}&stat={}".format(
+                path, year, month_index + 1, stat
+            )
+        else:
+            path = "/series"
+            target = "{}?borough={}&stat={}&start={}-{}".format(
+                path,
+                urllib.request.quote(rng.choice(metadata["boroughs"])),
+                stat,
+                year,
+                month_index + 1,
+            )
+        targets.append((path, target))
+    return targets
+
+
+async def run(
+    host: str, port: int, targets: List[Tuple[str, str]], connections: int
+) -> Tuple[Dict[str, List[float]], collections.Counter, float]:
+    """Send the targets over a number of connections.
+
+    :return: latencies (seconds) per path, status counts and the wall clock seconds
+    """
+    queue = collections.deque(targets)
+    latencies = collections.defaultdict(list)
+    statuses = collections.Counter()
+
+    async def worker():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while queue:
+                path, target = queue.popleft()
+                start = time.perf_counter()
+                status = await fetch(reader, writer, target)
+                latencies[path].append(time.perf_counter() - start)
+                statuses[status] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(connections)])
+    return latencies, statuses, time.perf_counter() - start
+
+
+def summary(latencies: List[float], seconds: float) -> dict:
+    """Latency percentiles in milliseconds and the request rate."""
+    milliseconds = 1000 * numpy.array(latencies)
+    return dict(
+        requests=len(latencies),
+        p50_ms=float(numpy.percentile(milliseconds, 50)),
+        p90_ms=float(numpy.percentile(milliseconds, 90)),
+        p99_ms=float(numpy.percentile(milliseconds, 99)),
+        max_ms=float(milliseconds.max()),
+        requests_per_second=len(latencies) / seconds,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument(
+        "--png-fraction", type=float, default=0.02, help="share of png requests"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with urllib.request.urlopen(
+        "http://{}:{}/boroughs".format(args.host, args.port)
+    ) as response:
+        metadata = json.load(response)
+    targets = make_targets(metadata, args.requests, args.png_fraction, args.seed)
+    latencies, statuses, seconds = asyncio.run(
+        run(args.host, args.port, targets, args.connections)
+    )
+    all_latencies = [latency for path in latencies for latency in latencies[path]]
+    print(
+        json.dumps(
+            dict(
+                connections=args.connections,
+                seconds=seconds,
+                statuses={str(status): count for status, count in statuses.items()},
+                overall=summary(all_latencies, seconds),
+                paths={
+                    path: summary(path_latencies, seconds)
+                    for path, path_latencies in latencies.items()
+                },
+            )
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Accuracy report of the quantile sketch engine against the exact groupby aggregates.
+
+The london rows of a price paid file are read once, then for each relative accuracy
+the median and percentiles of every (year, month, borough) cell are computed exactly
+(pandas groupby) and with QuantileSketch. The relative errors (max, mean, 99th
+percentile), timings and sketch sizes are printed as one json line per accuracy.
+
+python -m benchmarks.sketch_accuracy data/pp-complete.csv.gz --accuracies 0.005 0.01 0.02
+"""
+
+import time
+import json
+import argparse
+
+import numpy
+
+from borough_map.data_loader import DataLoader
+from borough_map.sketch import QuantileSketch
+
+KEYS = ["year", "month", "address_county_1"]
+
+
+def relative_errors(estimates: numpy.ndarray, exact: numpy.ndarray) -> dict:
+    """Summary of the relative errors of the estimates."""
+    errors = numpy.abs(estimates / exact - 1)
+    return dict(
+        max=float(errors.max()),
+        mean=float(errors.mean()),
+        p99=float(numpy.percentile(errors, 99)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="price paid file (.csv.gz or .csv)")
+    parser.add_argument(
+        "--accuracies", type=float, nargs="+", default=[0.005, 0.01, 0.02]
+    )
+    args = parser.parse_args()
+
+    data_loader = DataLoader(args.path)
+    data_loader._raw_df = data_loader._load_data(args.path)
+    london_df = data_loader._compact(data_loader._update_data_for_london_analysis())
+    quantiles = [0.5] + [percentile / 100 for percentile in data_loader.percentiles]
+    names = ["median"] + ["p{}".format(p) for p in data_loader.percentiles]
+
+    start = time.perf_counter()
+    exact = (
+        london_df.groupby(KEYS, observed=True)["price_gbp"]
+        .quantile(quantiles)
+        .unstack()
+    )
+    exact_seconds = time.perf_counter() - start
+
+    for accuracy in args.accuracies:
+        start = time.perf_counter()
+        sketch = QuantileSketch.from_frame(london_df, KEYS, "price_gbp", accuracy)
+        estimates = sketch.quantiles(quantiles).reindex(exact.index)
+        sketch_seconds = time.perf_counter() - start
+        print(
+            json.dumps(
+                dict(
+                    relative_accuracy=accuracy,
+                    rows=len(london_df),
+                    cells=len(exact),
+                    sketch_buckets=len(sketch.counts),
+                    sketch_bytes=int(sketch.to_frame().memory_usage(deep=True).sum()),
+                    exact_seconds=exact_seconds,
+                    sketch_seconds=sketch_seconds,
+                    errors={
+                        name: relative_errors(
+                            estimates[quantile].values, exact[quantile].values
+                        )
+                        for name, quantile in zip(names, quantiles)
+                    },
+                )
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
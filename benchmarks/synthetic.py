@@ -0,0 +1,233 @@
+"""Deterministic synthetic Land Registry price paid data and borough shape file.
+
+The price paid files have the 16 column layout of pp-complete.csv (every field
+quoted, no header) so they go through exactly the same reading code as the real
+data. The shape file has one square per london borough laid out on a grid inside
+the map extent; the first borough is made of two parts. The rows outside london are
+spread over OTHER_DISTRICTS or, with --districts, over that many synthetic districts
+(e.g. about 350 like England and Wales).
+
+python -m benchmarks.synthetic data/pp-synthetic.csv.gz --rows 1000000
+"""
+
+import io
+import csv
+import gzip
+import argparse
+from typing import List, Optional
+
+import numpy
+import pandas
+import shapefile as shp
+
+from borough_map.data_loader import DataLoader
+
+OTHER_DISTRICTS = [
+    "BIRMINGHAM",
+    "BRISTOL",
+    "CAMBRIDGE",
+    "ELMBRIDGE",
+    "LEEDS",
+    "MANCHESTER",
+    "SEVENOAKS",
+    "WATFORD",
+]
+POSTCODE_AREAS = ["E", "EC", "N", "NW", "SE", "SW", "W", "WC", "BR", "CR", "HA"]
+START = numpy.datetime64("1995-01-01")
+END = numpy.datetime64("2019-11-30")  # the last month of the default Controller
+
+
+def london_boroughs() -> List[str]:
+    """Upper case names of the london boroughs (as in the price paid data)."""
+    return DataLoader.get_all_london_boroughs()
+
+
+def synthetic_districts(count: int) -> List[str]:
+    """Names of count synthetic districts outside london (DISTRICT 001, ...)."""
+    return ["DISTRICT {:03d}".format(i + 1) for i in range(count)]
+
+
+def make_price_paid_chunk(
+    rows: int,
+    first_row: int,
+    random: numpy.random.RandomState,
+    london_fraction: float,
+    other_districts: Optional[List[str]] = None,
+) -> pandas.DataFrame:
+    """One chunk of synthetic rows in the price paid layout.
+
+    :param rows: number of rows
+    :param first_row: number of the first row (used for the unique transaction ids)
+    :param random: random state (consumed in a fixed order so files are reproducible)
+    :param london_fraction: fraction of rows in a london borough
+    :param other_districts: districts of the rows outside london (OTHER_DISTRICTS by default)
+    :return: dataframe with the 16 columns in file order
+    """
+    boroughs = numpy.array(london_boroughs())
+    other_districts = numpy.array(other_districts or OTHER_DISTRICTS)
+    is_london = random.random_sample(rows) < london_fraction
+    districts = numpy.where(
+        is_london,
+        boroughs[random.randint(len(boroughs), size=rows)],
+        other_districts[random.randint(len(other_districts), size=rows)],
+    )
+    days = random.randint(0, int((END - START).astype(int)) + 1, size=rows)
+    dates = numpy.datetime_as_string(START + days.astype("timedelta64[D]"))
+    prices = numpy.round(
+        random.lognormal(12.0, 0.7, size=rows) * (1 + days / 5000.0)
+    ).astype(numpy.int64)
+    postcodes = (
+        pandas.Series(numpy.array(POSTCODE_AREAS)[random.randint(11, size=rows)])
+        + random.randint(1, 21, size=rows).astype(str)
+        + " "
+        + random.randint(1, 10, size=rows).astype(str)
+        + pandas.Series(
+            numpy.array(list("ABDEFGHJLNPQRSTUWXYZ"))[random.randint(20, size=rows)]
+        )
+        + pandas.Series(
+            numpy.array(list("ABDEFGHJLNPQRSTUWXYZ"))[random.randint(20, size=rows)]
+        )
+    )
+    ids = numpy.arange(first_row, first_row + rows)
+    return pandas.DataFrame(
+        {
+            "transaction_id": [
+                "{{{:08X}-0000-0000-0000-{:012X}}}".format(i, i) for i in ids
+            ],
+            "price": prices,
+            "date": pandas.Series(dates) + " 00:00",
+            "postcode": postcodes,
+            "property_type": numpy.array(list("DSTFO"))[
+                random.choice(5, size=rows, p=[0.25, 0.25, 0.25, 0.24, 0.01])
+            ],
+            "new_build": numpy.where(random.random_sample(rows) < 0.1, "Y", "N"),
+            "estate_type": numpy.where(random.random_sample(rows) < 0.75, "F", "L"),
+            "paon": random.randint(1, 200, size=rows).astype(str),
+            "saon": "",
+            "street": "HIGH STREET",
+            "locality": "",
+            "town": numpy.where(is_london, "LONDON", districts),
+            "district": districts,
+            "county": numpy.where(is_london, "GREATER LONDON", districts),
+            "ppd_category_type": numpy.where(
+                random.random_sample(rows) < 0.95, "A", "B"
+            ),
+            "record_status": "A",
+        }
+    )
+
+
+def write_price_paid_file(
+    path: str,
+    rows: int,
+    seed: int = 0,
+    london_fraction: float = 0.15,
+    chunk_rows: int = 1000000,
+    other_districts: Optional[List[str]] = None,
+) -> None:
+    """Write a synthetic price paid file (gzip compressed if the path ends in .gz).
+
+    The same rows, seed and london_fraction always give the same file.
+
+    :param path: output file path
+    :param rows: number of rows
+    :param seed: random seed
+    :param london_fraction: fraction of rows in a london borough
+    :param chunk_rows: rows generated and written at a time (bounds the memory used)
+    :param other_districts: districts of the rows outside london (OTHER_DISTRICTS by default)
+    """
+    random = numpy.random.RandomState(seed)
+    with open(path, "wb") as output_file:
+        if path.endswith(".gz"):
+            # no file name or mtime in the header so the same arguments give identical files
+            binary_file = gzip.GzipFile("", "wb", 1, output_file, mtime=0)
+        else:
+            binary_file = output_file
+        with io.TextIOWrapper(binary_file, newline="") as price_paid_file:
+            for first_row in range(0, rows, chunk_rows):
+                chunk = make_price_paid_chunk(
+                    min(chunk_rows, rows - first_row),
+                    first_row,
+                    random,
+                    london_fraction,
+                    other_districts,
+                )
+                chunk.to_csv(
+                    price_paid_file, header=False, index=False, quoting=csv.QUOTE_ALL
+                )
+
+
+def write_borough_shape_file(
+    path: str, boroughs: Optional[List[str]] = None, size: float = 6e3
+) -> None:
+    """Write a polygon shape file with one square per borough (two for the first).
+
+    Names are written like the real shape file (title case, "Westminster") so they go
+    through the same name mappings as the real data.
+
+    :param path: output path (with or without the .shp extension)
+    :param boroughs: upper case borough names (defaults to the london boroughs)
+    :param size: side of each square in metres
+    """
+    boroughs = boroughs or london_boroughs()
+    x_origin, y_origin = 5.05e5, 1.57e5
+    with shp.Writer(path, shapeType=shp.POLYGON) as writer:
+        writer.field("NAME", "C", 40)
+        for i, borough in enumerate(boroughs):
+            x, y = x_origin + (i % 8) * size, y_origin + (i // 8) * size
+            if i == 0:
+                parts = [
+                    [
+                        [x, y],
+                        [x, y + size / 3],
+                        [x + size, y + size / 3],
+                        [x + size, y],
+                    ],
+                    [
+                        [x, y + size / 2],
+                        [x, y + size],
+                        [x + size, y + size],
+                        [x + size, y + size / 2],
+                    ],
+                ]
+            else:
+                parts = [[[x, y], [x, y + size], [x + size, y + size], [x + size, y]]]
+            writer.poly([part + part[:1] for part in parts])
+            name = (
+                "Westminster" if borough == "CITY OF WESTMINSTER" else borough.title()
+            )
+            writer.record(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="output price paid file (.csv.gz or .csv)")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--london-fraction", type=float, default=0.15)
+    parser.add_argument(
+        "--districts", type=int, help="number of synthetic districts outside london"
+    )
+    parser.add_argument(
+        "--shape-file",
+        help="also write a shape file of the boroughs (and --districts) here",
+    )
+    args = parser.parse_args()
+
+    other_districts = synthetic_districts(args.districts) if args.districts else None
+    write_price_paid_file(
+        args.path,
+        args.rows,
+        args.seed,
+        args.london_fraction,
+        other_districts=other_districts,
+    )
+    if args.shape_file:
+        write_borough_shape_file(
+            args.shape_file,
+            london_boroughs() + other_districts if other_districts else None,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Benchmark of scrubbing through the months in the interactive viewer.
+
+Uses the synthetic files of benchmarks.end_to_end (written if missing) and a headless
+viewer, so the drawing is timed but not the window's blit to the screen. Each scrub
+steps through the months at --fps (as a user dragging the slider would) and the
+latency of the steps is printed as json (p50, p99 and max in milliseconds):
+
+    forward: every month in order with the prefetch thread
+    back: then every month in reverse order (mostly restored from the frame cache)
+    random: random months without prefetch or cache hits, the cost of drawing a step
+    no_prefetch_forward: every month in order without the prefetch thread
+
+python -m benchmarks.viewer --rows 1000000 --fps 30
+"""
+
+import os
+import json
+import time
+import argparse
+from typing import Sequence
+
+import numpy
+
+from benchmarks.end_to_end import SHP_FILE_NAME, prepare_work_directory
+from borough_map.controller import Controller
+from borough_map.viewer import Viewer
+
+
+def scrub(viewer: Viewer, frames: Sequence[int], fps: float) -> dict:
+    """Show the frames at a steady rate and return the step latencies.
+
+    :param viewer: viewer to step through
+    :param frames: frame numbers in the order shown
+    :param fps: steps per second (the time left after a step is given to the prefetch)
+    :return: latency percentiles in milliseconds and the cache hits and misses
+    """
+    hits, misses = viewer.cache.hits, viewer.cache.misses
+    latencies = []
+    for i in frames:
+        start = time.perf_counter()
+        viewer.show_frame(int(i))
+        latencies.append(time.perf_counter() - start)
+        time.sleep(max(0.0, 1 / fps - latencies[-1]))
+    milliseconds = 1000 * numpy.array(latencies)
+    return dict(
+        steps=len(latencies),
+        p50_ms=float(numpy.percentile(milliseconds, 50)),
+        p99_ms=float(numpy.percentile(milliseconds, 99)),
+        max_ms=float(milliseconds.max()),
+        cache_hits=viewer.cache.hits - hits,
+        cache_misses=viewer.cache.misses - misses,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fps", type=float, default=30.0, help="scrubbing rate")
+    parser.add_argument("--cache-size", type=int, default=64)
+    parser.add_argument("--prefetch", type=int, default=8)
+    parser.add_argument(
+        "--work-directory",
+        default=os.path.join("data", "benchmark"),
+        help="directory for the synthetic files and caches",
+    )
+    args = parser.parse_args()
+
+    work_directory = os.path.abspath(args.work_directory)
+    price_paid_file_name = prepare_work_directory(work_directory, args.rows, args.seed)
+    os.chdir(os.path.join(work_directory, "run"))
+    results = dict(rows=args.rows, fps=args.fps)
+
+    def viewer(prefetch: int) -> Viewer:
+        controller = Controller(price_paid_file_name, SHP_FILE_NAME, headless=True)
+        start = time.perf_counter()
+        viewer = controller.viewer(cache_size=args.cache_size, prefetch=prefetch)
+        results["viewer_seconds"] = time.perf_counter() - start
+        return viewer
+
+    scrubbed = viewer(args.prefetch)
+    frames = numpy.arange(scrubbed.n_frames)
+    results["forward"] = scrub(scrubbed, frames, args.fps)
+    results["back"] = scrub(scrubbed, frames[::-1], args.fps)
+    scrubbed.close()
+
+    scrubbed = viewer(0)
+    results["random"] = scrub(
+        scrubbed, numpy.random.default_rng(args.seed).permutation(frames), args.fps
+    )
+    scrubbed = viewer(0)
+    results["no_prefetch_forward"] = scrub(scrubbed, frames, args.fps)
+    print(json.dumps(results))
+
+
+if __name__ == "__main__":
+    main()
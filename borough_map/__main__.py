@@ -1,11 +1,126 @@
-import borough_map.controller
+import json
+import asyncio
+import argparse
 
-if __name__ == "__main__":
+
+def render(args: argparse.Namespace) -> None:
+    """Render the video of the median prices (the default command)."""
+    import borough_map.controller
+
+    controller = borough_map.controller.Controller(
+        raw_price_paid_file_name=args.price_paid_file,
+        shp_file_name=args.shp_file,
+        data_directory=args.data_directory,
+        start_year=1995,
+        end_year=2019,
+        end_month=11,
+        chunk_size=1000000,
+        headless=True,
+    )
+    controller.render()
+
+
+def batch(args: argparse.Namespace) -> None:
+    """Render the videos of a json list of specs from one load of the data."""
+    import borough_map.controller
+    from borough_map.batch import RenderSpec
+
+    with open(args.specs) as specs_file:
+        specs = [RenderSpec.from_dict(spec) for spec in json.load(specs_file)]
     controller = borough_map.controller.Controller(
-        raw_price_paid_file_name="pp-complete.csv.gz",
-        shp_file_name="London_Borough_Excluding_MHW.shp",
+        raw_price_paid_file_name=args.price_paid_file,
+        shp_file_name=args.shp_file,
+        data_directory=args.data_directory,
         start_year=1995,
         end_year=2019,
         end_month=11,
+        chunk_size=1000000,
+        facets=any(spec.selectors for spec in specs),
+        headless=True,
+    )
+    controller.render_batch(specs, processes=args.processes)
+
+
+def view(args: argparse.Namespace) -> None:
+    """Open the map in a window with a slider (and arrow keys) over the months."""
+    import borough_map.controller
+
+    controller = borough_map.controller.Controller(
+        raw_price_paid_file_name=args.price_paid_file,
+        shp_file_name=args.shp_file,
+        data_directory=args.data_directory,
+        start_year=1995,
+        end_year=2019,
+        end_month=11,
+        chunk_size=1000000,
+    )
+    controller.viewer().show()
+
+
+def serve(args: argparse.Namespace) -> None:
+    """Load the aggregates once and answer json/png queries over http."""
+    from borough_map.data_loader import DataLoader
+    from borough_map.service import QueryService
+
+    def map_view_factory():
+        from borough_map.map_view import MapView  # matplotlib, on the first png
+
+        return MapView(args.shp_file, headless=True, data_directory=args.data_directory)
+
+    data_loader = DataLoader(
+        args.price_paid_file, chunk_size=1000000, data_directory=args.data_directory
+    )
+    service = QueryService(
+        data_loader,
+        map_view_factory=map_view_factory if args.shp_file else None,
+        png_cache_size=args.png_cache_size,
+    )
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m borough_map")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        default="render",
+        choices=["render", "batch", "view", "serve"],
+        help="render the video (default), render the videos of --specs, view the "
+        "months in a window or serve the aggregates over http",
+    )
+    parser.add_argument("--price-paid-file", default="pp-complete.csv.gz")
+    parser.add_argument(
+        "--data-directory",
+        help="directory of the data files and caches (default: ../data)",
+    )
+    parser.add_argument(
+        "--shp-file",
+        default="London_Borough_Excluding_MHW.shp",
+        help="borough shape file (serve: an empty value disables png snapshots)",
+    )
+    parser.add_argument(
+        "--specs",
+        default="render_specs.json",
+        help="batch: json list of RenderSpec arguments, e.g. "
+        '[{"file_name": "mean_prices.mp4", "stat": "mean"}]',
+    )
+    parser.add_argument(
+        "--processes", type=int, help="batch: render processes (default: cpus)"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="serve: interface")
+    parser.add_argument("--port", type=int, default=8080, help="serve: port")
+    parser.add_argument(
+        "--png-cache-size", type=int, default=128, help="serve: png snapshots kept"
     )
-    controller.animate()
+    arguments = parser.parse_args()
+    if arguments.command == "serve":
+        serve(arguments)
+    elif arguments.command == "batch":
+        batch(arguments)
+    elif arguments.command == "view":
+        view(arguments)
+    else:
+        render(arguments)
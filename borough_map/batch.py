@@ -0,0 +1,215 @@
+import os
+import time
+import logging
+import multiprocessing
+import concurrent.futures
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy
+
+from borough_map.facets import Selector
+from borough_map.geometry import GeometryStore
+from borough_map.map_view import MapView
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+
+class RenderSpec:
+    """One video of a batch render: the statistic drawn, its scale, months and output."""
+
+    def __init__(
+        self,
+        file_name: str,
+        stat: str = "median",
+        selectors: Optional[Dict[str, Selector]] = None,
+        color_limits: Tuple[float, float] = (0, 1e6),
+        cmap: str = "plasma",
+        start: Optional[Tuple[int, int]] = None,
+        end: Optional[Tuple[int, int]] = None,
+        dpi: float = 100,
+        fps: int = 15,
+        lossless: bool = False,
+    ):
+        """Instantiate the spec.
+
+        :param file_name: output video file name
+        :param stat: statistic of the areas, "mean", "median" or "count" (or a percentile
+            such as "p90" with the sketch engine)
+        :param selectors: facet values of the transactions included, e.g.
+            {"property_type": "F"} (the controller needs facets=True)
+        :param color_limits: values at the bottom and top of the colour bar
+        :param cmap: matplotlib colour map of the areas
+        :param start: first year, month drawn (defaults to the controller's first month)
+        :param end: last year, month drawn (defaults to the controller's last month)
+        :param dpi: resolution, the video is 6 x 9 inches of dpi pixels
+        :param fps: frames per second of the video
+        :param lossless: encode losslessly
+        """
+        self.file_name = file_name
+        self.stat = stat
+        self.selectors: Dict[str, Selector] = dict(selectors or {})
+        self.color_limits = tuple(color_limits)
+        self.cmap = cmap
+        self.start = start
+        self.end = end
+        self.dpi = dpi
+        self.fps = fps
+        self.lossless = lossless
+
+    @classmethod
+    def from_dict(cls, spec: dict) -> "RenderSpec":
+        """Spec from a json object with the arguments of __init__ (start and end as "YYYY-MM").
+
+        e.g. {"file_name": "flat_counts.mp4", "stat": "count", "selectors":
+        {"property_type": "F"}, "color_limits": [0, 200], "start": "2010-01"}
+        """
+        spec = dict(spec)
+        for key in ("start", "end"):
+            if isinstance(spec.get(key), str):
+                year, month = spec[key].split("-")
+                spec[key] = (int(year), int(month))
+        return cls(**spec)
+
+    def __repr__(self):
+        return "RenderSpec({!r}, stat={!r}, selectors={!r})".format(
+            self.file_name, self.stat, self.selectors
+        )
+
+
+class RenderJob:
+    """Everything a worker needs to render one spec, without the data loader.
+
+    values[k] are the colours of frame k, the month first_month + k, and the line of
+    frame k is line_x[: line_ends[k]], line_y[: line_ends[k]].
+    """
+
+    def __init__(
+        self,
+        spec: RenderSpec,
+        values: numpy.ndarray,
+        first_month: Tuple[int, int],
+        line_data: Tuple[numpy.ndarray, numpy.ndarray],
+        line_ends: numpy.ndarray,
+    ):
+        """Instantiate the job.
+
+        :param spec: the video rendered
+        :param values: array of shape (frames, areas), ordered as the borough_order
+        :param first_month: year, month of frame 0
+        :param line_data: x (datetime) and y data of the line
+        :param line_ends: number of line points shown in each frame
+        """
+        self.spec = spec
+        self.values = values
+        self.first_month = first_month
+        self.line_x, self.line_y = line_data
+        self.line_ends = line_ends
+
+    @property
+    def cost(self) -> float:
+        """Relative render time (pixels times frames), to start the longest jobs first."""
+        return len(self.values) * self.spec.dpi * self.spec.dpi
+
+    def year_month(self, k: int) -> Tuple[int, int]:
+        """Year, month of frame k."""
+        years, month_index = divmod(self.first_month[1] - 1 + k, 12)
+        return self.first_month[0] + years, month_index + 1
+
+
+def render_job(
+    job: RenderJob,
+    geometry: GeometryStore,
+    borough_order: Sequence[str],
+    allow_missing_areas: bool,
+) -> float:
+    """Render a job to its video on a new headless map view (run in a worker process).
+
+    :param job: the job
+    :param geometry: outlines of the areas (built once by the controller)
+    :param borough_order: areas of the values
+    :param allow_missing_areas: see MapView
+    :return: frames rendered per second
+    """
+    spec = job.spec
+    map_view = MapView(None, geometry=geometry, headless=True)
+    map_view.fig.set_dpi(spec.dpi)
+    map_view.borough_order = borough_order
+    map_view.allow_missing_areas = allow_missing_areas
+    map_view.color_limits = spec.color_limits
+    map_view.cmap = spec.cmap
+    last_year = job.year_month(len(job.values) - 1)[0]
+    map_view.date_limits = (
+        "{}-01-01".format(job.first_month[0]),
+        "{}-01-01".format(last_year + 1),
+    )
+
+    def update(k: int) -> None:
+        map_view.set_colors_for_patches(job.values[k])
+        map_view.draw_text_on_axis(*job.year_month(k))
+        end = job.line_ends[k]
+        map_view.plot_line(job.line_x[:end], job.line_y[:end])
+
+    return map_view.render_to_ffmpeg(
+        update,
+        len(job.values),
+        file_name=spec.file_name,
+        fps=spec.fps,
+        lossless=spec.lossless,
+    )
+
+
+def render_jobs(
+    jobs: List[RenderJob],
+    geometry: GeometryStore,
+    borough_order: Sequence[str],
+    allow_missing_areas: bool,
+    processes: Optional[int] = None,
+) -> Dict[str, float]:
+    """Render jobs over a pool of processes, the most expensive first.
+
+    Each job is one video rendered by one process, so the pool is kept busy as long as
+    there are jobs left (a single long video is better split with render_parallel).
+
+    :param jobs: the jobs
+    :param geometry: outlines of the areas, sent to each process
+    :param borough_order: areas of the values
+    :param allow_missing_areas: see MapView
+    :param processes: number of render processes (defaults to the number of cpus), with
+        1 the jobs are rendered one after the other in this process
+    :return: frames rendered per second of each output file
+    """
+    processes = min(processes or os.cpu_count() or 1, len(jobs))
+    jobs = sorted(jobs, key=lambda job: job.cost, reverse=True)
+    start = time.perf_counter()
+    if processes <= 1:
+        frames_per_second = {
+            job.spec.file_name: render_job(
+                job, geometry, borough_order, allow_missing_areas
+            )
+            for job in jobs
+        }
+    else:
+        # spawn so workers do not inherit this process' figure or GUI backend state
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(
+                    render_job, job, geometry, borough_order, allow_missing_areas
+                ): job.spec.file_name
+                for job in jobs
+            }
+            frames_per_second = {
+                futures[future]: future.result()
+                for future in concurrent.futures.as_completed(futures)
+            }
+    frames = sum(len(job.values) for job in jobs)
+    LOGGER.info(
+        "render_jobs rendered %s videos (%s frames) over %s processes at %.1f frames/second",
+        len(jobs),
+        frames,
+        processes,
+        frames / (time.perf_counter() - start),
+    )
+    return frames_per_second
@@ -0,0 +1,246 @@
+import os
+import json
+import shutil
+import logging
+from typing import Dict, List, Tuple
+
+import numpy
+import pandas
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+CACHE_FORMAT_VERSION = 1
+
+
+class CacheBackend:
+    """Base class for persisting an aggregated dataframe between runs.
+
+    A backend is bound to a directory and a cache name (no extension) and knows how
+    to check for, save and load a single dataframe.
+    """
+
+    format_name: str = ""
+
+    def __init__(self, directory: str, name: str):
+        """Instantiate the cache backend.
+
+        :param directory: directory holding the cache
+        :param name: name of the cache (without any extension)
+        """
+        self._directory = directory
+        self._name = name
+
+    @property
+    def path(self) -> str:
+        """Path of the cache on disk."""
+        raise NotImplementedError
+
+    def exists(self) -> bool:
+        """Checks if a readable cache is available."""
+        raise NotImplementedError
+
+    def remove(self) -> None:
+        """Remove the cache from disk if it exists."""
+        raise NotImplementedError
+
+    def save(self, df: pandas.DataFrame) -> None:
+        """Save the dataframe to the cache.
+
+        :param df: dataframe to persist
+        """
+        raise NotImplementedError
+
+    def load(self) -> pandas.DataFrame:
+        """Load the dataframe from the cache.
+
+        :return: the cached dataframe
+        """
+        raise NotImplementedError
+
+
+class CsvCacheBackend(CacheBackend):
+    """Text CSV cache (the original format), kept as a fallback.
+
+    The leading index_levels columns are read back as the index and the date_time
+    column is parsed back to datetimes.
+    """
+
+    format_name = "csv"
+
+    def __init__(self, directory: str, name: str, index_levels: int):
+        """Instantiate the CSV cache backend.
+
+        :param directory: directory holding the cache
+        :param name: name of the cache (without any extension)
+        :param index_levels: number of leading columns that form the index
+        """
+        super().__init__(directory, name)
+        self._index_levels = index_levels
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self._directory, self._name + ".csv")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def remove(self) -> None:
+        if self.exists():
+            os.remove(self.path)
+
+    def save(self, df: pandas.DataFrame) -> None:
+        df.to_csv(self.path, index=True)
+
+    def load(self) -> pandas.DataFrame:
+        return pandas.read_csv(
+            self.path,
+            index_col=list(range(self._index_levels)),
+            parse_dates=["date_time"],
+        )
+
+
+class NumpyCacheBackend(CacheBackend):
+    """Binary columnar cache of one .npy file per index level and column.
+
+    The directory also holds a meta.json with the format version, the index and column
+    names and which arrays are categorical (stored as integer codes plus a categories
+    array). Arrays are opened memory mapped so a warm start is little more than a copy
+    of the arrays into the dataframe, with dtypes and the MultiIndex kept exactly.
+    """
+
+    format_name = "npy"
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self._directory, self._name + ".npycache")
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.path, "meta.json")
+
+    def exists(self) -> bool:
+        if not os.path.exists(self._meta_path):
+            return False
+        with open(self._meta_path) as meta_file:
+            meta = json.load(meta_file)
+        if meta.get("format_version") != CACHE_FORMAT_VERSION:
+            LOGGER.info(
+                "Ignoring %s cache with format version %s (expected %s).",
+                self.path,
+                meta.get("format_version"),
+                CACHE_FORMAT_VERSION,
+            )
+            return False
+        return True
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def save(self, df: pandas.DataFrame) -> None:
+        self.remove()  # drop arrays of columns that no longer exist
+        os.makedirs(self.path, exist_ok=True)
+        index_names = [str(name) for name in df.index.names]
+        meta = {
+            "format_version": CACHE_FORMAT_VERSION,
+            "index": self._save_arrays(
+                "index", [df.index.get_level_values(i) for i in range(df.index.nlevels)]
+            ),
+            "index_names": index_names,
+            "columns": self._save_arrays("column", [df[c] for c in df.columns]),
+            "column_names": [str(column) for column in df.columns],
+        }
+        # meta.json is written last so a partially written cache is never picked up
+        with open(self._meta_path, "w") as meta_file:
+            json.dump(meta, meta_file, indent=2)
+
+    def _save_arrays(self, prefix: str, arrays: List) -> List[Dict]:
+        """Save index levels or columns as .npy files.
+
+        :param prefix: file name prefix (index or column)
+        :param arrays: list of pandas Index/Series objects to persist
+        :return: list of descriptions for meta.json
+        """
+        descriptions = []
+        for i, values in enumerate(arrays):
+            file_name = "{}_{}.npy".format(prefix, i)
+            description = {"file": file_name, "categorical": False}
+            if isinstance(values.dtype, pandas.CategoricalDtype):
+                categorical = pandas.Categorical(values)
+                categories_file_name = "{}_{}_categories.npy".format(prefix, i)
+                numpy.save(
+                    os.path.join(self.path, categories_file_name),
+                    self._to_numpy(pandas.Series(categorical.categories)),
+                )
+                numpy.save(os.path.join(self.path, file_name), categorical.codes)
+                description.update(categorical=True, categories=categories_file_name)
+            else:
+                array = self._to_numpy(values)
+                if array.dtype.kind == "U":
+                    array, description["text"] = self._to_ascii(array)
+                numpy.save(os.path.join(self.path, file_name), array)
+            descriptions.append(description)
+        return descriptions
+
+    @staticmethod
+    def _to_numpy(values) -> numpy.ndarray:
+        """Convert pandas values to a numpy array that can be saved without pickling."""
+        array = numpy.asarray(values)
+        if array.dtype == object:
+            array = array.astype(str)
+        return array
+
+    @staticmethod
+    def _to_ascii(array: numpy.ndarray) -> Tuple[numpy.ndarray, bool]:
+        """Store ascii text as fixed width bytes (4x smaller than numpy unicode).
+
+        :param array: unicode array
+        :return: tuple of the array to save and whether it has to be decoded on load
+        """
+        try:
+            return array.astype("S"), True
+        except UnicodeEncodeError:
+            return array, False
+
+    def _load_array(self, description: Dict):
+        """Load a memory mapped array (or categorical) described in meta.json."""
+        values = numpy.load(os.path.join(self.path, description["file"]), mmap_mode="r")
+        if description["categorical"]:
+            categories = numpy.load(os.path.join(self.path, description["categories"]))
+            return pandas.Categorical.from_codes(values, categories)
+        if description.get("text", False):
+            return values.astype(str)
+        return values
+
+    def load(self) -> pandas.DataFrame:
+        with open(self._meta_path) as meta_file:
+            meta = json.load(meta_file)
+        levels = [self._load_array(description) for description in meta["index"]]
+        if len(levels) == 1:
+            index = pandas.Index(levels[0], name=meta["index_names"][0])
+        else:
+            index = pandas.MultiIndex.from_arrays(levels, names=meta["index_names"])
+        columns = {
+            name: self._load_array(description)
+            for name, description in zip(meta["column_names"], meta["columns"])
+        }
+        return pandas.DataFrame(columns, index=index)
+
+
+def get_cache_backend(
+    cache_format: str, directory: str, name: str, index_levels: int
+) -> CacheBackend:
+    """Get the cache backend for a format name.
+
+    :param cache_format: "npy" (binary columnar) or "csv"
+    :param directory: directory holding the cache
+    :param name: name of the cache (without any extension)
+    :param index_levels: number of index levels of the cached dataframe
+    :return: the cache backend
+    """
+    if cache_format == NumpyCacheBackend.format_name:
+        return NumpyCacheBackend(directory, name)
+    if cache_format == CsvCacheBackend.format_name:
+        return CsvCacheBackend(directory, name, index_levels)
+    raise ValueError("Unknown cache format: {}".format(cache_format))
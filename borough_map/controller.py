@@ -1,9 +1,25 @@
-import itertools
+import os
+import time
+import shutil
 import logging
-from typing import Iterator, Tuple
+import tempfile
+import multiprocessing
+import concurrent.futures
+from typing import TYPE_CHECKING, Dict, Optional, Sequence, Tuple, Union
+
+import numpy
 
 from borough_map.data_loader import DataLoader
-from borough_map.map_view import MapView
+from borough_map.dates import month_starts
+from borough_map.facets import Selector
+from borough_map.geometry import GeometryStore
+from borough_map.instrumentation import Instrumentation
+from borough_map.map_view import MapView, concatenate_videos
+from borough_map.paths import resolve_data_directory
+
+if TYPE_CHECKING:
+    from borough_map.batch import RenderSpec
+    from borough_map.viewer import Viewer
 
 logging.basicConfig()
 LOGGER = logging.getLogger(__file__)
@@ -19,6 +35,19 @@ class Controller:
         start_year: int = 1995,
         end_year: int = 2019,
         end_month: int = 11,
+        chunk_size: Optional[int] = None,
+        cache_format: str = "npy",
+        workers: int = 1,
+        simplify_tolerance: float = 0.0,
+        instrumentation: Optional[Instrumentation] = None,
+        trace_file_name: Optional[str] = None,
+        area_level: str = "borough",
+        area_file_name: Optional[str] = None,
+        regions: Union[str, Sequence[str]] = "london",
+        facets: bool = False,
+        facet_selectors: Optional[Dict[str, Selector]] = None,
+        headless: bool = False,
+        data_directory: Optional[str] = None,
     ):
         """Instantiate the controller.
 
@@ -27,58 +56,401 @@ class Controller:
         :param start_year: start year of the price paid data (assumed to start in Jan)
         :param end_year: end year of the price paid data
         :param end_month: end month of the price paid data
+        :param chunk_size: rows per chunk when streaming the raw data (None reads it in one go)
+        :param cache_format: format of the aggregated data cache ("npy" or "csv")
+        :param workers: number of processes used to parse the raw data
+        :param simplify_tolerance: simplify borough outlines to this tolerance in metres (0 keeps all)
+        :param instrumentation: collects stage timings, rows and memory (shared with the data
+            loader and map view, by default a new one that keeps events only with a
+            trace_file_name); add hooks to it to receive the events
+        :param trace_file_name: if set the instrumentation is written to this file after each
+            render, as a Chrome trace if it ends in .trace.json and as json otherwise
+        :param area_level: areas of the map, "borough" or the postcode "district" or "sector"
+        :param area_file_name: outlines of the postcode areas, a shape file (.shp, named by
+            the first field) or a csv of postcode unit coordinates (e.g. the ONS Postcode
+            Directory) drawn as a hexagon per area centroid
+        :param regions: "london" (the boroughs), "all" (every local authority district of the
+            price paid data, drawn from shp_file_name) or a list of district names. Lists are
+            selected from the cached "all" aggregates, so any subset costs no further reads.
+        :param facets: keep the prices by property type, new build and tenure so show and the
+            renders can select them (e.g. show(2019, 1, property_type="F"))
+        :param facet_selectors: facet values of the transactions drawn by animate and the
+            renders, e.g. {"property_type": "F", "estate_type": "L"} (implies facets)
+        :param headless: draw on an Agg canvas without pyplot (renders only, show is
+            unavailable), see MapView
+        :param data_directory: directory of the price paid, shape and area files and the
+            caches (defaults to ../data from the working directory)
         """
-        self.data_loader = DataLoader(raw_price_paid_file_name)
-        self.map_view = MapView(shp_file_name)
+        if area_level != "borough" and area_file_name is None:
+            raise ValueError(
+                "area_file_name is needed to draw {} areas".format(area_level)
+            )
+        self._arguments = dict(
+            raw_price_paid_file_name=raw_price_paid_file_name,
+            shp_file_name=shp_file_name,
+            start_year=start_year,
+            end_year=end_year,
+            end_month=end_month,
+            chunk_size=chunk_size,
+            cache_format=cache_format,
+            workers=workers,
+            simplify_tolerance=simplify_tolerance,
+            area_level=area_level,
+            area_file_name=area_file_name,
+            regions=regions,
+            facets=facets,
+            facet_selectors=facet_selectors,
+            headless=headless,
+            data_directory=resolve_data_directory(data_directory),
+        )  # to build the same controller in render worker processes
+        self.data_directory = self._arguments["data_directory"]
+        self.instrumentation = instrumentation or Instrumentation(
+            keep_events=trace_file_name is not None
+        )
+        self.trace_file_name = trace_file_name
+        self.area_level = area_level
+        self.facet_selectors: Dict[str, Selector] = dict(facet_selectors or {})
+        if (facets or self.facet_selectors) and area_level != "borough":
+            raise ValueError("Facets are only available for boroughs.")
+        self.data_loader = DataLoader(
+            raw_price_paid_file_name,
+            chunk_size=chunk_size,
+            cache_format=cache_format,
+            workers=workers,
+            instrumentation=self.instrumentation,
+            postcode_levels=[] if area_level == "borough" else [area_level],
+            regions="london" if regions == "london" else "all",
+            facets=facets or bool(self.facet_selectors),
+            # the exact medians of a list of regions are taken from the rows
+            row_store=regions not in ("london", "all")
+            and not (facets or self.facet_selectors),
+            data_directory=self.data_directory,
+        )
+        self.map_view = MapView(
+            shp_file_name,
+            simplify_tolerance=simplify_tolerance,
+            instrumentation=self.instrumentation,
+            geometry=self._load_area_geometry(area_file_name, simplify_tolerance),
+            headless=headless,
+            data_directory=self.data_directory,
+        )
         self.data_loader.load_prepare_and_aggregate_data()
+        if regions not in ("london", "all"):
+            self.data_loader = self.data_loader.select_regions(
+                [str.upper(region) for region in regions]
+            )
+        if regions != "london":  # district names differ slightly between the sources
+            self.map_view.allow_missing_areas = True
+        if area_level == "borough":
+            self.map_view.borough_order = self.data_loader.boroughs
+        else:
+            self.map_view.borough_order = self.data_loader.postcode_areas(area_level)
         self._start_year, self._end_year, self._end_month = (
             start_year,
             end_year,
             end_month,
         )
         self._frames = (self._end_year - self._start_year) * 12 + self._end_month
-        self._input_iterator = self._get_year_month_pair_iterator()
 
-    def show(self, year: int, month: int) -> None:
+    def _load_area_geometry(
+        self, area_file_name: Optional[str], simplify_tolerance: float
+    ) -> Optional[GeometryStore]:
+        """Geometry of the postcode areas (None for boroughs, drawn from the shape file).
+
+        :param area_file_name: shape file or postcode unit coordinate csv (in data_directory)
+        :param simplify_tolerance: simplify shape file outlines to this tolerance in metres
+        :return: the geometry store
+        """
+        if self.area_level == "borough":
+            return None
+        path = os.path.join(self.data_directory, area_file_name)
+        with self.instrumentation.stage("load_geometry", area_level=self.area_level):
+            if path.lower().endswith(".shp"):
+                return GeometryStore.load_or_build(path, {}, simplify_tolerance)
+            return GeometryStore.load_or_build_postcode_hexagons(path, self.area_level)
+
+    def _prices(
+        self, stat: str, year: int, month: int, **selectors: Selector
+    ) -> numpy.ndarray:
+        """A statistic of every drawn area (boroughs or postcode areas) in a year, month.
+
+        :param stat: "mean", "median" or "count" (boroughs also any other statistic of the
+            data loader's cube, e.g. a sketch percentile such as "p90")
+        :param year:
+        :param month:
+        :param selectors: facet values of the transactions included (boroughs only)
+        :return: array ordered as the map view's borough_order
+        """
+        if selectors:
+            return self.data_loader.get_facet_prices(stat, year, month, **selectors)
+        if self.area_level == "borough":
+            return self.data_loader.get_prices(stat, year, month)
+        return self.data_loader.get_postcode_prices(self.area_level, stat, year, month)
+
+    def show(self, year: int, month: int, **selectors: Selector) -> None:
         """Show the plot for a specific year, month input.
 
         :param year: chosen year to display
         :param month: chosen month to display
+        :param selectors: only include transactions with these facet values (overriding
+            facet_selectors), e.g. property_type="F" for flats, is_new_build="Y" for new
+            builds or estate_type="L" for leaseholds. Needs facets=True.
         :return:
         """
-        colors = self.data_loader.get_mean_prices(year, month).values
+        selectors = dict(self.facet_selectors, **selectors)
+        colors = self._prices("mean", year, month, **selectors)
         self.map_view.initial_draw()
         self.map_view.set_colors_for_patches(colors)
         self.map_view.show()
 
-    def _get_year_month_pair_iterator(self,) -> Iterator[Tuple[int, int]]:
-        """Iterator for year month looping stopping at a fixed month in final year.
+    def viewer(
+        self, stat: str = "median", cache_size: int = 64, prefetch: int = 8
+    ) -> "Viewer":
+        """Interactive viewer of the months (call its show method to open the window).
+
+        The statistic of every month is computed once before the viewer is created.
 
-        :return: iterator
+        :param stat: "mean" or "median"
+        :param cache_size: number of drawn frames kept, see Viewer
+        :param prefetch: number of neighbouring frames drawn in the background, see Viewer
+        :return: the viewer, drawing on this controller's map view
         """
-        years = range(self._start_year, self._end_year + 1)
-        months = range(1, 13)
-        for (year, month) in itertools.product(years, months):
-            if year == self._end_year and month > self._end_month:
-                raise StopIteration()
-            yield (year, month)
+        from borough_map.viewer import Viewer
+
+        with self.instrumentation.stage("viewer_values", frames=self._frames):
+            values = numpy.stack(
+                [
+                    self._prices(stat, *self._year_month(i), **self.facet_selectors)
+                    for i in range(self._frames)
+                ]
+            )
+        return Viewer(
+            self.map_view,
+            values,
+            self.data_loader.get_line_data(**self.facet_selectors),
+            self._year_month,
+            cache_size=cache_size,
+            prefetch=prefetch,
+        )
+
+    def _year_month(self, i: int) -> Tuple[int, int]:
+        """Year, month shown in frame i (frame 0 is January of the start year).
+
+        :param i: frame number
+        :return: tuple of year, month
+        """
+        years, month_index = divmod(i, 12)
+        return self._start_year + years, month_index + 1
 
     def _update(self, i: int) -> None:
         """Called to update the map view animation.
 
         Uses the data loader and the map view to update the map view
         every frame of the iteration. This is then saved to a video file
-        using ffmpeg.
+        using ffmpeg. A frame only depends on i so frames can be rendered
+        in any order (or in separate processes).
 
         :param i: frame number
         """
-        year, month = next(self._input_iterator)
-        colors = self.data_loader.get_median_prices(year, month).values
-        self.map_view.set_colors_for_patches(colors)
-        self.map_view.draw_text_on_axis(year, month)
-        plot_x_data, plot_y_data = self.data_loader.get_line_data()
-        self.map_view.plot_line(plot_x_data[:i], plot_y_data[:i])
+        with self.instrumentation.stage("update_frame", frame=i):
+            year, month = self._year_month(i)
+            colors = self._prices("median", year, month, **self.facet_selectors)
+            self.map_view.set_colors_for_patches(colors)
+            self.map_view.draw_text_on_axis(year, month)
+            plot_x_data, plot_y_data = self.data_loader.get_line_data(
+                **self.facet_selectors
+            )
+            self.map_view.plot_line(plot_x_data[:i], plot_y_data[:i])
 
     def animate(self) -> None:
         """Wrapper to call the map_view's animate method."""
-        self.map_view.animate(self._update, self._frames)
+        with self.instrumentation.stage("animate", frames=self._frames):
+            self.map_view.animate(self._update, self._frames)
+        self._dump_instrumentation()
+
+    def render(
+        self,
+        file_name: str = "median_prices.mp4",
+        fps: int = 15,
+        lossless: bool = False,
+    ) -> float:
+        """Render the video with the map_view's blitting ffmpeg pipeline (faster than animate).
+
+        :param file_name: output video file name
+        :param fps: frames per second of the video
+        :param lossless: encode losslessly (frame identical to render_parallel)
+        :return: frames rendered per second
+        """
+        with self.instrumentation.stage("render", frames=self._frames):
+            frames_per_second = self.map_view.render_to_ffmpeg(
+                self._update,
+                self._frames,
+                file_name=file_name,
+                fps=fps,
+                lossless=lossless,
+            )
+        self._dump_instrumentation()
+        return frames_per_second
+
+    def render_parallel(
+        self,
+        file_name: str = "median_prices.mp4",
+        fps: int = 15,
+        processes: Optional[int] = None,
+    ) -> float:
+        """Render the video over a pool of processes and concatenate the segments.
+
+        The frame range is split into one contiguous segment per process. Each process
+        builds its own Controller (reading the aggregates from the cache this controller
+        wrote) and MapView, renders its segment losslessly and the segments are then
+        concatenated without re-encoding. The result is frame identical to
+        render(lossless=True).
+
+        :param file_name: output video file name
+        :param fps: frames per second of the video
+        :param processes: number of render processes (defaults to the number of cpus)
+        :return: frames rendered per second
+        """
+        processes = min(processes or os.cpu_count() or 1, self._frames)
+        segments = [
+            range(frames[0], frames[-1] + 1)
+            for frames in numpy.array_split(numpy.arange(self._frames), processes)
+        ]
+        segment_directory = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(file_name))
+        )
+        segment_files = [
+            os.path.join(segment_directory, "segment_{:04d}.mp4".format(i))
+            for i in range(len(segments))
+        ]
+        start = time.perf_counter()
+        # worker processes have their own instrumentation, only the total is recorded here
+        with self.instrumentation.stage(
+            "render_parallel", frames=self._frames, processes=processes
+        ):
+            try:
+                # spawn so workers do not inherit this process' figure or GUI backend state
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                ) as executor:
+                    list(
+                        executor.map(
+                            _render_segment,
+                            [self._arguments] * len(segments),
+                            segments,
+                            segment_files,
+                            [fps] * len(segments),
+                        )
+                    )
+                concatenate_videos(segment_files, file_name)
+            finally:
+                shutil.rmtree(segment_directory)
+        frames_per_second = self._frames / (time.perf_counter() - start)
+        LOGGER.info(
+            "render_parallel rendered %s frames over %s processes at %.1f frames/second",
+            self._frames,
+            processes,
+            frames_per_second,
+        )
+        self._dump_instrumentation()
+        return frames_per_second
+
+    def render_batch(
+        self, specs: Sequence["RenderSpec"], processes: Optional[int] = None
+    ) -> Dict[str, float]:
+        """Render several videos (statistics, facets, scales, months) from this data and geometry.
+
+        The values and line of every spec are computed here, from the aggregates loaded
+        once, and the videos are then rendered over a pool of processes that get these
+        arrays and the geometry built once (no process reads the data or shape file).
+
+        e.g. render_batch([RenderSpec("mean_prices.mp4", stat="mean"),
+        RenderSpec("flat_prices.mp4", selectors={"property_type": "F"})])
+
+        :param specs: the videos, see RenderSpec
+        :param processes: number of render processes (defaults to the number of cpus)
+        :return: frames rendered per second of each output file
+        """
+        from borough_map.batch import render_jobs
+
+        file_names = [spec.file_name for spec in specs]
+        if len(set(file_names)) != len(file_names):
+            raise ValueError("Output file names are not unique: {}".format(file_names))
+        with self.instrumentation.stage("batch_values", videos=len(specs)):
+            jobs = [self._render_job(spec) for spec in specs]
+        with self.instrumentation.stage(
+            "render_batch",
+            videos=len(specs),
+            frames=sum(len(job.values) for job in jobs),
+        ):
+            frames_per_second = render_jobs(
+                jobs,
+                self.map_view.geometry,
+                self.map_view.borough_order,
+                self.map_view.allow_missing_areas,
+                processes=processes,
+            )
+        self._dump_instrumentation()
+        return frames_per_second
+
+    def _render_job(self, spec: "RenderSpec"):
+        """Values and line of the months of a spec, see RenderJob.
+
+        :param spec: the video
+        :return: the render job
+        """
+        from borough_map.batch import RenderJob
+
+        first = self._frame(spec.start or (self._start_year, 1))
+        last = self._frame(spec.end or (self._end_year, self._end_month))
+        if first > last:
+            raise ValueError("{} starts after it ends".format(spec))
+        frames = range(first, last + 1)
+        selectors = dict(self.facet_selectors, **spec.selectors)
+        values = numpy.stack(
+            [self._prices(spec.stat, *self._year_month(i), **selectors) for i in frames]
+        )
+        line_x, line_y = self.data_loader.get_line_data(**selectors)
+        years, months = zip(*[self._year_month(i) for i in frames])
+        line_ends = numpy.searchsorted(
+            line_x, month_starts(years, months).astype(line_x.dtype)
+        )
+        return RenderJob(
+            spec, values, self._year_month(first), (line_x, line_y), line_ends
+        )
+
+    def _frame(self, year_month: Tuple[int, int]) -> int:
+        """Frame number of a year, month (the inverse of _year_month).
+
+        :param year_month: tuple of year, month
+        :return: frame number
+        """
+        year, month = year_month
+        i = (year - self._start_year) * 12 + month - 1
+        if not 0 <= i < self._frames:
+            raise ValueError(
+                "{}-{:02d} is outside the months of the data".format(year, month)
+            )
+        return i
+
+    def _dump_instrumentation(self) -> None:
+        """Write the instrumentation to trace_file_name (if set)."""
+        if self.trace_file_name:
+            self.instrumentation.dump(self.trace_file_name)
+
+
+def _render_segment(
+    controller_arguments: dict, frames: range, file_name: str, fps: int
+) -> None:
+    """Render a range of frames to a lossless video segment (run in a worker process).
+
+    :param controller_arguments: arguments to build the Controller with
+    :param frames: frame numbers of the segment
+    :param file_name: segment video file name
+    :param fps: frames per second of the video
+    """
+    controller = Controller(**dict(controller_arguments, headless=True))
+    controller.map_view.render_to_ffmpeg(
+        controller._update, frames, file_name=file_name, fps=fps, lossless=True
+    )
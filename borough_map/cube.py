@@ -0,0 +1,135 @@
+from typing import TYPE_CHECKING, Sequence, Tuple
+
+import numpy
+
+if TYPE_CHECKING:  # queries of the cube only need numpy
+    import pandas
+
+
+class AggregateCube:
+    """Dense array of borough aggregates with explicit statistic, time and borough axes.
+
+    values has shape (stat, frame, borough) and is C contiguous so the boroughs for one
+    (stat, year, month) are a contiguous slice. Frame 0 is (start_year, start_month) and
+    every following frame is the next calendar month. Cells with no transactions are NaN.
+    """
+
+    def __init__(
+        self,
+        values: numpy.ndarray,
+        stats: Sequence[str],
+        boroughs: Sequence[str],
+        start_year: int,
+        start_month: int,
+    ):
+        """Instantiate the cube.
+
+        :param values: array of shape (len(stats), frames, len(boroughs))
+        :param stats: names of the statistics along the first axis (e.g. mean, median, count)
+        :param boroughs: names of the boroughs along the last axis
+        :param start_year: year of the first frame
+        :param start_month: month of the first frame
+        """
+        self.values = numpy.ascontiguousarray(values, dtype=numpy.float64)
+        self.stats: Tuple[str, ...] = tuple(stats)
+        self.boroughs: Tuple[str, ...] = tuple(boroughs)
+        self.start_year = start_year
+        self.start_month = start_month
+        self._stat_index = {stat: i for i, stat in enumerate(self.stats)}
+        self._borough_index = {borough: i for i, borough in enumerate(self.boroughs)}
+
+    @classmethod
+    def from_borough_data(
+        cls,
+        borough_data: "pandas.DataFrame",
+        stats: Sequence[str],
+        boroughs: Sequence[str],
+    ) -> "AggregateCube":
+        """Materialise the cube from the (year, month, borough) indexed aggregate.
+
+        :param borough_data: aggregate with price_gbp_<stat> columns
+        :param stats: statistics to include
+        :param boroughs: borough axis (boroughs not in the data are all NaN)
+        :return: the cube
+        """
+        years = borough_data.index.get_level_values(0).values.astype(numpy.int64)
+        months = borough_data.index.get_level_values(1).values.astype(numpy.int64)
+        month_numbers = years * 12 + months - 1
+        first_month_number = int(month_numbers.min()) if len(month_numbers) else 0
+        frames = month_numbers - first_month_number
+        n_frames = int(frames.max()) + 1 if len(frames) else 0
+
+        borough_index = {borough: i for i, borough in enumerate(boroughs)}
+        borough_positions = borough_data.index.get_level_values(2).map(borough_index)
+        is_known_borough = ~borough_positions.isna()
+        borough_positions = borough_positions.values
+
+        values = numpy.full((len(stats), n_frames, len(boroughs)), numpy.nan)
+        for i, stat in enumerate(stats):
+            values[
+                i,
+                frames[is_known_borough],
+                borough_positions[is_known_borough].astype(numpy.int64),
+            ] = borough_data["price_gbp_" + stat].values[is_known_borough]
+        start_year, start_month = divmod(first_month_number, 12)
+        return cls(values, stats, boroughs, start_year, start_month + 1)
+
+    @property
+    def n_frames(self) -> int:
+        """Number of months along the time axis."""
+        return self.values.shape[1]
+
+    def frame_index(self, year: int, month: int) -> int:
+        """Index along the time axis of a year, month.
+
+        :param year:
+        :param month:
+        :return: frame index
+        """
+        frame = (year - self.start_year) * 12 + month - self.start_month
+        if not 0 <= frame < self.n_frames:
+            raise KeyError((year, month))
+        return frame
+
+    def year_month(self, frame: int) -> Tuple[int, int]:
+        """Year, month of an index along the time axis.
+
+        :param frame: frame index
+        :return: tuple of year, month
+        """
+        year, month = divmod(self.start_month - 1 + frame, 12)
+        return self.start_year + year, month + 1
+
+    def get(self, stat: str, year: int, month: int) -> numpy.ndarray:
+        """Values of a statistic for all boroughs in a year, month (a view, not a copy).
+
+        :param stat: statistic name
+        :param year:
+        :param month:
+        :return: array ordered as self.boroughs
+        """
+        return self.values[self._stat_index[stat], self.frame_index(year, month)]
+
+    def series(self, stat: str, borough: str) -> numpy.ndarray:
+        """Values of a statistic for one borough over all frames (a strided view).
+
+        :param stat: statistic name
+        :param borough: borough name
+        :return: array over the time axis
+        """
+        return self.values[self._stat_index[stat], :, self._borough_index[borough]]
+
+    def subset(self, boroughs: Sequence[str]) -> "AggregateCube":
+        """A cube of some of the boroughs (a copy with the borough axis in the given order).
+
+        :param boroughs: borough names
+        :return: the cube
+        """
+        positions = [self._borough_index[borough] for borough in boroughs]
+        return AggregateCube(
+            self.values[:, :, positions],
+            self.stats,
+            boroughs,
+            self.start_year,
+            self.start_month,
+        )
@@ -1,15 +1,54 @@
 import os
+import copy
+import hashlib
 import logging
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Sequence, Tuple, Union
 
 import pandas
 import numpy
 
+from borough_map.cache import CACHE_FORMAT_VERSION, CsvCacheBackend, get_cache_backend
+from borough_map.cube import AggregateCube
+from borough_map.dates import month_starts
+from borough_map.facets import FACET_DIMENSIONS, FacetStore, Selector
+from borough_map.instrumentation import Instrumentation
+from borough_map.manifest import CacheManifest
+from borough_map.parallel import (
+    SHARD_AGGREGATIONS,
+    RowPreparation,
+    aggregate_london_data_in_parallel,
+    load_london_data_in_parallel,
+    merge_sketch_aggregates,
+    price_count_aggregates,
+)
+from borough_map.paths import resolve_data_directory
+from borough_map.postcodes import POSTCODE_LEVELS, postcode_areas_of_rows
+from borough_map.row_store import ROW_STORE_VERSION, RowStore
+from borough_map.sketch import QuantileSketch
+
 logging.basicConfig()
 LOGGER = logging.getLogger(__file__)
 LOGGER.setLevel("DEBUG")
 
 
+def _source_stem(file_name: str) -> str:
+    """File name of a source without its directory and extensions (pp-complete.csv.gz
+    is pp-complete), the part of the cache names that tells sources apart.
+    """
+    stem = os.path.basename(file_name)
+    for extension in (".gz", ".bz2", ".xz", ".zip", ".csv", ".txt"):
+        if stem.lower().endswith(extension):
+            stem = stem[: -len(extension)]
+    return stem
+
+
+def _month_numbers(index: pandas.MultiIndex) -> numpy.ndarray:
+    """year * 12 + month of a year, month index."""
+    years = index.get_level_values(0).values.astype(numpy.int64)
+    months = index.get_level_values(1).values.astype(numpy.int64)
+    return years * 12 + months
+
+
 class DataLoader:
     """Responsible for loading aggregating and analysing the data set.
 
@@ -21,29 +60,198 @@ class DataLoader:
     to load the data frame. Then public methods can be called on the object to get data.
     """
 
-    def __init__(self, price_paid_file_name):
+    def __init__(
+        self,
+        price_paid_file_name,
+        chunk_size: Optional[int] = None,
+        cache_format: str = "npy",
+        verify_source_hash: bool = False,
+        keep_transaction_ledger: bool = False,
+        workers: int = 1,
+        fast_dates: bool = True,
+        compact: bool = True,
+        instrumentation: Optional[Instrumentation] = None,
+        aggregation_engine: str = "exact",
+        sketch_relative_accuracy: float = 0.01,
+        postcode_levels: Sequence[str] = (),
+        regions: Union[str, Sequence[str]] = "london",
+        facets: bool = False,
+        row_store: bool = False,
+        data_directory: Optional[str] = None,
+        temporary_directory: Optional[str] = None,
+    ):
         """Instantiate the DataLoader.
 
         All dataframes are initialised as None and then populated by calling load_prepare_and_aggregate_data.
+
+        :param price_paid_file_name: price paid data file name (in the data directory), its
+            name without extensions is part of the cache names
+        :param chunk_size: if set the raw file is streamed in chunks of this many rows and each
+            chunk is filtered to london before any further processing. Peak memory is then bounded
+            by the chunk size rather than the size of the national file.
+        :param cache_format: format of the aggregated data cache, "npy" (binary columnar,
+            memory mapped on load) or "csv". An existing csv cache is used as a fallback.
+        :param verify_source_hash: hash the full raw file to validate the cache (and store the
+            full hash when building it). By default only size, mtime and a sampled hash are checked.
+        :param keep_transaction_ledger: persist the london transactions (indexed by transaction_id)
+            when building the aggregates so monthly update files can be applied incrementally.
+        :param workers: number of processes used to parse the raw file. Above 1 the file is
+            decompressed once and split into byte ranges that are filtered and prepared in parallel.
+            Unless the rows are kept (ledger, postcodes, facets or row store) each worker also
+            aggregates its range and only the partial aggregates are merged.
+        :param fast_dates: parse the fixed width date strings by byte offset into year and month
+            only (see extra_date_columns) rather than with pandas.to_datetime.
+        :param compact: shrink the filtered london dataframe before aggregating it (small integer
+            and categorical dtypes, no redundant columns or transaction_id index), see memory_report.
+        :param instrumentation: collects the time, rows and memory of each stage (a new one by default)
+        :param aggregation_engine: "exact" (pandas groupby medians over all london rows) or
+            "sketch" (a mergeable quantile sketch per cell, see QuantileSketch). The sketch engine
+            also gives the percentiles in self.percentiles and, with chunk_size, aggregates each
+            chunk as it is read so the london rows are never all held in memory.
+        :param sketch_relative_accuracy: relative accuracy of the sketch medians and percentiles
+        :param postcode_levels: also aggregate by postcode "district" (e.g. SW11) and/or "sector"
+            (e.g. SW11 1), see get_postcode_prices. Needs the london rows (no chunk aggregation).
+        :param regions: areas (address_county_1, the local authority district) kept and
+            aggregated: "london" (the boroughs), "all" (every district of England and Wales in
+            the file, in one pass) or a list of names. Each region set has its own caches. Maps
+            of a few regions are best made with select_regions from the "all" aggregates.
+        :param facets: also keep the prices by property type, new build and tenure (estate
+            type) for breakdowns with get_facet_prices and facet_rolled_up, see FacetStore.
+            Needs the london rows (no chunk aggregation).
+        :param row_store: keep the parsed rows of the regions in a memory mapped RowStore
+            (written when the raw file is read, see open_row_store). Later builds of the
+            aggregates (e.g. with other aggregations or a lower max_price) then read the
+            store instead of parsing the raw file, unless they keep a transaction ledger.
+            Cached aggregates without a current store are rebuilt (once) to write it.
+        :param data_directory: directory of the price paid file, update files and caches
+            (defaults to ../data from the working directory, see resolve_data_directory)
+        :param temporary_directory: directory of the file decompressed for the workers
+            (defaults to that of the price paid file)
         """
+        if isinstance(regions, str) and regions not in ("london", "all"):
+            raise ValueError(
+                "Unknown regions {!r}, use london, all or a list of names".format(
+                    regions
+                )
+            )
+        if aggregation_engine not in ("exact", "sketch"):
+            raise ValueError(
+                "Unknown aggregation engine {!r}, use exact or sketch".format(
+                    aggregation_engine
+                )
+            )
+        for level in postcode_levels:
+            if level not in POSTCODE_LEVELS:
+                raise ValueError(
+                    "Unknown postcode level {!r}, use one of {}".format(
+                        level, POSTCODE_LEVELS
+                    )
+                )
         self._raw_df: Optional[pandas.DataFrame] = None
         self._borough_data: Optional[pandas.DataFrame] = None
         self._aggregated_data: Optional[pandas.DataFrame] = None
+        self._cube: Optional[AggregateCube] = None
 
         self.all_london_boroughs = self.get_all_london_boroughs()
+        # regions kept by the filter, None keeps all (the categories then come from the data)
+        self.regions: Optional[List[str]] = None
+        if regions == "london":
+            self.regions, cache_prefix = sorted(self.all_london_boroughs), "london"
+        elif regions == "all":
+            cache_prefix = "national"
+        else:
+            self.regions = sorted({str.upper(region) for region in regions})
+            cache_prefix = "regions_{}".format(
+                hashlib.sha1("\n".join(self.regions).encode()).hexdigest()[:10]
+            )
+        # caches of different source files (e.g. a yearly file) live side by side
+        cache_prefix = "{}_{}".format(cache_prefix, _source_stem(price_paid_file_name))
         self.max_price: int = 100e6
-        self._data_directory: str = os.path.join(os.getcwd(), "..", "data")
-        self._cached_data_path: str = os.path.join(
-            self._data_directory, "london_aggregated_cache.csv"
+        self.aggregations: List[str] = ["mean", "median", "count"]
+        self.verify_source_hash: bool = verify_source_hash
+        self.chunk_size: Optional[int] = chunk_size
+        self.keep_transaction_ledger: bool = keep_transaction_ledger
+        self.workers: int = workers
+        self.fast_dates: bool = fast_dates
+        self.extra_date_columns: List[str] = []  # date_time, day and/or epoch_seconds
+        self.row_store: bool = row_store
+        if row_store:
+            self.extra_date_columns.append("day")  # the store keeps the date in days
+        self.compact: bool = compact
+        self.aggregation_engine: str = aggregation_engine
+        self.sketch_relative_accuracy: float = sketch_relative_accuracy
+        self.percentiles: List[int] = [10, 25, 75, 90]  # with the sketch engine
+        self._sketch: Optional[QuantileSketch] = None
+        self.postcode_levels: List[str] = list(postcode_levels)
+        self._postcode_data: Dict[str, pandas.DataFrame] = {}
+        self._postcode_cubes: Dict[str, AggregateCube] = {}
+        self.facets: bool = facets
+        self._facet_store: Optional[FacetStore] = None
+        self._facet_cubes: Dict[Tuple, AggregateCube] = {}
+        self._facet_lines: Dict[Tuple, pandas.DataFrame] = {}
+        self._memory_before_compaction: Optional[int] = None
+        self.instrumentation = instrumentation or Instrumentation()
+        self._data_directory: str = resolve_data_directory(data_directory)
+        self.temporary_directory: Optional[str] = temporary_directory
+        self._borough_cache = get_cache_backend(
+            cache_format,
+            self._data_directory,
+            "{}_aggregated_cache".format(cache_prefix),
+            3,
+        )
+        self._yearly_cache = get_cache_backend(
+            cache_format,
+            self._data_directory,
+            "yearly_{}_aggregated_cache".format(cache_prefix),
+            2,
         )
-        self._cached_yearly_data_path: str = os.path.join(
-            self._data_directory, "yearly_london_aggregated_cache.csv"
+        self._fallback_caches = (
+            CsvCacheBackend(
+                self._data_directory, "{}_aggregated_cache".format(cache_prefix), 3
+            ),
+            CsvCacheBackend(
+                self._data_directory,
+                "yearly_{}_aggregated_cache".format(cache_prefix),
+                2,
+            ),
         )
         self._price_paid_data_path: str = os.path.join(
             self._data_directory, price_paid_file_name
         )
+        self._ledger_cache = get_cache_backend(
+            "npy", self._data_directory, "{}_transaction_ledger".format(cache_prefix), 1
+        )
+        self._facet_cache = get_cache_backend(
+            "npy", self._data_directory, "{}_facet_rows".format(cache_prefix), 1
+        )
+        # bucket counts, not an aggregate with date_time, so always npy
+        self._sketch_cache = get_cache_backend(
+            "npy", self._data_directory, "{}_price_sketch".format(cache_prefix), 4
+        )
+        self._postcode_caches = {
+            level: get_cache_backend(
+                cache_format,
+                self._data_directory,
+                "{}_postcode_{}_cache".format(cache_prefix, level),
+                3,
+            )
+            for level in self.postcode_levels
+        }
+        self._cache_manifest = CacheManifest(
+            os.path.join(
+                self._data_directory,
+                "{}_aggregated_cache.manifest.json".format(cache_prefix),
+            )
+        )
+        self._row_store_path = os.path.join(
+            self._data_directory, "{}_row_store".format(cache_prefix)
+        )
+        self._row_store_manifest = CacheManifest(
+            self._row_store_path + ".manifest.json"
+        )
 
-    def get_all_london_boroughs(self) -> List[str]:
+    @staticmethod
+    def get_all_london_boroughs() -> List[str]:
         """Returns list of all london boroughs in upper case
 
         :return list(str): list of all london boroughs in upper case
@@ -91,13 +299,11 @@ class DataLoader:
             for borough in inner_london_boroughs + outer_london_boroughs
         ]
 
-    def _load_data(self, path: str) -> pandas.DataFrame:
-        """Reads the data from CSV and loads it into a dataframe.
-
-        The private _data attribute is populated with the result.
+    def _read_csv_arguments(self, with_record_status: bool = False) -> dict:
+        """Keyword arguments for pandas.read_csv shared by the full and chunked readers.
 
-        :param path:
-        :return: the raw full data frame of price paid data UK
+        :param with_record_status: also read the record status column (A/C/D) of monthly update files
+        :return: dictionary of keyword arguments describing the price paid data layout
         """
         names = [
             "transaction_id",
@@ -114,8 +320,8 @@ class DataLoader:
             "address_district",
             "address_county_1",
             "adress_county_2",
-            "flag_4",
-            "flag_5",
+            "ppd_category_type",
+            "record_status",
         ]
         dtypes = [
             str,
@@ -136,66 +342,198 @@ class DataLoader:
             str,
         ]
         use_cols = [0, 1, 2, 3, 4, 5, 6, 12]
+        if with_record_status:
+            use_cols.append(15)
         use_names = [names[i] for i in use_cols]
         use_dtypes = {names[i]: dtypes[i] for i in use_cols}
-        raw_df = pandas.read_csv(
-            path,
+        return dict(
             delimiter=",",
             names=use_names,
             index_col=0,
             usecols=use_cols,
             dtype=use_dtypes,
             engine="c",
-            compression="gzip",
+            compression="infer",
         )
-        LOGGER.debug("completed reading raw data")
+
+    def _load_data(self, path: str) -> pandas.DataFrame:
+        """Reads the data from CSV and loads it into a dataframe.
+
+        The private _data attribute is populated with the result.
+
+        :param path:
+        :return: the raw full data frame of price paid data UK
+        """
+        with self.instrumentation.stage("load_data") as stage:
+            raw_df = pandas.read_csv(path, **self._read_csv_arguments())
+            stage["rows_out"] = len(raw_df)
+        LOGGER.debug("completed reading raw data (%s rows)", len(raw_df))
         return raw_df
 
+    def _load_london_data_in_chunks(self, path: str) -> pandas.DataFrame:
+        """Streams the CSV in chunks of self.chunk_size rows keeping only london rows.
+
+        Rows outside london or above max_price are dropped from each chunk as soon as it
+        is parsed (before any date handling) so only the london subset is ever held in memory.
+
+        :param path:
+        :return: the raw data frame of price paid data UK filtered to london boroughs
+        """
+        read_csv_arguments = self._read_csv_arguments()
+        with self.instrumentation.stage("load_london_data_in_chunks") as stage:
+            chunks = [
+                self._filter_to_london(chunk)
+                for chunk in pandas.read_csv(
+                    path, chunksize=self.chunk_size, **read_csv_arguments
+                )
+            ]
+            london_df = pandas.concat(chunks)
+            # categories differ between chunks so concat falls back to object columns
+            for column, dtype in read_csv_arguments["dtype"].items():
+                if dtype == "category" and column in london_df.columns:
+                    london_df[column] = london_df[column].astype("category")
+            stage.update(chunks=len(chunks), rows_out=len(london_df))
+        LOGGER.debug("completed streaming raw data (%s london rows)", len(london_df))
+        return london_df
+
+    def _filter_to_london(self, df: pandas.DataFrame) -> pandas.DataFrame:
+        """Filter a raw dataframe to the regions (london boroughs) and prices at or below max_price.
+
+        :param df: raw (or partially filtered) price paid dataframe
+        :return: a filtered copy of the dataframe
+        """
+        london_df = self._row_preparation().filter(df)
+        self.instrumentation.count("filter_to_london.rows_in", len(df))
+        self.instrumentation.count("filter_to_london.rows_out", len(london_df))
+        return london_df
+
     def _update_data_for_london_analysis(self) -> pandas.DataFrame:
         """Updates the _data DataFrame to only include london boroughs.
 
+        Filtering happens before the dates are parsed so the date handling only
+        runs over london rows.
+
         :return: the raw dataframe but filtered to only london boroughs
         """
-        df = self._raw_df.copy()
-        df["date_time"] = pandas.to_datetime(df["date_time"])
-        df["year"] = df["date_time"].dt.year
-        df["month"] = df["date_time"].dt.month
-        df["day"] = df["date_time"].dt.day
-        df["epoch_seconds"] = df["date_time"].astype("int64")
-        df["is_london_borough"] = df["address_county_1"].isin(self.all_london_boroughs)
-        df["address_county_1"] = df["address_county_1"].astype("category")
-        df = df.loc[
-            df["price_gbp"] <= self.max_price
-        ]  # not interested in prices over 100 MM
-        LOGGER.debug("filtered to london only")
-        return df.loc[df["is_london_borough"]]
-
-    def _aggregate_data(self) -> Tuple[pandas.DataFrame, pandas.DataFrame]:
+        with self.instrumentation.stage("update_data_for_london_analysis") as stage:
+            stage["rows_in"] = len(self._raw_df)
+            df = self._filter_to_london(self._raw_df)
+            stage["rows_out"] = len(df)
+            LOGGER.debug("filtered to the regions (%s rows)", len(df))
+            return self._add_date_columns(df)
+
+    def _add_date_columns(self, df: pandas.DataFrame) -> pandas.DataFrame:
+        """Parse date_time and add the derived date columns.
+
+        With fast_dates only year and month (plus any extra_date_columns) are derived,
+        otherwise date_time is parsed and year, month, day and epoch_seconds are all added.
+
+        :param df: london dataframe with date_time as strings
+        :return: the dataframe with the date columns
+        """
+        with self.instrumentation.stage("add_date_columns", rows_in=len(df)) as stage:
+            df, stage["fast_dates"] = self._row_preparation().add_date_columns(df)
+            return df
+
+    def _row_preparation(self) -> RowPreparation:
+        """The filter, date and partial aggregation settings of the loader (sent to workers)."""
+        return RowPreparation(
+            self._read_csv_arguments(),
+            self.regions,
+            self.max_price,
+            fast_dates=self.fast_dates,
+            extra_date_columns=self.extra_date_columns,
+            chunk_size=self.chunk_size,
+            aggregation_engine=self.aggregation_engine,
+            sketch_relative_accuracy=self.sketch_relative_accuracy,
+        )
+
+    def _compact(self, df: pandas.DataFrame) -> pandas.DataFrame:
+        """Shrink the prepared london dataframe to the smallest dtypes that hold it.
+
+        Boroughs, property attributes and post codes become categoricals (int8/int32 codes),
+        year and month int16/int8 and price int32 when max_price allows it. Unparsed date
+        strings and the transaction_id index are dropped.
+
+        :param df: prepared london dataframe
+        :return: the compact dataframe
+        """
+        self._memory_before_compaction = int(df.memory_usage(deep=True).sum())
+        columns = [
+            column
+            for column in df.columns
+            if not (column == "date_time" and df[column].dtype == object)
+        ]
+        df = df[columns].reset_index(drop=True)
+        df["address_county_1"] = pandas.Categorical(
+            df["address_county_1"],
+            categories=self._region_categories(df["address_county_1"]),
+        )
+        for column in ["post_code", "property_type", "is_new_build", "estate_type"]:
+            if column in df.columns:
+                df[column] = df[column].astype("category")
+        df["year"] = df["year"].astype(numpy.int16)
+        df["month"] = df["month"].astype(numpy.int8)
+        if self.max_price <= numpy.iinfo(numpy.int32).max:
+            df["price_gbp"] = df["price_gbp"].astype(numpy.int32)
+        LOGGER.debug("compacted london data to %s", self.memory_report()["total"])
+        return df
+
+    def memory_report(self) -> dict:
+        """Memory used by the london dataframe, per column and in total (deep, in bytes).
+
+        :return: dictionary with columns, index and total bytes, and the total before compaction
+            and the reduction factor if the dataframe was compacted
+        """
+        if self._raw_df is None:
+            raise ValueError(
+                "No london data in memory (aggregates were read from cache)."
+            )
+        usage = self._raw_df.memory_usage(deep=True)
+        report = {
+            "rows": len(self._raw_df),
+            "columns": {
+                str(column): int(usage[column]) for column in self._raw_df.columns
+            },
+            "index": int(usage["Index"]),
+            "total": int(usage.sum()),
+        }
+        if self._memory_before_compaction is not None:
+            report["total_before_compaction"] = self._memory_before_compaction
+            report["reduction"] = self._memory_before_compaction / report["total"]
+        return report
+
+    def _aggregate_data(
+        self, df: Optional[pandas.DataFrame] = None
+    ) -> Tuple[pandas.DataFrame, pandas.DataFrame]:
         """Get the borough df and aggregated df.
 
         Performs group bys to produce much smaller datasets required for the plots.
+        :param df: london dataframe to aggregate (defaults to self._raw_df)
         :return: tuple of pandas Dataframes that have been aggregated.
         """
-        borough_df = self._raw_df.groupby(
-            ["year", "month", "address_county_1"]
-        ).aggregate({"price_gbp": ["mean", "median", "count"], "date_time": "first"})
+        if df is None:
+            df = self._raw_df
+        if self.aggregation_engine == "sketch":
+            return self._finalise_sketch_aggregates(*self._sketch_aggregates(df))
+        borough_df = df.groupby(
+            ["year", "month", "address_county_1"], observed=True
+        ).aggregate({"price_gbp": self.aggregations})
         borough_df.columns = ["_".join(col) for col in borough_df.columns]
         borough_df = borough_df.dropna(subset=["price_gbp_count"])
-        borough_df["date_time_first"] = borough_df["date_time_first"].values.astype(
-            "datetime64[M]"
+        borough_df["date_time"] = month_starts(
+            borough_df.index.get_level_values("year"),
+            borough_df.index.get_level_values("month"),
         )
-        borough_df = borough_df.rename(columns={"date_time_first": "date_time"})
 
-        aggregated_data = self._raw_df.groupby(["year", "month"]).aggregate(
-            {"price_gbp": ["mean", "median", "count"], "date_time": "first"}
+        aggregated_data = df.groupby(["year", "month"]).aggregate(
+            {"price_gbp": self.aggregations}
         )
         aggregated_data.columns = ["_".join(col) for col in aggregated_data.columns]
         aggregated_data = aggregated_data.dropna(subset=["price_gbp_count"])
-        aggregated_data["date_time_first"] = aggregated_data[
-            "date_time_first"
-        ].values.astype("datetime64[M]")
-        aggregated_data = aggregated_data.rename(
-            columns={"date_time_first": "date_time"}
+        aggregated_data["date_time"] = month_starts(
+            aggregated_data.index.get_level_values("year"),
+            aggregated_data.index.get_level_values("month"),
         )
         return borough_df, aggregated_data
 
@@ -204,59 +542,924 @@ class DataLoader:
 
         Updates the dataframe attributes of the object.
         """
-        if self._cached_data_available():
-            LOGGER.info("Reading cached aggregated data.")
-            self._borough_data, self._aggregated_data = self._load_cached_data()
+        instrumentation = self.instrumentation
+        with instrumentation.stage("load_prepare_and_aggregate_data") as stage:
+            if self._cached_data_available():
+                LOGGER.info("Reading cached aggregated data.")
+                stage["cache"] = "hit"
+                instrumentation.count("cache.hit")
+                with instrumentation.stage("cache_load"):
+                    self._borough_data, self._aggregated_data = self._load_cached_data()
+                    if self.aggregation_engine == "sketch":
+                        self._sketch = self._load_cached_sketch()
+                    self._postcode_data = {
+                        level: cache.load()
+                        for level, cache in self._postcode_caches.items()
+                    }
+                    if self.facets:
+                        self._facet_store = FacetStore(self._facet_cache.load())
+            elif self._fallback_cached_data_available():
+                LOGGER.info("Reading fallback csv cached data and converting it.")
+                stage["cache"] = "fallback"
+                instrumentation.count("cache.fallback")
+                with instrumentation.stage("cache_load", cache_format="csv"):
+                    self._borough_data, self._aggregated_data = self._load_cached_data(
+                        *self._fallback_caches
+                    )
+                with instrumentation.stage("cache_save"):
+                    self._save_data_to_disk()
+            else:
+                LOGGER.info("Did not find cached aggregated data. Reading raw data.")
+                stage["cache"] = "miss"
+                instrumentation.count("cache.miss")
+                if self._aggregates_chunks():
+                    self._ledger_cache.remove()
+                    with instrumentation.stage("aggregate_in_chunks") as chunks_stage:
+                        self._borough_data, self._aggregated_data = (
+                            self._aggregate_london_data_in_chunks(
+                                self._price_paid_data_path
+                            )
+                        )
+                        chunks_stage["rows_out"] = len(self._borough_data)
+                elif self._aggregates_shards():
+                    self._ledger_cache.remove()
+                    with instrumentation.stage(
+                        "aggregate_in_parallel", workers=self.workers
+                    ) as parallel_stage:
+                        self._borough_data, self._aggregated_data = (
+                            self._aggregate_london_data_in_parallel(
+                                self._price_paid_data_path
+                            )
+                        )
+                        parallel_stage["rows_out"] = len(self._borough_data)
+                else:
+                    self._load_prepare_and_aggregate_rows()
+                with instrumentation.stage("cache_save"):
+                    self._save_data_to_disk()
+            with instrumentation.stage("build_cube"):
+                self._cube = self._build_cube()
+                self._postcode_cubes = {
+                    level: self._build_postcode_cube(level)
+                    for level in self.postcode_levels
+                }
+
+    def _load_prepare_and_aggregate_rows(self) -> None:
+        """Read and prepare all london rows of the raw file then aggregate them."""
+        instrumentation = self.instrumentation
+        from_row_store = (
+            self.row_store
+            and not self.keep_transaction_ledger
+            and self._row_store_available()
+        )
+        if from_row_store:
+            with instrumentation.stage("load_row_store") as row_store_stage:
+                self._raw_df = self.open_row_store().to_frame(max_price=self.max_price)
+                row_store_stage["rows_out"] = len(self._raw_df)
+        elif self.workers > 1:
+            with instrumentation.stage(
+                "load_london_data_in_parallel", workers=self.workers
+            ) as parallel_stage:
+                self._raw_df = load_london_data_in_parallel(
+                    self._row_preparation(),
+                    self._price_paid_data_path,
+                    self.workers,
+                    self.temporary_directory,
+                )
+                parallel_stage["rows_out"] = len(self._raw_df)
         else:
-            LOGGER.info("Did not find cached aggregated data. Reading raw data.")
-            self._raw_df = self._load_data(self._price_paid_data_path)
+            if self.chunk_size:
+                self._raw_df = self._load_london_data_in_chunks(
+                    self._price_paid_data_path
+                )
+            else:
+                self._raw_df = self._load_data(self._price_paid_data_path)
             self._raw_df = self._update_data_for_london_analysis()
-            self._borough_data, self._aggregated_data = self._aggregate_data()
-            self._save_data_to_disk()
+        if self.row_store and not from_row_store:
+            with instrumentation.stage("save_row_store", rows_in=len(self._raw_df)):
+                self._save_row_store()
+        if self.keep_transaction_ledger:
+            with instrumentation.stage("save_transaction_ledger"):
+                self._ledger_cache.save(self._to_ledger(self._raw_df))
+        else:
+            self._ledger_cache.remove()  # a ledger from a previous build is stale
+        if self.compact:
+            with instrumentation.stage("compact") as compact_stage:
+                self._raw_df = self._compact(self._raw_df)
+                compact_stage.update(
+                    bytes_in=self._memory_before_compaction,
+                    bytes_out=int(self._raw_df.memory_usage(deep=True).sum()),
+                )
+        with instrumentation.stage(
+            "aggregate_data", rows_in=len(self._raw_df)
+        ) as aggregate_stage:
+            if self.aggregation_engine == "sketch":
+                sums, self._sketch = self._sketch_aggregates(self._raw_df)
+                self._borough_data, self._aggregated_data = (
+                    self._finalise_sketch_aggregates(sums, self._sketch)
+                )
+            else:
+                self._borough_data, self._aggregated_data = self._aggregate_data()
+            aggregate_stage["rows_out"] = len(self._borough_data)
+        for level in self.postcode_levels:
+            with instrumentation.stage(
+                "aggregate_by_postcode", level=level, rows_in=len(self._raw_df)
+            ) as postcode_stage:
+                self._postcode_data[level] = self._aggregate_by_postcode(
+                    self._raw_df, level
+                )
+                postcode_stage["rows_out"] = len(self._postcode_data[level])
+        if self.facets:
+            with instrumentation.stage(
+                "build_facets", rows_in=len(self._raw_df)
+            ) as facet_stage:
+                self._facet_store = FacetStore.from_frame(self._raw_df)
+                facet_stage["cells"] = len(self._facet_store.cells)
+
+    def _aggregates_chunks(self) -> bool:
+        """Whether the raw file is aggregated chunk by chunk without keeping the london rows.
+
+        Needs the sketch engine (exact medians need all rows of a cell at once), a chunk
+        size, a single process and no transaction ledger.
+        """
+        return (
+            self.aggregation_engine == "sketch"
+            and bool(self.chunk_size)
+            and self.workers == 1
+            and not self.keep_transaction_ledger
+            and not self.postcode_levels
+            and not self.facets
+            and not self.row_store
+        )
+
+    def _aggregates_shards(self) -> bool:
+        """Whether the workers aggregate their shards of the raw file (see _aggregates_chunks).
+
+        Needs more than one worker, no kept rows (transaction ledger, postcodes, facets or
+        row store) and only aggregations that merge exactly (mean, median and count).
+        """
+        return (
+            self.workers > 1
+            and not self.keep_transaction_ledger
+            and not self.postcode_levels
+            and not self.facets
+            and not self.row_store
+            and set(self.aggregations) <= set(SHARD_AGGREGATIONS)
+        )
+
+    def _aggregate_london_data_in_parallel(
+        self, path: str
+    ) -> Tuple[pandas.DataFrame, pandas.DataFrame]:
+        """Merge the partial aggregates of the shards of the raw file, one per worker.
+
+        Exact medians come from the merged price counts of each cell; with the sketch engine
+        the sums and sketches are merged as those of chunks and self._sketch is set.
+
+        :param path: path of the price paid file
+        :return: tuple of the borough df and aggregated df
+        """
+        partials = aggregate_london_data_in_parallel(
+            self._row_preparation(),
+            path,
+            self.workers,
+            self.temporary_directory,
+        )
+        if self.aggregation_engine == "sketch":
+            merged_sums, self._sketch = partials
+            return self._finalise_sketch_aggregates(merged_sums, self._sketch)
+        aggregates = []
+        for keys in (["year", "month", "address_county_1"], ["year", "month"]):
+            df = price_count_aggregates(partials, keys, self.aggregations)
+            df["date_time"] = month_starts(
+                df.index.get_level_values("year"), df.index.get_level_values("month")
+            )
+            aggregates.append(df)
+        borough_df, aggregated_data = aggregates
+        return borough_df, aggregated_data
+
+    def _aggregate_london_data_in_chunks(
+        self, path: str
+    ) -> Tuple[pandas.DataFrame, pandas.DataFrame]:
+        """Stream the CSV in chunks and merge per chunk sums, counts and sketches.
+
+        Sets self._sketch. Only one chunk and the (small) partial aggregates are held
+        in memory, never the london rows of the whole file.
+
+        :param path:
+        :return: tuple of the borough df and aggregated df
+        """
+        partials = []
+        for chunk in pandas.read_csv(
+            path, chunksize=self.chunk_size, **self._read_csv_arguments()
+        ):
+            london_df = self._filter_to_london(chunk)
+            if len(london_df):
+                partials.append(
+                    self._sketch_aggregates(self._add_date_columns(london_df))
+                )
+        if not partials:
+            raise ValueError("No rows of the regions in {}".format(path))
+        merged_sums, self._sketch = merge_sketch_aggregates(partials)
+        LOGGER.debug("merged the aggregates of %s chunks", len(partials))
+        return self._finalise_sketch_aggregates(merged_sums, self._sketch)
+
+    def _sketch_aggregates(
+        self, df: pandas.DataFrame
+    ) -> Tuple[pandas.DataFrame, QuantileSketch]:
+        """Mergeable aggregates of london rows: price sums and counts plus quantile sketches.
+
+        :param df: london dataframe with year, month, address_county_1 and price_gbp
+        :return: tuple of the sums and counts per (year, month, borough) and the sketches
+        """
+        return self._row_preparation().sketch_aggregates(df)
+
+    def _finalise_sketch_aggregates(
+        self, sums: pandas.DataFrame, sketch: QuantileSketch
+    ) -> Tuple[pandas.DataFrame, pandas.DataFrame]:
+        """Borough and london aggregates (as _aggregate_data) from sums and sketches.
+
+        :param sums: price sums and counts per (year, month, borough)
+        :param sketch: sketches per (year, month, borough)
+        :return: tuple of the borough df and aggregated df
+        """
+        unsupported = set(self.aggregations) - {"mean", "median", "count"}
+        if unsupported:
+            raise ValueError(
+                "The sketch engine cannot aggregate {}".format(sorted(unsupported))
+            )
+        quantiles = [0.5] + [percentile / 100 for percentile in self.percentiles]
+        names = ["median"] + self._percentile_stats()
+
+        def finalise(cell_sums, cell_sketch):
+            estimates = cell_sketch.quantiles(quantiles).reindex(cell_sums.index)
+            estimates.columns = names
+            columns = dict(
+                mean=cell_sums["price_gbp_sum"] / cell_sums["price_gbp_count"],
+                count=cell_sums["price_gbp_count"],
+                **{name: estimates[name] for name in names}
+            )
+            df = pandas.DataFrame(
+                {
+                    "price_gbp_" + stat: columns[stat]
+                    for stat in list(self.aggregations) + self._percentile_stats()
+                }
+            )
+            df["date_time"] = month_starts(
+                df.index.get_level_values("year"), df.index.get_level_values("month")
+            )
+            return df
+
+        borough_df = finalise(sums, sketch)
+        aggregated_data = finalise(
+            sums.groupby(level=[0, 1]).sum(), sketch.rolled_up(["year", "month"])
+        )
+        return borough_df, aggregated_data
+
+    def _aggregate_by_postcode(
+        self, df: pandas.DataFrame, level: str
+    ) -> pandas.DataFrame:
+        """Aggregate london rows by (year, month, postcode district or sector).
+
+        :param df: london dataframe with year, month, post_code and price_gbp
+        :param level: "district" or "sector"
+        :return: aggregate indexed by year, month and postcode_<level> (as _aggregate_data)
+        """
+        area_column = "postcode_" + level
+        cells = pandas.DataFrame(
+            {
+                "year": df["year"].values,
+                "month": df["month"].values,
+                area_column: postcode_areas_of_rows(df["post_code"], level),
+                "price_gbp": df["price_gbp"].values,
+            }
+        )
+        postcode_df = cells.groupby(
+            ["year", "month", area_column], observed=True
+        ).aggregate({"price_gbp": self.aggregations})
+        postcode_df.columns = ["_".join(col) for col in postcode_df.columns]
+        postcode_df = postcode_df.dropna(subset=["price_gbp_count"])
+        postcode_df["date_time"] = month_starts(
+            postcode_df.index.get_level_values("year"),
+            postcode_df.index.get_level_values("month"),
+        )
+        return postcode_df
+
+    def _build_postcode_cube(self, level: str) -> AggregateCube:
+        """Materialise a postcode aggregate as a dense (stat, frame, area) cube.
+
+        :param level: "district" or "sector"
+        :return: cube with an area axis of the sorted area codes with any transactions
+        """
+        data = self._postcode_data[level]
+        areas = numpy.unique(numpy.asarray(data.index.get_level_values(2), dtype=str))
+        return AggregateCube.from_borough_data(data, self.aggregations, areas.tolist())
+
+    def postcode_areas(self, level: str) -> Tuple[str, ...]:
+        """Postcode areas in the order of the arrays returned by get_postcode_prices.
+
+        :param level: "district" or "sector"
+        """
+        return self._postcode_cubes[level].boroughs
+
+    def get_postcode_prices(
+        self, level: str, stat: str, year: int, month: int
+    ) -> numpy.ndarray:
+        """Get a statistic (e.g. median) for all postcode areas of a level in a year, month.
+
+        Areas without transactions in the month are NaN. The array is a view into the cube.
+
+        :param level: "district" or "sector" (one of self.postcode_levels)
+        :param stat: statistic name (one of self.aggregations)
+        :param year:
+        :param month:
+        :return: array ordered as postcode_areas(level)
+        """
+        return self._postcode_cubes[level].get(stat, year, month)
+
+    def _percentile_stats(self) -> List[str]:
+        """Names of the percentile statistics (p10, ...), empty for the exact engine."""
+        if self.aggregation_engine != "sketch":
+            return []
+        return ["p{}".format(percentile) for percentile in self.percentiles]
+
+    def _load_cached_sketch(self) -> QuantileSketch:
+        """Load the quantile sketches from the cache."""
+        return QuantileSketch.from_cached_frame(
+            self._sketch_cache.load(), self.sketch_relative_accuracy
+        )
+
+    def _region_categories(self, regions: pandas.Series) -> List[str]:
+        """Categories of the region (address_county_1) categoricals.
+
+        :param regions: region of each row
+        :return: the configured regions or, when all are kept, those in the rows (sorted)
+        """
+        return self._row_preparation().region_categories(regions)
+
+    def _build_cube(self) -> AggregateCube:
+        """Materialise the borough aggregates as a dense (stat, frame, borough) cube.
+
+        :return: cube with a borough axis of all regions (london boroughs) in alphabetical order
+        """
+        return AggregateCube.from_borough_data(
+            self._borough_data,
+            list(self.aggregations) + self._percentile_stats(),
+            self._region_categories(
+                pandas.Series(self._borough_data.index.get_level_values(2))
+            ),
+        )
+
+    def select_regions(self, regions: Sequence[str]) -> "DataLoader":
+        """A loader of a subset of the regions, derived from the loaded aggregates.
+
+        Nothing is re-read from the raw file: the cube, borough aggregates and sketches
+        are subset, and the line (all regions of the subset) is rolled up from them. Its
+        mean and count are exact and so is its median: the sketch median of the subset
+        with the sketch engine and otherwise the median of the subset's rows, taken from
+        the facet rows (facets=True) or the row store (row_store=True). The exact engine
+        needs one of them, medians are never combined from the region medians.
+
+        :param regions: names of the regions (upper case, as self.boroughs)
+        :return: a shallow copy of the loader limited to the regions (in the given order)
+        """
+        missing = [region for region in regions if region not in self.boroughs]
+        if missing:
+            raise ValueError("Regions not in the aggregates: {}".format(missing))
+        subset = copy.copy(self)
+        subset.regions = list(regions)
+        subset._raw_df = None
+        subset._cube = self._cube.subset(regions)
+        is_selected = self._borough_data.index.get_level_values(2).isin(regions)
+        subset._borough_data = self._borough_data.loc[is_selected]
+        if self._sketch is not None:
+            is_selected = self._sketch.counts.index.get_level_values(2).isin(regions)
+            subset._sketch = QuantileSketch(
+                self._sketch.counts.loc[is_selected], self.sketch_relative_accuracy
+            )
+        subset._aggregated_data = subset._roll_up_regions(
+            None if self._sketch is not None else self._region_row_medians(regions)
+        )
+        subset._facet_cubes, subset._facet_lines = {}, {}  # of fewer regions
+        return subset
+
+    def _roll_up_regions(self, medians: Optional[pandas.Series]) -> pandas.DataFrame:
+        """Line aggregate (per year, month) of the regions in the borough aggregate.
+
+        :param medians: exact medians of the regions by year, month (see
+            _region_row_medians), None to take them from the sketch
+        :return: dataframe with the columns of self._aggregated_data
+        """
+        data = self._borough_data
+        counts = data["price_gbp_count"]
+        frame = pandas.DataFrame(
+            {"count": counts, "sum": data["price_gbp_mean"] * counts}, index=data.index
+        )
+        frame = frame.loc[frame["count"] > 0]
+        totals = frame.groupby(level=[0, 1])[["count", "sum"]].sum()
+        rolled_up = pandas.DataFrame(
+            {
+                "price_gbp_mean": totals["sum"] / totals["count"],
+                "price_gbp_count": totals["count"],
+            }
+        )
+        if medians is not None:
+            # align on the month number (the year, month levels may differ in dtype)
+            rolled_up["price_gbp_median"] = (
+                pandas.Series(medians.values, index=_month_numbers(medians.index))
+                .reindex(_month_numbers(rolled_up.index))
+                .values
+            )
+        else:
+            quantiles = [0.5] + [percentile / 100 for percentile in self.percentiles]
+            estimates = (
+                self._sketch.rolled_up(["year", "month"])
+                .quantiles(quantiles)
+                .reindex(rolled_up.index)
+            )
+            estimates.columns = ["median"] + self._percentile_stats()
+            for name in estimates.columns:
+                rolled_up["price_gbp_" + name] = estimates[name]
+        rolled_up = rolled_up[
+            [
+                "price_gbp_" + stat
+                for stat in self.aggregations + self._percentile_stats()
+            ]
+        ]
+        rolled_up["date_time"] = month_starts(
+            rolled_up.index.get_level_values(0), rolled_up.index.get_level_values(1)
+        )
+        return rolled_up
+
+    def _region_row_medians(self, regions: Sequence[str]) -> pandas.Series:
+        """Exact median price per year, month of the rows of some of the regions.
+
+        :param regions: names of the regions (as self.boroughs)
+        :return: series indexed by year, month
+        """
+        if self._facet_store is not None:
+            return self._facet_store.rolled_up(
+                ["year", "month"], ["median"], address_county_1=list(regions)
+            )["price_gbp_median"]
+        if self._row_store_available():
+            return self.open_row_store().aggregate(
+                ["year", "month"],
+                ["median"],
+                max_price=self.max_price,
+                address_county_1=list(regions),
+            )["price_gbp_median"]
+        raise ValueError(
+            "The median of a subset of the regions needs their rows with the exact "
+            "engine: load the aggregates with facets=True or row_store=True, or use "
+            'aggregation_engine="sketch".'
+        )
+
+    @property
+    def boroughs(self) -> Tuple[str, ...]:
+        """Boroughs in the order of the arrays returned by the price getters."""
+        return self._cube.boroughs
+
+    def _cache_parameters(self) -> dict:
+        """Loader parameters that the cached aggregates depend on.
+
+        :return: json serialisable dictionary recorded in the cache manifest
+        """
+        parameters = {
+            "max_price": float(self.max_price),
+            "all_london_boroughs": sorted(self.all_london_boroughs),
+            "aggregations": list(self.aggregations),
+            "cache_format_version": CACHE_FORMAT_VERSION,
+        }
+        if self.regions != sorted(self.all_london_boroughs):
+            parameters["regions"] = self.regions or "all"
+        if self.postcode_levels:
+            parameters["postcode_levels"] = sorted(self.postcode_levels)
+        if self.facets:
+            parameters["facets"] = list(FACET_DIMENSIONS)
+        if self.aggregation_engine != "exact":  # caches of the exact engine stay valid
+            parameters.update(
+                aggregation_engine=self.aggregation_engine,
+                sketch_relative_accuracy=self.sketch_relative_accuracy,
+                percentiles=list(self.percentiles),
+            )
+        return parameters
+
+    def _row_store_parameters(self) -> dict:
+        """Loader parameters that the rows of the row store depend on (see _cache_parameters).
+
+        max_price is checked separately: a store of rows up to a price serves any lower one.
+        """
+        return {
+            "regions": self.regions or "all",
+            "row_store_version": ROW_STORE_VERSION,
+        }
+
+    def _row_store_available(self) -> bool:
+        """Checks if a row store of the raw file is available for the regions and max_price."""
+        return (
+            RowStore.exists(self._row_store_path)
+            and self._row_store_manifest.is_valid(
+                self._price_paid_data_path,
+                self._row_store_parameters(),
+                verify_full_hash=self.verify_source_hash,
+            )
+            and RowStore(self._row_store_path).max_price >= self.max_price
+        )
+
+    def _save_row_store(self) -> None:
+        """Write the prepared rows in self._raw_df to the row store (and its manifest)."""
+        RowStore.write(self._row_store_path, self._raw_df, self.max_price)
+        if os.path.exists(self._price_paid_data_path):
+            self._row_store_manifest.write(
+                self._price_paid_data_path,
+                self._row_store_parameters(),
+                with_full_hash=self.verify_source_hash,
+            )
+
+    def open_row_store(self) -> RowStore:
+        """Open the row store of the raw file (written by a build with row_store=True).
+
+        e.g. open_row_store().aggregate(["year", "postcode_district"], property_type="F")
+
+        :return: the store, memory mapped
+        """
+        if not self._row_store_available():
+            raise ValueError(
+                "No current row store at {}, build the aggregates with "
+                "row_store=True first.".format(self._row_store_path)
+            )
+        return RowStore(self._row_store_path)
+
+    def _cache_is_current(self) -> bool:
+        """Checks the cache manifest against the raw data file and loader parameters."""
+        return self._cache_manifest.is_valid(
+            self._price_paid_data_path,
+            self._cache_parameters(),
+            verify_full_hash=self.verify_source_hash,
+        )
 
     def _cached_data_available(self) -> bool:
-        """Checks if the cached data is available."""
-        return os.path.exists(self._cached_data_path) and os.path.exists(
-            self._cached_yearly_data_path
+        """Checks if the cached data is available and up to date."""
+        return (
+            self._borough_cache.exists()
+            and self._yearly_cache.exists()
+            and (self.aggregation_engine != "sketch" or self._sketch_cache.exists())
+            and all(cache.exists() for cache in self._postcode_caches.values())
+            and (not self.facets or self._facet_cache.exists())
+            and (not self.row_store or self._row_store_available())
+            and self._cache_is_current()
         )
 
-    def get_mean_prices(self, year: int, month: int) -> pandas.Series:
-        """Get the mean price for that year, month as a series for all address_county_1s"""
-        LOGGER.debug("getting mean price for (%s, %s)", year, month)
-        return self._borough_data.loc[(year, month)][("price_gbp_mean")]
+    def _fallback_cached_data_available(self) -> bool:
+        """Checks if up to date cached data is available in the fallback (csv) format."""
+        borough_cache, yearly_cache = self._fallback_caches
+        if (
+            borough_cache.path == self._borough_cache.path
+            or self.aggregation_engine == "sketch"  # the csv caches have no sketches
+            or self.postcode_levels
+            or self.facets
+        ):
+            return False
+        return (
+            borough_cache.exists()
+            and yearly_cache.exists()
+            and self._cache_is_current()
+        )
+
+    def _to_ledger(self, df: pandas.DataFrame) -> pandas.DataFrame:
+        """Reduce a prepared london dataframe to the columns kept in the transaction ledger.
+
+        :param df: london dataframe (output of _update_data_for_london_analysis)
+        :return: ledger dataframe indexed by transaction_id
+        """
+        ledger = df[["price_gbp", "year", "month"]].copy()
+        ledger["address_county_1"] = pandas.Categorical(
+            df["address_county_1"],
+            categories=self._region_categories(df["address_county_1"]),
+        )
+        if self.postcode_levels:
+            ledger["post_code"] = df["post_code"].astype("category")
+        if self.facets:
+            for dimension in FACET_DIMENSIONS:
+                ledger[dimension] = df[dimension].astype("category")
+        return ledger
+
+    def apply_monthly_update(self, update_file_name: str) -> None:
+        """Apply a Land Registry monthly update file to the cached aggregates.
+
+        The update file has the same layout as the complete file plus a record status
+        column: A (added), C (changed) and D (deleted), keyed by transaction_id. Old
+        versions of changed and deleted records are removed from the transaction ledger,
+        added and changed records are inserted, and only the (year, month) cells touched
+        by the update are re-aggregated from the ledger. Mean, median and count stay exact
+        and the cost is proportional to the update and the touched months rather than the
+        complete file.
+
+        Requires a ledger built with keep_transaction_ledger=True.
+
+        :param update_file_name: monthly update file name (in the data directory)
+        """
+        update_path = os.path.join(self._data_directory, update_file_name)
+        if self._cache_manifest.has_update(update_path):
+            LOGGER.info("Monthly update %s already applied.", update_file_name)
+            return
+        if not self._ledger_cache.exists():
+            raise FileNotFoundError(
+                "No transaction ledger at {}, rebuild the aggregates with "
+                "keep_transaction_ledger=True first.".format(self._ledger_cache.path)
+            )
+        with self.instrumentation.stage("apply_monthly_update") as stage:
+            if self._borough_data is None:
+                self._borough_data, self._aggregated_data = self._load_cached_data()
+            for level, cache in self._postcode_caches.items():
+                if level not in self._postcode_data:
+                    self._postcode_data[level] = cache.load()
+            ledger = self._ledger_cache.load()
+            if self.postcode_levels and "post_code" not in ledger.columns:
+                raise ValueError(
+                    "The transaction ledger has no postcodes, rebuild the aggregates "
+                    "with postcode_levels first."
+                )
+            if self.facets and not set(FACET_DIMENSIONS) <= set(ledger.columns):
+                raise ValueError(
+                    "The transaction ledger has no facets, rebuild the aggregates "
+                    "with facets=True first."
+                )
+            update_df = pandas.read_csv(
+                update_path, **self._read_csv_arguments(with_record_status=True)
+            )
+            LOGGER.debug("read %s update records", len(update_df))
+            stage["rows_in"] = len(update_df)
+
+            # changed and deleted records replace/remove their old version; an add of an
+            # existing transaction_id is treated the same way so re-runs stay idempotent
+            replaced = ledger.index.intersection(update_df.index)
+            touched = ledger.loc[replaced, ["year", "month"]]
+            ledger = ledger.drop(replaced)
+            additions = update_df.loc[update_df["record_status"].isin(["A", "C"])]
+            additions = self._add_date_columns(self._filter_to_london(additions))
+            additions = self._to_ledger(additions)
+            ledger = pandas.concat([ledger, additions])
+            if self.regions is None:  # the regions of the additions may be new
+                ledger["address_county_1"] = ledger["address_county_1"].astype(
+                    "category"
+                )
+            if self.postcode_levels:
+                ledger["post_code"] = ledger["post_code"].astype("category")
+            if self.facets:
+                for dimension in FACET_DIMENSIONS:
+                    ledger[dimension] = ledger[dimension].astype("category")
+            touched = pandas.concat([touched, additions[["year", "month"]]])
+            touched_months = pandas.MultiIndex.from_frame(touched).unique()
+            stage.update(
+                rows_replaced=len(replaced),
+                rows_added=len(additions),
+                months_touched=len(touched_months),
+            )
+            LOGGER.debug(
+                "update replaced %s, added %s and touched %s months",
+                len(replaced),
+                len(additions),
+                len(touched_months),
+            )
+
+            in_touched_months = pandas.MultiIndex.from_arrays(
+                [ledger["year"], ledger["month"]]
+            ).isin(touched_months)
+            if self.aggregation_engine == "sketch":
+                if self._sketch is None:
+                    self._sketch = self._load_cached_sketch()
+                sums, touched_sketch = self._sketch_aggregates(
+                    ledger.loc[in_touched_months]
+                )
+                borough_update, aggregated_update = self._finalise_sketch_aggregates(
+                    sums, touched_sketch
+                )
+                self._sketch = QuantileSketch.from_cached_frame(
+                    self._replace_months(
+                        self._sketch.to_frame(),
+                        touched_sketch.to_frame(),
+                        touched_months,
+                    ),
+                    self.sketch_relative_accuracy,
+                )
+                self._sketch_cache.save(self._sketch.to_frame())
+            else:
+                borough_update, aggregated_update = self._aggregate_data(
+                    ledger.loc[in_touched_months]
+                )
+            self._borough_data = self._replace_months(
+                self._borough_data, borough_update, touched_months
+            )
+            self._aggregated_data = self._replace_months(
+                self._aggregated_data, aggregated_update, touched_months
+            )
+            for level in self.postcode_levels:
+                self._postcode_data[level] = self._replace_months(
+                    self._postcode_data[level],
+                    self._aggregate_by_postcode(ledger.loc[in_touched_months], level),
+                    touched_months,
+                )
+                self._postcode_caches[level].save(self._postcode_data[level])
+            if self.facets:  # the rows of all months, a regroup of the ledger
+                self._facet_store = FacetStore.from_frame(ledger)
+                self._facet_cache.save(self._facet_store.rows)
+                self._facet_cubes, self._facet_lines = {}, {}
+            self._borough_cache.save(self._borough_data)
+            self._yearly_cache.save(self._aggregated_data)
+            self._ledger_cache.save(ledger)
+            self._cache_manifest.record_update(update_path)
+            if RowStore.exists(self._row_store_path):
+                LOGGER.info("Removing the row store, it does not have the update.")
+                RowStore.remove(self._row_store_path)
+            self._cube = self._build_cube()
+            self._postcode_cubes = {
+                level: self._build_postcode_cube(level)
+                for level in self.postcode_levels
+            }
+
+    @staticmethod
+    def _replace_months(
+        data: pandas.DataFrame, update: pandas.DataFrame, months: pandas.MultiIndex
+    ) -> pandas.DataFrame:
+        """Replace the rows of an aggregate for the given (year, month) pairs.
+
+        :param data: aggregated dataframe indexed by year, month (and optionally borough)
+        :param update: re-aggregated rows for the months
+        :param months: (year, month) pairs being replaced
+        :return: the updated aggregate sorted by its index
+        """
+        year_month = pandas.MultiIndex.from_arrays(
+            [data.index.get_level_values(0), data.index.get_level_values(1)]
+        )
+        kept = data.loc[~year_month.isin(months)]
+        return pandas.concat([kept, update.astype(kept.dtypes)]).sort_index()
+
+    def get_mean_prices(self, year: int, month: int) -> numpy.ndarray:
+        """Get the mean price for that year, month for all boroughs (ordered as self.boroughs).
 
-    def get_median_prices(self, year: int, month: int) -> pandas.Series:
-        """Get the median price for that year, month as a series for all address_county_1s"""
+        Boroughs without transactions in the month are NaN. The array is a view into the cube.
+        """
         LOGGER.debug("getting mean price for (%s, %s)", year, month)
-        return self._borough_data.loc[(year, month)][("price_gbp_median")]
+        return self._cube.get("mean", year, month)
+
+    def get_median_prices(self, year: int, month: int) -> numpy.ndarray:
+        """Get the median price for that year, month for all boroughs (ordered as self.boroughs).
+
+        Boroughs without transactions in the month are NaN. The array is a view into the cube.
+        """
+        LOGGER.debug("getting median price for (%s, %s)", year, month)
+        return self._cube.get("median", year, month)
+
+    def get_prices(self, stat: str, year: int, month: int) -> numpy.ndarray:
+        """Get any statistic of the cube (e.g. count) for that year, month for all boroughs.
+
+        :param stat: a statistic of the cube, "mean", "median", "count" (or e.g. "p90"
+            with the sketch engine)
+        :return: array ordered as self.boroughs, a view into the cube
+        """
+        if stat not in self._cube.stats:
+            raise KeyError(
+                "Unknown statistic {!r}, use one of {}".format(stat, self._cube.stats)
+            )
+        return self._cube.get(stat, year, month)
+
+    def get_percentile_prices(
+        self, percentile: int, year: int, month: int
+    ) -> numpy.ndarray:
+        """Get a percentile (one of self.percentiles) of the prices for that year, month.
+
+        Only available with the sketch engine. Ordered as self.boroughs, a view into the cube.
+        """
+        if percentile not in self.percentiles or self.aggregation_engine != "sketch":
+            raise KeyError(
+                "Percentile {} needs the sketch engine and to be in {}".format(
+                    percentile, self.percentiles
+                )
+            )
+        return self._cube.get("p{}".format(percentile), year, month)
 
     def _save_data_to_disk(self) -> None:
         """Save the borough and aggregated dataframes to disk for caching."""
-        self._borough_data.to_csv(self._cached_data_path, index=True)
-        self._aggregated_data.to_csv(self._cached_yearly_data_path, index=True)
+        self._borough_cache.save(self._borough_data)
+        self._yearly_cache.save(self._aggregated_data)
+        if self._sketch is not None:
+            self._sketch_cache.save(self._sketch.to_frame())
+        else:
+            self._sketch_cache.remove()
+        for level, cache in self._postcode_caches.items():
+            cache.save(self._postcode_data[level])
+        if self._facet_store is not None:
+            self._facet_cache.save(self._facet_store.rows)
+        if os.path.exists(self._price_paid_data_path):
+            self._cache_manifest.write(
+                self._price_paid_data_path,
+                self._cache_parameters(),
+                with_full_hash=self.verify_source_hash,
+            )
 
-    def _load_cached_data(self) -> Tuple[pandas.DataFrame, pandas.DataFrame]:
+    def _load_cached_data(
+        self, borough_cache=None, yearly_cache=None
+    ) -> Tuple[pandas.DataFrame, pandas.DataFrame]:
         """Loads cached borough and aggregated dataframe files and loads them.
 
+        :param borough_cache: cache backend to read the borough data from (defaults to configured format)
+        :param yearly_cache: cache backend to read the aggregated data from (defaults to configured format)
         :return: Tuple of the borough_df and aggregated_df
         """
-        borough_data = pandas.read_csv(self._cached_data_path, index_col=[0, 1, 2])
-        aggregated_data = pandas.read_csv(
-            self._cached_yearly_data_path, index_col=[0, 1], parse_dates=["date_time"]
-        )
+        borough_data = (borough_cache or self._borough_cache).load()
+        aggregated_data = (yearly_cache or self._yearly_cache).load()
         return borough_data, aggregated_data
 
-    def get_line_data(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    def get_line_data(
+        self, **selectors: Selector
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
         """Gets the data necessary for the median line data below the cmap plot.
 
+        :param selectors: facet values (e.g. property_type="F"), see get_facet_prices
         :return: Tuple of the x (datetime) and y (median price) data for the plot.
         """
+        aggregated_data = self._aggregated_data
+        if selectors:
+            key = self._facet_key(selectors)
+            if key not in self._facet_lines:
+                self._facet_lines[key] = self.facet_rolled_up(
+                    ["year", "month"], ["median"], **selectors
+                )
+            aggregated_data = self._facet_lines[key]
         x_data, y_data = (
-            self._aggregated_data["date_time"],
-            self._aggregated_data["price_gbp_median"],
+            aggregated_data["date_time"],
+            aggregated_data["price_gbp_median"],
         )
         return x_data.values, y_data.values
 
+    @staticmethod
+    def _facet_key(selectors: Dict[str, Selector]) -> Tuple:
+        """Hashable key of facet selectors (for the cubes and lines of selections)."""
+        return tuple(
+            sorted(
+                (dimension, values if isinstance(values, str) else tuple(values))
+                for dimension, values in selectors.items()
+            )
+        )
+
+    def _get_facet_store(self) -> FacetStore:
+        if self._facet_store is None:
+            raise ValueError(
+                "No facets loaded, create the DataLoader with facets=True."
+            )
+        return self._facet_store
+
+    def facet_rolled_up(
+        self,
+        keys: Sequence[str],
+        stats: Sequence[str] = ("mean", "median", "count"),
+        **selectors: Selector
+    ) -> pandas.DataFrame:
+        """Prices by any of year, month, borough, property_type, is_new_build and estate_type.
+
+        e.g. facet_rolled_up(["year", "property_type"], is_new_build="Y") gives the yearly
+        new build prices of each property type over the regions. Medians are exact.
+
+        :param keys: dimensions kept, see FacetStore.rolled_up
+        :param stats: statistics, any of mean, median and count
+        :param selectors: values (or lists of values) of the dimensions to keep
+        :return: dataframe indexed by keys with price_gbp_<stat> columns
+        """
+        selectors.setdefault("address_county_1", list(self.boroughs))
+        return self._get_facet_store().rolled_up(keys, stats, **selectors)
+
+    def get_facet_prices(
+        self, stat: str, year: int, month: int, **selectors: Selector
+    ) -> numpy.ndarray:
+        """Get a statistic for all boroughs in a year, month for some of the transactions.
+
+        e.g. get_facet_prices("median", 2019, 1, property_type="F", estate_type="L") for
+        leasehold flats. The cube of a selection is built on its first use (one pass over
+        the selected rows), later months are views into it.
+
+        :param stat: "mean", "median" or "count"
+        :param year:
+        :param month:
+        :param selectors: values (or lists of values) of property_type (D, S, T, F, O),
+            is_new_build (Y, N) and/or estate_type (F, L)
+        :return: array ordered as self.boroughs (NaN without transactions)
+        """
+        stats = ["mean", "median", "count"]
+        if stat not in stats:
+            raise ValueError("Unknown facet statistic {!r}, use {}".format(stat, stats))
+        key = self._facet_key(selectors)
+        if key not in self._facet_cubes:
+            self._facet_cubes[key] = AggregateCube.from_borough_data(
+                self._get_facet_store().rolled_up(
+                    ["year", "month", "address_county_1"], stats, **selectors
+                ),
+                stats,
+                self.boroughs,
+            )
+        try:
+            return self._facet_cubes[key].get(stat, year, month)
+        except KeyError:  # no selected transactions from or until that month
+            return numpy.full(len(self.boroughs), numpy.nan)
+
 
 if __name__ == "__main__":
     data_loader = DataLoader()
@@ -0,0 +1,102 @@
+from typing import Tuple
+
+import numpy
+import pandas
+
+# only the "YYYY-MM-DD" prefix of the "YYYY-MM-DD 00:00" Land Registry timestamps is read
+DATE_WIDTH = 10
+ZERO = ord("0")
+
+
+def _date_digits(date_strings) -> numpy.ndarray:
+    """View the fixed width date prefix of each string as a (rows, 10) array of bytes.
+
+    :param date_strings: sequence of "YYYY-MM-DD ..." strings
+    :return: uint8 array with one row per date
+    """
+    prefixes = numpy.asarray(date_strings, dtype=object).astype(
+        "S{}".format(DATE_WIDTH)
+    )
+    digits = prefixes.view(numpy.uint8).reshape(-1, DATE_WIDTH)
+    if len(digits) and not (
+        (digits[:, 4] == ord("-")).all() and (digits[:, 7] == ord("-")).all()
+    ):
+        raise ValueError("Dates are not in the fixed YYYY-MM-DD format")
+    return digits.astype(numpy.int16) - ZERO
+
+
+def parse_year_month_day(
+    date_strings,
+) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Parse year, month and day from fixed width "YYYY-MM-DD ..." strings.
+
+    Reads the digits at fixed byte offsets with vectorised integer arithmetic instead of
+    going through datetime objects or format inference.
+
+    :param date_strings: sequence of "YYYY-MM-DD ..." strings
+    :return: tuple of int16 year, int8 month and int8 day arrays
+    """
+    digits = _date_digits(date_strings)
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = (digits[:, 5] * 10 + digits[:, 6]).astype(numpy.int8)
+    day = (digits[:, 8] * 10 + digits[:, 9]).astype(numpy.int8)
+    return year, month, day
+
+
+def month_starts(years, months) -> numpy.ndarray:
+    """First day of each year, month as datetime64[M].
+
+    :param years: integer years
+    :param months: integer months (1 to 12)
+    :return: datetime64[M] array
+    """
+    years = numpy.asarray(years, dtype=numpy.int64)
+    months = numpy.asarray(months, dtype=numpy.int64)
+    return ((years - 1970) * 12 + months - 1).astype("datetime64[M]")
+
+
+def dates(years, months, days) -> numpy.ndarray:
+    """Dates from integer year, month, day arrays as datetime64[D].
+
+    :param years: integer years
+    :param months: integer months (1 to 12)
+    :param days: integer days of the month
+    :return: datetime64[D] array
+    """
+    days = numpy.asarray(days, dtype=numpy.int64)
+    return month_starts(years, months).astype("datetime64[D]") + (days - 1)
+
+
+def epoch_seconds(date_times) -> numpy.ndarray:
+    """Seconds since 1970-01-01 of datetimes, whatever their unit (D, us, ns...).
+
+    :param date_times: datetime64 array or series (without time zone)
+    :return: int64 array
+    """
+    return numpy.asarray(date_times).astype("datetime64[s]").astype(numpy.int64)
+
+
+def add_fast_date_columns(df: pandas.DataFrame, extra_columns=()) -> pandas.DataFrame:
+    """Replace the date_time strings of a dataframe by integer year and month columns.
+
+    The day, epoch_seconds and parsed date_time columns are only computed if requested in
+    extra_columns; otherwise the date_time strings are dropped.
+
+    :param df: dataframe with a date_time column of "YYYY-MM-DD HH:MM" strings
+    :param extra_columns: any of "date_time", "day" and "epoch_seconds"
+    :return: the dataframe with the date columns
+    """
+    year, month, day = parse_year_month_day(df["date_time"].values)
+    if "date_time" in extra_columns or "epoch_seconds" in extra_columns:
+        df["date_time"] = dates(year, month, day)
+        if "epoch_seconds" in extra_columns:
+            df["epoch_seconds"] = epoch_seconds(df["date_time"].values)
+        if "date_time" not in extra_columns:
+            df = df.drop(columns="date_time")
+    else:
+        df = df.drop(columns="date_time")
+    df["year"] = year
+    df["month"] = month
+    if "day" in extra_columns:
+        df["day"] = day
+    return df
@@ -0,0 +1,119 @@
+from typing import Dict, Sequence, Union
+
+import numpy
+import pandas
+
+from borough_map.dates import month_starts
+from borough_map.prices import price_dtype
+
+FACET_DIMENSIONS = ("property_type", "is_new_build", "estate_type")
+CELL_KEYS = ("year", "month", "address_county_1") + FACET_DIMENSIONS
+
+Selector = Union[str, Sequence[str]]
+
+
+class FacetStore:
+    """Prices of every row grouped by (year, month, borough, property type, new build, tenure).
+
+    The rows are held compactly (int16 year, int8 month, categorical keys, int32 price,
+    int64 if a price does not fit, about 11 bytes a row). Sums and counts of the cells are precomputed, so means and
+    counts of any roll-up are a sum over the cells rather than the rows. Medians of
+    rolled up cells are computed from the rows of the selected cells, never averaged
+    from the cell medians, so they are exact.
+
+    property_type: D (detached), S (semi detached), T (terraced), F (flat), O (other)
+    is_new_build: Y or N
+    estate_type: F (freehold) or L (leasehold)
+    """
+
+    def __init__(self, rows: pandas.DataFrame):
+        """Instantiate the store.
+
+        :param rows: dataframe with the CELL_KEYS and price_gbp columns
+        """
+        self.rows = rows
+        cells = rows.groupby(list(CELL_KEYS), observed=True)["price_gbp"]
+        self.cells = pandas.DataFrame(
+            {"sum": cells.sum().astype(numpy.float64), "count": cells.size()}
+        )
+
+    @classmethod
+    def from_frame(cls, df: pandas.DataFrame) -> "FacetStore":
+        """Build the store from prepared london rows (or the transaction ledger).
+
+        :param df: dataframe with the CELL_KEYS and price_gbp columns
+        :return: the store
+        """
+        return cls(
+            pandas.DataFrame(
+                {
+                    "year": df["year"].values.astype(numpy.int16),
+                    "month": df["month"].values.astype(numpy.int8),
+                    **{
+                        key: pandas.Categorical(df[key])
+                        for key in ["address_county_1"] + list(FACET_DIMENSIONS)
+                    },
+                    "price_gbp": df["price_gbp"].values.astype(
+                        price_dtype(df["price_gbp"])
+                    ),
+                }
+            )
+        )
+
+    @staticmethod
+    def _check_keys(keys: Sequence[str], selectors: Dict[str, Selector]) -> None:
+        unknown = [key for key in list(keys) + list(selectors) if key not in CELL_KEYS]
+        if unknown:
+            raise ValueError(
+                "Unknown facet dimensions {}, use {}".format(unknown, CELL_KEYS)
+            )
+
+    @staticmethod
+    def _selected(
+        df: pandas.DataFrame, selectors: Dict[str, Selector]
+    ) -> numpy.ndarray:
+        """Mask of the rows of df matching all selectors (a value or a list of values)."""
+        is_selected = numpy.ones(len(df), dtype=bool)
+        for key, values in selectors.items():
+            values = [values] if isinstance(values, str) else list(values)
+            is_selected &= df[key].isin(values).values
+        return is_selected
+
+    def rolled_up(
+        self,
+        keys: Sequence[str],
+        stats: Sequence[str] = ("mean", "median", "count"),
+        **selectors: Selector
+    ) -> pandas.DataFrame:
+        """Aggregate the rows of the selected cells along some of the dimensions.
+
+        e.g. rolled_up(["year", "month", "address_county_1"], property_type="F") gives the
+        flat prices of each borough and month, over new builds, resales and both tenures.
+
+        :param keys: dimensions kept (any of CELL_KEYS), the index levels in this order
+        :param stats: statistics, any of mean, median and count
+        :param selectors: values (or lists of values) of the dimensions to keep
+        :return: dataframe indexed by keys with price_gbp_<stat> columns (and date_time
+            when year and month are among the keys)
+        """
+        self._check_keys(keys, selectors)
+        columns = {}
+        if "mean" in stats or "count" in stats:
+            cells = self.cells.reset_index()
+            totals = (
+                cells.loc[self._selected(cells, selectors)]
+                .groupby(list(keys), observed=True)[["sum", "count"]]
+                .sum()
+            )
+            columns.update(mean=totals["sum"] / totals["count"], count=totals["count"])
+        if "median" in stats:
+            rows = self.rows.loc[self._selected(self.rows, selectors)]
+            columns["median"] = rows.groupby(list(keys), observed=True)[
+                "price_gbp"
+            ].median()
+        df = pandas.DataFrame({"price_gbp_" + stat: columns[stat] for stat in stats})
+        if "year" in keys and "month" in keys:
+            df["date_time"] = month_starts(
+                df.index.get_level_values("year"), df.index.get_level_values("month")
+            )
+        return df
@@ -0,0 +1,338 @@
+import os
+import json
+import shutil
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+GEOMETRY_FORMAT_VERSION = 1
+
+
+def simplify_ring(points: numpy.ndarray, tolerance: float) -> numpy.ndarray:
+    """Douglas-Peucker simplification of a closed ring of points.
+
+    The first and last point are always kept and rings are never reduced below four
+    points (a triangle plus the closing point).
+
+    :param points: (n, 2) array of coordinates
+    :param tolerance: maximum distance of a removed point from the simplified outline
+    :return: the simplified (n', 2) array
+    """
+    if tolerance <= 0 or len(points) <= 4:
+        return points
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    # a closed ring has first == last so split it at the point furthest from the start
+    furthest = int(numpy.argmax(((points - points[0]) ** 2).sum(axis=1)))
+    keep[furthest] = True
+    stack = [(0, furthest), (furthest, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1 : end] - points[start]
+        length = numpy.hypot(*segment)
+        if length == 0:
+            distances = numpy.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = (
+                numpy.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0])
+                / length
+            )
+        i = int(numpy.argmax(distances))
+        if distances[i] > tolerance:
+            keep[start + 1 + i] = True
+            stack.extend([(start, start + 1 + i), (start + 1 + i, end)])
+    if keep.sum() < 4:
+        return points
+    return points[keep]
+
+
+class GeometryStore:
+    """Borough outlines stored as one flat coordinate array plus offsets.
+
+    coordinates is an (n, 2) float64 array of all points of all parts (rings),
+    part_offsets[i]:part_offsets[i + 1] are the points of part i and
+    borough_part_offsets[j]:borough_part_offsets[j + 1] are the parts of borough j.
+    Boroughs are keyed by their normalised (upper case, mapped) name so they match
+    the names in the price paid data. Saved stores are loaded memory mapped.
+    """
+
+    def __init__(
+        self,
+        boroughs: Sequence[str],
+        coordinates: numpy.ndarray,
+        part_offsets: numpy.ndarray,
+        borough_part_offsets: numpy.ndarray,
+    ):
+        """Instantiate the store.
+
+        :param boroughs: normalised borough names
+        :param coordinates: (n, 2) array of all points
+        :param part_offsets: start of each part in coordinates (plus the end)
+        :param borough_part_offsets: start of each borough in the parts (plus the end)
+        """
+        self.boroughs: Tuple[str, ...] = tuple(boroughs)
+        self.coordinates = coordinates
+        self.part_offsets = part_offsets
+        self.borough_part_offsets = borough_part_offsets
+        self._borough_index = {borough: i for i, borough in enumerate(self.boroughs)}
+
+    @classmethod
+    def from_shape_file(
+        cls, shp_path: str, name_mappings: Optional[Dict[str, str]] = None
+    ) -> "GeometryStore":
+        """Convert a polygon shape file (name in the first field) into a store.
+
+        :param shp_path: path of the .shp file
+        :param name_mappings: upper case shape file names to names in the price paid data
+        :return: the store
+        """
+        import shapefile as shp  # only needed to build the store
+
+        name_mappings = name_mappings or {}
+        parts_by_borough: Dict[str, List[numpy.ndarray]] = {}
+        with shp.Reader(shp_path) as shape_reader:
+            for shape in shape_reader.shapeRecords():
+                borough = shape.record[0].upper()
+                borough = name_mappings.get(borough, borough)
+                points = numpy.asarray(shape.shape.points, dtype=numpy.float64)
+                starts = list(shape.shape.parts) + [len(points)]
+                parts_by_borough.setdefault(borough, []).extend(
+                    points[start:end] for start, end in zip(starts[:-1], starts[1:])
+                )
+        return cls.from_parts(parts_by_borough)
+
+    @classmethod
+    def from_parts(
+        cls, parts_by_borough: Dict[str, List[numpy.ndarray]]
+    ) -> "GeometryStore":
+        """Build a store from lists of (n, 2) part arrays per borough.
+
+        :param parts_by_borough: parts (rings) of each borough
+        :return: the store
+        """
+        boroughs = list(parts_by_borough)
+        parts = [part for borough in boroughs for part in parts_by_borough[borough]]
+        part_lengths = [len(part) for part in parts]
+        borough_part_counts = [len(parts_by_borough[borough]) for borough in boroughs]
+        coordinates = (
+            numpy.concatenate(parts) if parts else numpy.empty((0, 2), numpy.float64)
+        )
+        return cls(
+            boroughs,
+            coordinates,
+            numpy.concatenate([[0], numpy.cumsum(part_lengths)]).astype(numpy.int64),
+            numpy.concatenate([[0], numpy.cumsum(borough_part_counts)]).astype(
+                numpy.int64
+            ),
+        )
+
+    def parts(self, borough: str) -> List[numpy.ndarray]:
+        """The parts (rings) of a borough as views into the coordinates.
+
+        :param borough: normalised borough name
+        :return: list of (n, 2) arrays
+        """
+        j = self._borough_index[borough]
+        return [
+            self.coordinates[self.part_offsets[i] : self.part_offsets[i + 1]]
+            for i in range(
+                self.borough_part_offsets[j], self.borough_part_offsets[j + 1]
+            )
+        ]
+
+    @property
+    def bounds(self) -> Tuple[float, float, float, float]:
+        """Bounding box (x min, y min, x max, y max) of all boroughs."""
+        x_min, y_min = self.coordinates.min(axis=0)
+        x_max, y_max = self.coordinates.max(axis=0)
+        return float(x_min), float(y_min), float(x_max), float(y_max)
+
+    def bounds_of(self, boroughs: Sequence[str]) -> Tuple[float, float, float, float]:
+        """Bounding box (x min, y min, x max, y max) of some of the boroughs.
+
+        :param boroughs: normalised borough names
+        :return: the bounding box
+        """
+        points = numpy.concatenate(
+            [part for borough in boroughs for part in self.parts(borough)]
+        )
+        x_min, y_min = points.min(axis=0)
+        x_max, y_max = points.max(axis=0)
+        return float(x_min), float(y_min), float(x_max), float(y_max)
+
+    def simplified(self, tolerance: float) -> "GeometryStore":
+        """A copy of the store with every part simplified (fewer vertices to draw).
+
+        :param tolerance: maximum distance (in map units) of a removed point from the outline
+        :return: the simplified store
+        """
+        return self.from_parts(
+            {
+                borough: [
+                    simplify_ring(part, tolerance) for part in self.parts(borough)
+                ]
+                for borough in self.boroughs
+            }
+        )
+
+    def save(self, directory: str, source: Optional[Dict] = None) -> None:
+        """Save the store as .npy arrays and a meta.json in a directory.
+
+        :param directory: directory of the store (replaced if it exists)
+        :param source: description of the source (stored in meta.json)
+        """
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        numpy.save(os.path.join(directory, "coordinates.npy"), self.coordinates)
+        numpy.save(os.path.join(directory, "part_offsets.npy"), self.part_offsets)
+        numpy.save(
+            os.path.join(directory, "borough_part_offsets.npy"),
+            self.borough_part_offsets,
+        )
+        meta = {
+            "format_version": GEOMETRY_FORMAT_VERSION,
+            "boroughs": list(self.boroughs),
+            "source": source,
+        }
+        with open(os.path.join(directory, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file, indent=2)
+
+    @classmethod
+    def load(cls, directory: str) -> "GeometryStore":
+        """Load a saved store with its arrays memory mapped.
+
+        :param directory: directory of the store
+        :return: the store
+        """
+        with open(os.path.join(directory, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        arrays = [
+            numpy.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+            for name in ["coordinates", "part_offsets", "borough_part_offsets"]
+        ]
+        return cls(meta["boroughs"], *arrays)
+
+    @classmethod
+    def hexagons(
+        cls,
+        names: Sequence[str],
+        x: numpy.ndarray,
+        y: numpy.ndarray,
+        radius: Optional[float] = None,
+    ) -> "GeometryStore":
+        """A store with one regular hexagon per name centred on its point.
+
+        Used where no outlines are available, e.g. postcode sector centroids.
+
+        :param names: name of each hexagon
+        :param x: x of each centre
+        :param y: y of each centre
+        :param radius: centre to corner distance (by default about half the mean
+            spacing of the points in their bounding box)
+        :return: the store
+        """
+        x, y = numpy.asarray(x, dtype=numpy.float64), numpy.asarray(
+            y, dtype=numpy.float64
+        )
+        if radius is None:
+            area = max(numpy.ptp(x) * numpy.ptp(y), 1.0) if len(x) else 1.0
+            radius = 0.5 * numpy.sqrt(area / max(len(x), 1))
+        angles = numpy.deg2rad(numpy.arange(0, 420, 60) + 30)  # closed: 7 corners
+        corners = numpy.stack([numpy.cos(angles), numpy.sin(angles)], axis=1) * radius
+        coordinates = (numpy.stack([x, y], axis=1)[:, None, :] + corners).reshape(-1, 2)
+        offsets = numpy.arange(len(x) + 1, dtype=numpy.int64)
+        return cls(names, coordinates, offsets * len(corners), offsets)
+
+    @classmethod
+    def _load_or_build(
+        cls, source_path: str, directory: str, source: Dict, build
+    ) -> "GeometryStore":
+        """Load the store cached in directory if it was built from source, else build it.
+
+        :param source_path: file the store is built from (its size and mtime are checked)
+        :param directory: directory of the cached store
+        :param source: further description of how the store is built
+        :param build: function returning the store
+        :return: the store
+        """
+        stat = os.stat(source_path)
+        source = dict(
+            file_name=os.path.basename(source_path),
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            **source
+        )
+        meta_path = os.path.join(directory, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if (
+                meta.get("format_version") == GEOMETRY_FORMAT_VERSION
+                and meta.get("source") == source
+            ):
+                return cls.load(directory)
+        LOGGER.info("Converting %s to a geometry store.", source_path)
+        build().save(directory, source)
+        return cls.load(directory)
+
+    @classmethod
+    def load_or_build(
+        cls,
+        shp_path: str,
+        name_mappings: Optional[Dict[str, str]] = None,
+        tolerance: float = 0.0,
+    ) -> "GeometryStore":
+        """Load the cached store for a shape file, converting the shape file once if needed.
+
+        The store is cached next to the shape file (one directory per tolerance) and rebuilt
+        if the shape file's size or mtime, the name mappings or the format version change.
+
+        :param shp_path: path of the .shp file
+        :param name_mappings: upper case shape file names to names in the price paid data
+        :param tolerance: simplification tolerance (0 keeps every vertex)
+        :return: the store
+        """
+        directory = "{}.geometry".format(os.path.splitext(shp_path)[0])
+        if tolerance > 0:
+            directory += ".simplified_{:g}".format(tolerance)
+
+        def build():
+            store = cls.from_shape_file(shp_path, name_mappings)
+            return store.simplified(tolerance) if tolerance > 0 else store
+
+        return cls._load_or_build(
+            shp_path,
+            directory,
+            dict(name_mappings=name_mappings or {}, tolerance=tolerance),
+            build,
+        )
+
+    @classmethod
+    def load_or_build_postcode_hexagons(
+        cls, centroids_path: str, level: str, radius: Optional[float] = None
+    ) -> "GeometryStore":
+        """Load the cached hexagons of postcode areas, building them once from unit coordinates.
+
+        :param centroids_path: csv of postcode unit coordinates (see load_area_centroids)
+        :param level: postcode level, "district" or "sector"
+        :param radius: hexagon radius (see hexagons)
+        :return: the store
+        """
+        directory = "{}.{}_hexagons".format(os.path.splitext(centroids_path)[0], level)
+
+        def build():
+            from borough_map.postcodes import load_area_centroids  # imports pandas
+
+            return cls.hexagons(*load_area_centroids(centroids_path, level), radius)
+
+        return cls._load_or_build(
+            centroids_path, directory, dict(level=level, radius=radius), build
+        )
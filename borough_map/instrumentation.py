@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+Hook = Callable[[dict], None]
+
+
+def current_rss() -> int:
+    """Resident memory of this process in bytes (the peak so far if /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process in bytes since it started (0 if unknown)."""
+    if resource is None:
+        return 0
+    scale = 1 if sys.platform == "darwin" else 1024  # bytes on macOS, kB elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class Instrumentation:
+    """Collects stage timings, counters and memory figures of a run.
+
+    Counters are always kept. Events are opt-in: with keep_events or a registered hook
+    every stage and counter produces an event (a flat dictionary) that is passed to
+    each hook and, with keep_events, kept in self.events so the events can be dumped as
+    json or as a Chrome trace (chrome://tracing or https://ui.perfetto.dev) after the
+    run. Otherwise stages are not timed and no memory figures are taken.
+
+    Stage events: type "stage", name, start and seconds (relative to the creation of
+    the instrumentation), rss_bytes and peak_rss_bytes at the end of the stage plus
+    any attributes set by the stage (e.g. rows_in, rows_out).
+    Counter events: type "counter", name, value (added to the counter) and total.
+    """
+
+    def __init__(self, keep_events: bool = False):
+        """Instantiate the instrumentation.
+
+        :param keep_events: keep every event in self.events (needed for the dumps and
+            the stages of the summary)
+        """
+        self.keep_events = keep_events
+        self.events: List[dict] = []
+        self.counters: Dict[str, float] = {}
+        self._hooks: List[Hook] = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        """Hooks (often closures) and events are not sent to worker processes."""
+        state = self.__dict__.copy()
+        state.update(events=[], _hooks=[], _lock=None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Hook) -> Hook:
+        """Register a function called with every event.
+
+        :param hook: function taking the event dictionary
+        :return: the hook (to remove it later)
+        """
+        self._hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook: Hook) -> None:
+        """Unregister a hook added with add_hook."""
+        self._hooks.remove(hook)
+
+    @property
+    def collecting(self) -> bool:
+        """Whether events are kept or sent to hooks."""
+        return self.keep_events or bool(self._hooks)
+
+    def _emit(self, event: dict) -> None:
+        with self._lock:
+            if self.keep_events:
+                self.events.append(event)
+        for hook in self._hooks:
+            hook(event)
+
+    @contextmanager
+    def stage(self, name: str, **attributes) -> Iterator[dict]:
+        """Time the enclosed block as a stage.
+
+        The yielded dictionary holds the attributes of the stage event and can be
+        filled in by the block, e.g. stage["rows_out"] = len(df).
+
+        :param name: stage name
+        :param attributes: initial attributes of the stage event
+        """
+        if not self.collecting:
+            yield attributes
+            return
+        start = time.perf_counter()
+        try:
+            yield attributes
+        finally:
+            end = time.perf_counter()
+            self._emit(
+                dict(
+                    type="stage",
+                    name=name,
+                    start=start - self._origin,
+                    seconds=end - start,
+                    rss_bytes=current_rss(),
+                    peak_rss_bytes=peak_rss(),
+                    thread=threading.get_ident(),
+                    **attributes
+                )
+            )
+
+    def count(self, name: str, value: float = 1, **attributes) -> None:
+        """Add to a counter (e.g. rows filtered, cache hits).
+
+        :param name: counter name
+        :param value: amount added to the counter
+        :param attributes: additional attributes of the counter event
+        """
+        with self._lock:
+            total = self.counters.get(name, 0) + value
+            self.counters[name] = total
+        if not self.collecting:
+            return
+        self._emit(
+            dict(
+                type="counter",
+                name=name,
+                start=time.perf_counter() - self._origin,
+                value=value,
+                total=total,
+                **attributes
+            )
+        )
+
+    def summary(self) -> dict:
+        """Totals per stage name (with keep_events), the counters and the peak resident memory.
+
+        :return: dictionary of stages (calls, seconds, max_seconds), counters and peak_rss_bytes
+        """
+        stages = {}
+        for event in self.events:
+            if event["type"] != "stage":
+                continue
+            stage = stages.setdefault(
+                event["name"], dict(calls=0, seconds=0.0, max_seconds=0.0)
+            )
+            stage["calls"] += 1
+            stage["seconds"] += event["seconds"]
+            stage["max_seconds"] = max(stage["max_seconds"], event["seconds"])
+        return dict(
+            stages=stages, counters=dict(self.counters), peak_rss_bytes=peak_rss()
+        )
+
+    def dump_json(self, path: str) -> None:
+        """Write the summary and all events as json.
+
+        :param path: output file path
+        """
+        with open(path, "w") as output_file:
+            json.dump(
+                dict(summary=self.summary(), events=self.events), output_file, indent=2
+            )
+
+    def dump_chrome_trace(self, path: str) -> None:
+        """Write the events in the Chrome trace event format.
+
+        Stages become complete ("X") events and counters counter ("C") events.
+
+        :param path: output file path
+        """
+        pid = os.getpid()
+        trace_events = []
+        for event in self.events:
+            timestamp = event["start"] * 1e6
+            if event["type"] == "stage":
+                args = {
+                    key: value
+                    for key, value in event.items()
+                    if key not in ("type", "name", "start", "seconds", "thread")
+                }
+                trace_events.append(
+                    dict(
+                        name=event["name"],
+                        cat="stage",
+                        ph="X",
+                        ts=timestamp,
+                        dur=event["seconds"] * 1e6,
+                        pid=pid,
+                        tid=event["thread"],
+                        args=args,
+                    )
+                )
+            else:
+                trace_events.append(
+                    dict(
+                        name=event["name"],
+                        cat="counter",
+                        ph="C",
+                        ts=timestamp,
+                        pid=pid,
+                        args={event["name"]: event["total"]},
+                    )
+                )
+        with open(path, "w") as output_file:
+            json.dump(dict(traceEvents=trace_events), output_file)
+
+    def dump(self, path: str) -> None:
+        """Write a Chrome trace (paths ending in .trace.json) or the json summary and events.
+
+        :param path: output file path
+        """
+        if path.endswith(".trace.json"):
+            self.dump_chrome_trace(path)
+        else:
+            self.dump_json(path)
+        LOGGER.info("Wrote instrumentation to %s", path)
@@ -0,0 +1,196 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Dict, Optional
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+MANIFEST_VERSION = 1
+SAMPLE_BYTES = 1 << 20  # bytes hashed at the start, middle and end of the source file
+FULL_HASH_BLOCK_BYTES = 1 << 24
+
+
+def sample_hash(path: str) -> str:
+    """Fast content hash from the size and three fixed size samples of the file.
+
+    Cheap enough to run on every start (three 1 MB reads) whatever the size of the file.
+
+    :param path: path of the file to hash
+    :return: hex digest
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, "rb") as source_file:
+        for offset in (
+            0,
+            max(size // 2 - SAMPLE_BYTES // 2, 0),
+            max(size - SAMPLE_BYTES, 0),
+        ):
+            source_file.seek(offset)
+            digest.update(source_file.read(SAMPLE_BYTES))
+    return digest.hexdigest()
+
+
+def full_hash(path: str) -> str:
+    """Hash of the full content of the file (slow for the national file).
+
+    :param path: path of the file to hash
+    :return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as source_file:
+        for block in iter(lambda: source_file.read(FULL_HASH_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CacheManifest:
+    """Records what a cached aggregate was built from so stale caches can be detected.
+
+    The manifest holds the source file's size, mtime and a sampled content hash (and a
+    full hash if requested) plus the loader parameters that change the aggregate. The
+    check is ordered from cheapest to most expensive: parameters, then size, then mtime,
+    and only if the mtime moved is the sampled hash recomputed.
+    """
+
+    def __init__(self, path: str):
+        """Instantiate the manifest.
+
+        :param path: path of the manifest json file
+        """
+        self.path = path
+
+    def _read(self) -> Optional[Dict]:
+        """Read the manifest from disk (None if missing or from another version)."""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("manifest_version") != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def write(
+        self, source_path: str, parameters: Dict, with_full_hash: bool = False
+    ) -> None:
+        """Write the manifest for a freshly built cache.
+
+        :param source_path: path of the raw price paid file the cache was built from
+        :param parameters: loader parameters the cache depends on (json serialisable)
+        :param with_full_hash: also store a hash of the full source file
+        """
+        stat = os.stat(source_path)
+        manifest = {
+            "manifest_version": MANIFEST_VERSION,
+            "source": {
+                "file_name": os.path.basename(source_path),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sample_hash": sample_hash(source_path),
+                "full_hash": full_hash(source_path) if with_full_hash else None,
+            },
+            "parameters": parameters,
+            "applied_updates": [],
+        }
+        with open(self.path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+    def is_valid(
+        self, source_path: str, parameters: Dict, verify_full_hash: bool = False
+    ) -> bool:
+        """Checks if the cache described by the manifest matches the source and parameters.
+
+        If the source file is not available a cache with a manifest of the same
+        parameters is trusted (it is all there is), with a warning as it cannot be
+        checked. With verify_full_hash a manifest without a full hash is stale, the
+        cache is rebuilt to record one. Every reason a cache is not used is logged.
+
+        :param source_path: path of the raw price paid file
+        :param parameters: current loader parameters
+        :param verify_full_hash: hash the whole source file rather than trusting size and mtime
+        :return: True if the cache can be used
+        """
+        manifest = self._read()
+        if manifest is None:
+            LOGGER.info("No cache manifest found, cache treated as stale.")
+            return False
+        if manifest["parameters"] != parameters:
+            LOGGER.info("Loader parameters changed since the cache was built.")
+            return False
+        if not os.path.exists(source_path):
+            LOGGER.warning(
+                "Source file %s not found, using the cache of manifest %s without "
+                "checking it.",
+                source_path,
+                self.path,
+            )
+            return True
+
+        source = manifest["source"]
+        stat = os.stat(source_path)
+        if stat.st_size != source["size"]:
+            LOGGER.info("Source file size changed since the cache was built.")
+            return False
+        if verify_full_hash:
+            if source["full_hash"] is None:
+                LOGGER.info(
+                    "No full hash of the source file in the manifest, cache treated "
+                    "as stale."
+                )
+                return False
+            if full_hash(source_path) != source["full_hash"]:
+                LOGGER.info("Source file full hash changed since the cache was built.")
+                return False
+            if stat.st_mtime_ns != source["mtime_ns"]:
+                self._update_source(manifest, stat.st_mtime_ns)
+            return True
+        if stat.st_mtime_ns == source["mtime_ns"]:
+            return True
+        if sample_hash(source_path) != source["sample_hash"]:
+            LOGGER.info("Source file content changed since the cache was built.")
+            return False
+        self._update_source(manifest, stat.st_mtime_ns)  # touched but unchanged
+        return True
+
+    def _update_source(self, manifest: Dict, mtime_ns: int) -> None:
+        """Rewrite the manifest after the source was verified unchanged.
+
+        :param manifest: the manifest read from disk
+        :param mtime_ns: current mtime of the source file
+        """
+        manifest["source"]["mtime_ns"] = mtime_ns
+        with open(self.path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+    def has_update(self, update_path: str) -> bool:
+        """Checks if a monthly update file has already been applied to the cache.
+
+        :param update_path: path of the monthly update file
+        :return: True if an update with the same name and sampled hash was recorded
+        """
+        manifest = self._read()
+        if manifest is None:
+            return False
+        return {
+            "file_name": os.path.basename(update_path),
+            "sample_hash": sample_hash(update_path),
+        } in manifest["applied_updates"]
+
+    def record_update(self, update_path: str) -> None:
+        """Record that a monthly update file was applied to the cache.
+
+        :param update_path: path of the monthly update file
+        """
+        manifest = self._read()
+        if manifest is None:
+            return
+        manifest["applied_updates"].append(
+            {
+                "file_name": os.path.basename(update_path),
+                "sample_hash": sample_hash(update_path),
+            }
+        )
+        with open(self.path, "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
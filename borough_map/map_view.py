@@ -1,79 +1,143 @@
 import os
-from typing import Optional
+import time
+import logging
+import subprocess
+from typing import Callable, List, Optional, Sequence, Tuple, Union
 
-import shapefile as shp
 import numpy
 import pandas
 
-import matplotlib.animation
 import matplotlib.ticker
-import matplotlib.pyplot as plt
 
-from pandas.plotting import register_matplotlib_converters
-from matplotlib.patches import Polygon
+from matplotlib.figure import Figure
+from matplotlib.path import Path
+from matplotlib.patches import PathPatch
 from matplotlib.collections import PatchCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-register_matplotlib_converters()
+from borough_map.geometry import GeometryStore
+from borough_map.instrumentation import Instrumentation
+from borough_map.paths import resolve_data_directory
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
 
 
 class MapView:
     """Class to plot the view (map and line plots etc.)."""
 
-    def __init__(self, shp_file_name: str):
+    def __init__(
+        self,
+        shp_file_name: Optional[str],
+        simplify_tolerance: float = 0.0,
+        instrumentation: Optional[Instrumentation] = None,
+        geometry: Optional[GeometryStore] = None,
+        headless: bool = False,
+        data_directory: Optional[str] = None,
+    ):
         """Instantiate the MapView.
 
-        :param path:
+        :param shp_file_name: shape file for london boroughs name (in the data directory)
+        :param simplify_tolerance: simplify the borough outlines so no removed vertex is further
+            than this (in metres) from the outline. Useful for smaller, faster renders.
+        :param instrumentation: collects the time spent drawing and encoding frames
+        :param geometry: areas to draw instead of the boroughs of shp_file_name (e.g. postcode
+            districts). Areas of the data missing from it are left out of the map.
+        :param headless: draw on an Agg canvas without importing pyplot (no window, so show is
+            unavailable, and nothing registered in pyplot's global state). Enough for the
+            renders and png snapshots and much faster to import.
+        :param data_directory: directory of the shape file (defaults to ../data from the
+            working directory, see resolve_data_directory)
         """
-        self._shp_path = os.path.join(os.getcwd(), "..", "data", shp_file_name)
+        self._shp_path = (
+            os.path.join(resolve_data_directory(data_directory), shp_file_name)
+            if shp_file_name
+            else None
+        )
+        self._simplify_tolerance = simplify_tolerance
+        self.instrumentation = instrumentation or Instrumentation()
 
-        self.shape_reader = shp.Reader(self._shp_path)
         figsize = 3 * numpy.array([2, 3])
-        self.fig = plt.figure(constrained_layout=True, figsize=figsize)
+        self.headless = headless
+        if headless:
+            self.fig = Figure(constrained_layout=True, figsize=figsize)
+            FigureCanvasAgg(self.fig)
+        else:
+            import matplotlib.pyplot as plt
+            from pandas.plotting import register_matplotlib_converters
+
+            register_matplotlib_converters()
+            self.fig = plt.figure(constrained_layout=True, figsize=figsize)
         gs = self.fig.add_gridspec(3, 2)
         self.map_ax = self.fig.add_subplot(gs[0:2, :])
         self.plot_ax = self.fig.add_subplot(gs[2, :])
 
         self.borough_to_plot_dict = {}
         self.boroughs = []
+        self.borough_order: Optional[Sequence[str]] = None
+        self.allow_missing_areas = geometry is not None
+        self._data_positions: Optional[numpy.ndarray] = None
         self.patches = []
         self.patch_collection = None
         self.text_on_axis = None
         self.disclaimer = None
+        # scales of the drawing, set before initial_draw
+        self.color_limits: Tuple[float, float] = (0, 1e6)
+        self.cmap = "plasma"
+        self.line_limit = 7.5e5
+        self.date_limits: Tuple[str, str] = ("1995-01-01", "2020-01-01")
         self._borough_name_mappings = {
             "WESTMINSTER": "CITY OF WESTMINSTER"
         }  # align between names in house price data and in shape file
+        if geometry is not None:
+            self.geometry = geometry
+        else:
+            with self.instrumentation.stage("load_geometry"):
+                self.geometry = GeometryStore.load_or_build(
+                    self._shp_path, self._borough_name_mappings, simplify_tolerance
+                )
 
     def initial_draw(self) -> None:
         """Initial configuration and drawing of plots (called once at beginning of animation)."""
-        self._loop_over_shape_file_and_create_polygons()
+        self._create_patches_from_geometry()
         self.sort_patches_and_boroughs()
         self._add_patches_to_collection_and_axis()
         self._configure_axis()
         self._create_initial_color_bar()
 
-    def _loop_over_shape_file_and_create_polygons(self) -> None:
-        """Loops over the records in the shape files (boroughs) and appends them to lists for drawing."""
-        for shape in self.shape_reader.shapeRecords():
-            borough = shape.record[0].upper()
-            if borough in self._borough_name_mappings:
-                borough = self._borough_name_mappings[borough]
-            xy = numpy.array(shape.shape.points)
-            polygon = Polygon(xy, False)
-            self.patches.append(polygon)
-            self.borough_to_plot_dict[borough] = polygon
+    def _create_patches_from_geometry(self) -> None:
+        """Creates one patch per borough from the geometry store and appends them to lists for drawing.
+
+        Each part (ring) of a borough is a closed sub path of the patch so multi-part
+        boroughs and holes are kept.
+        """
+        self.patches, self.boroughs, self.borough_to_plot_dict = [], [], {}
+        for borough in self.geometry.boroughs:
+            parts = self.geometry.parts(borough)
+            codes = numpy.concatenate(
+                [
+                    [Path.MOVETO] + [Path.LINETO] * (len(part) - 2) + [Path.CLOSEPOLY]
+                    for part in parts
+                ]
+            )
+            patch = PathPatch(Path(numpy.concatenate(parts), codes))
+            self.patches.append(patch)
+            self.borough_to_plot_dict[borough] = patch
             self.boroughs.append(borough)
 
     def _configure_axis(self) -> None:
-        """Configure the plot axes."""
-        self.map_ax.set_xlim(left=5.025e5, right=5.625e5)
-        self.map_ax.set_ylim(bottom=1.55e5, top=2.025e5)
+        """Configure the plot axes (the map extent is the bounding box of the drawn areas)."""
+        x_min, y_min, x_max, y_max = self.geometry.bounds_of(self.boroughs)
+        margin = 0.02 * max(x_max - x_min, y_max - y_min)
+        self.map_ax.set_xlim(left=x_min - margin, right=x_max + margin)
+        self.map_ax.set_ylim(bottom=y_min - margin, top=y_max + margin)
         self.map_ax.set_aspect("equal")
         self.map_ax.get_xaxis().set_visible(False)
         self.map_ax.get_yaxis().set_visible(False)
-        self.plot_ax.set_ylim(bottom=0, top=7.5e5)
+        self.plot_ax.set_ylim(bottom=0, top=self.line_limit)
         self.plot_ax.set_xlim(
-            left=pandas.to_datetime("1995-01-01"),
-            right=pandas.to_datetime("2020-01-01"),
+            left=pandas.to_datetime(self.date_limits[0]),
+            right=pandas.to_datetime(self.date_limits[1]),
         )
         self.line, = self.plot_ax.plot([], [], "-")
         self.plot_ax.yaxis.set_major_formatter(
@@ -82,48 +146,80 @@ class MapView:
 
     def _add_patches_to_collection_and_axis(self) -> None:
         """Add the patches (borough boundaries) to a PatchCollection and attach to the axes plot."""
-        self.patch_collection = PatchCollection(self.patches, cmap="plasma")
+        self.patch_collection = PatchCollection(self.patches, cmap=self.cmap)
         self.map_ax.add_collection(self.patch_collection)
 
     def sort_patches_and_boroughs(self) -> None:
-        """Make sure patches (boroughs) are sorted alphebetically so they match DataLoader's order."""
-        zipped = zip(self.boroughs, self.patches)
-        self.patches = [
-            patch for borough, patch in sorted(zipped, key=lambda pair: pair[0])
+        """Order patches (boroughs) to match the borough axis of the data.
+
+        Uses self.borough_order (e.g. DataLoader.boroughs) if set, otherwise sorts alphabetically.
+        With allow_missing_areas, areas of the data without geometry are skipped and
+        set_colors_for_patches picks the values of the drawn areas.
+        """
+        order = self.borough_order
+        if order is None:
+            order = sorted(self.boroughs)
+        missing = [
+            borough for borough in order if borough not in self.borough_to_plot_dict
         ]
-        self.boroughs = sorted(self.boroughs)
+        self._data_positions = None
+        if missing and self.allow_missing_areas:
+            LOGGER.warning(
+                "%s areas without geometry not drawn: %s", len(missing), missing[:10]
+            )
+            self._data_positions = numpy.flatnonzero(
+                [borough in self.borough_to_plot_dict for borough in order]
+            )
+            order = [order[position] for position in self._data_positions]
+        elif missing:
+            raise ValueError("Boroughs not found in shape file: {}".format(missing))
+        unused = set(self.boroughs) - set(order)
+        if unused:
+            LOGGER.warning(
+                "%s areas without data not drawn: %s",
+                len(unused),
+                sorted(unused)[:10],
+            )
+        self.patches = [self.borough_to_plot_dict[borough] for borough in order]
+        self.boroughs = list(order)
 
     def _create_initial_color_bar(self) -> None:
-        """Create a colour bar for the cmap plot"""
-        array = numpy.array((len(self.patches) - 1) * [0] + [1e6])
+        """Create a colour bar for the cmap plot (from color_limits, ten ticks apart)"""
+        low, high = self.color_limits
+        array = numpy.array((len(self.patches) - 1) * [low] + [high])
         self.patch_collection.set_array(array)
         colorbar = self.fig.colorbar(self.patch_collection, ax=self.map_ax)
-        self.patch_collection.set_clim(0, 1e6)
-        colorbar.vmin = 0
-        colorbar.vmax = 1e6
-        colorbar.set_ticks(numpy.arange(0, 1.1e6, 1e5))
+        self.patch_collection.set_clim(low, high)
+        colorbar.vmin = low
+        colorbar.vmax = high
+        colorbar.set_ticks(numpy.linspace(low, high, 11))
+        if high >= 1e4:  # prices, in thousands
+            formatter = lambda x, p: "{}k".format(int(x // 1000))
+        else:  # e.g. counts
+            formatter = lambda x, p: "{:g}".format(x)
         colorbar.ax.yaxis.set_major_formatter(
-            matplotlib.ticker.FuncFormatter(lambda x, p: "{}k".format(int(x // 1000)))
+            matplotlib.ticker.FuncFormatter(formatter)
         )
 
     def draw_text_on_axis(self, year: int, month: int) -> None:
         """Write the year month as text on the axes and disclaimer text.
 
+        The text artists are created on the first call and only the date text is updated after.
+
         :param year:
         :param month:
         :return:
         """
-        if self.text_on_axis is not None:
-            self.text_on_axis.remove()
-        self.text_on_axis = self.map_ax.text(
-            0.0,
-            1.0,
-            "{}-{}".format(year, month),
-            transform=self.map_ax.transAxes,
-            fontsize=24,
-        )
-        if self.disclaimer is not None:
-            self.disclaimer.remove()
+        if self.text_on_axis is None:
+            self.text_on_axis = self.map_ax.text(
+                0.0, 1.0, "", transform=self.map_ax.transAxes, fontsize=24
+            )
+        self.text_on_axis.set_text("{}-{}".format(year, month))
+        if self.disclaimer is None:
+            self._draw_disclaimer()
+
+    def _draw_disclaimer(self) -> None:
+        """Write the copyright disclaimer below the line plot."""
         self.disclaimer = self.plot_ax.text(
             0.1,
             -0.5,
@@ -136,13 +232,20 @@ class MapView:
         )
 
     def show(self) -> None:
+        if self.headless:
+            raise RuntimeError("A headless map view cannot be shown, save it instead.")
+        import matplotlib.pyplot as plt
+
         plt.show()
 
     def set_colors_for_patches(self, colors_array: numpy.ndarray) -> None:
         """Set the values to each patch (gets mapped to color in cmap plot).
 
-        :param numpy.array colors_array: same length as self.patches
+        :param numpy.array colors_array: same length as self.patches (or as borough_order
+            when areas without geometry were skipped)
         """
+        if self._data_positions is not None:
+            colors_array = colors_array[self._data_positions]
         self.patch_collection.set_array(colors_array)
 
     def animate(self, update_function, frames) -> None:
@@ -151,6 +254,8 @@ class MapView:
         :param update_function: function to be called to update map view (using updated data)
         :param frames:  number of frames
         """
+        import matplotlib.animation
+
         Writer = matplotlib.animation.writers["ffmpeg"]
         writer = Writer(fps=15, metadata=dict(artist="Tim"))
 
@@ -162,14 +267,163 @@ class MapView:
             frames=frames,
             repeat=False,
         )
-        self.animation.save("mean_prices.mp4", writer=writer)
+        start = time.perf_counter()
+        self.animation.save("median_prices.mp4", writer=writer)
+        LOGGER.info(
+            "animate rendered %s frames at %.1f frames/second",
+            frames,
+            frames / (time.perf_counter() - start),
+        )
+
+    def render_to_ffmpeg(
+        self,
+        update_function: Callable[[int], None],
+        frames: Union[int, range],
+        file_name: str = "median_prices.mp4",
+        fps: int = 15,
+        ffmpeg_path: str = "ffmpeg",
+        lossless: bool = False,
+    ) -> float:
+        """Render frames with blitting and pipe the raw RGBA canvas buffers to ffmpeg.
+
+        Static elements (axes, colour bar, disclaimer) are drawn once and cached as the
+        background. Each frame restores the background, calls update_function and redraws
+        only the patch colours, the date text and the line before the buffer is written to
+        the stdin of an ffmpeg subprocess.
+
+        :param update_function: function to be called to update map view (using updated data)
+        :param frames: number of frames, or the range of frame numbers to render
+        :param file_name: output video file name
+        :param fps: frames per second of the video
+        :param ffmpeg_path: ffmpeg executable
+        :param lossless: encode losslessly (x264 -qp 0) so separately rendered segments
+            concatenate to exactly the frames of a single render
+        :return: frames rendered per second
+        """
+        if isinstance(frames, int):
+            frames = range(frames)
+        canvas = FigureCanvasAgg(self.fig)
+        background = self.draw_background()
+        width, height = canvas.get_width_height()
+        process = subprocess.Popen(
+            [
+                ffmpeg_path,
+                "-y",
+                "-loglevel",
+                "error",
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "rgba",
+                "-s",
+                "{}x{}".format(width, height),
+                "-r",
+                str(fps),
+                "-i",
+                "-",
+                "-an",
+                "-vf",
+                "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+                "-vcodec",
+                "libx264",
+                "-pix_fmt",
+                "yuv420p",
+            ]
+            + (["-qp", "0"] if lossless else [])
+            + ["-metadata", "artist=Tim", file_name],
+            stdin=subprocess.PIPE,
+        )
+        start = time.perf_counter()
+        try:
+            for i in frames:
+                canvas.restore_region(background)
+                update_function(i)
+                with self.instrumentation.stage("draw_frame", frame=i):
+                    self.draw_animated()
+                with self.instrumentation.stage("encode_frame", frame=i):
+                    process.stdin.write(canvas.buffer_rgba())
+        finally:
+            process.stdin.close()
+            return_code = process.wait()
+        if return_code != 0:
+            raise RuntimeError("ffmpeg exited with code {}".format(return_code))
+        frames_per_second = len(frames) / (time.perf_counter() - start)
+        LOGGER.info(
+            "render_to_ffmpeg rendered %s frames at %.1f frames/second",
+            len(frames),
+            frames_per_second,
+        )
+        return frames_per_second
+
+    def draw_background(self):
+        """Draw the figure without the artists that change every frame (for blitting).
+
+        Calls initial_draw and marks the patch colours, the date text and the line as
+        animated, so the full draw of the canvas only holds the static elements (axes,
+        colour bar, disclaimer).
+
+        :return: the background, a region of the canvas to restore before each frame
+        """
+        self.initial_draw()
+        self.draw_text_on_axis(0, 0)
+        self.text_on_axis.set_text("")
+        for artist in self.animated_artists:
+            artist.set_animated(True)
+        self.fig.canvas.draw()
+        return self.fig.canvas.copy_from_bbox(self.fig.bbox)
+
+    @property
+    def animated_artists(self) -> list:
+        """Artists updated every frame: the patch colours, the date text and the line."""
+        return [self.patch_collection, self.text_on_axis, self.line]
+
+    def draw_animated(self) -> None:
+        """Draw the animated artists over the restored background."""
+        for artist in self.animated_artists:
+            self.fig.draw_artist(artist)
 
     def plot_line(self, plot_x_data: numpy.ndarray, plot_y_data: numpy.ndarray):
         """Update the line plot."""
         self.line.set_data(plot_x_data, plot_y_data)
 
 
+def concatenate_videos(
+    file_names: List[str], output_file_name: str, ffmpeg_path: str = "ffmpeg"
+) -> None:
+    """Concatenate video files with the same encoding without re-encoding them.
+
+    :param file_names: video files in order
+    :param output_file_name: concatenated video file name
+    :param ffmpeg_path: ffmpeg executable
+    """
+    list_file_name = output_file_name + ".segments.txt"
+    with open(list_file_name, "w") as list_file:
+        for file_name in file_names:
+            list_file.write("file '{}'\n".format(os.path.abspath(file_name)))
+    try:
+        subprocess.run(
+            [
+                ffmpeg_path,
+                "-y",
+                "-loglevel",
+                "error",
+                "-f",
+                "concat",
+                "-safe",
+                "0",
+                "-i",
+                list_file_name,
+                "-c",
+                "copy",
+                output_file_name,
+            ],
+            check=True,
+        )
+    finally:
+        os.remove(list_file_name)
+
+
 if __name__ == "__main__":
     map_view = MapView()
     map_view.initial_draw()
-    plt.show()
+    map_view.show()
@@ -0,0 +1,434 @@
+import io
+import os
+import gzip
+import shutil
+import logging
+import tempfile
+import concurrent.futures
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+import numpy
+import pandas
+
+from borough_map.dates import add_fast_date_columns, epoch_seconds
+from borough_map.sketch import QuantileSketch
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+DEFAULT_SHARD_CHUNK_SIZE = 1000000
+BOROUGH_KEYS = ["year", "month", "address_county_1"]
+# statistics that can be merged from the partial aggregates of the shards
+SHARD_AGGREGATIONS = ("mean", "median", "count")
+
+# price counts per (year, month, borough, price) or sums, counts and sketches per cell
+PartialAggregates = Union[pandas.Series, Tuple[pandas.DataFrame, QuantileSketch]]
+
+
+class RowPreparation:
+    """How raw price paid rows are filtered, dated and partially aggregated.
+
+    Holds only the settings of a DataLoader these steps need, so it is what the worker
+    processes are sent (rather than the loader and whatever data it holds).
+    """
+
+    def __init__(
+        self,
+        read_csv_arguments: dict,
+        regions: Optional[Sequence[str]],
+        max_price: float,
+        fast_dates: bool = True,
+        extra_date_columns: Sequence[str] = (),
+        chunk_size: Optional[int] = None,
+        aggregation_engine: str = "exact",
+        sketch_relative_accuracy: float = 0.01,
+    ):
+        """Instantiate the preparation.
+
+        :param read_csv_arguments: pandas.read_csv keyword arguments of the file layout
+        :param regions: address_county_1 values kept, None keeps all
+        :param max_price: highest price kept
+        :param fast_dates: parse the dates by byte offset (see add_fast_date_columns)
+        :param extra_date_columns: date columns added besides year and month
+        :param chunk_size: rows read at once by the workers
+        :param aggregation_engine: "exact" (price counts) or "sketch" (sums and sketches)
+        :param sketch_relative_accuracy: relative accuracy of the sketches
+        """
+        self.read_csv_arguments = read_csv_arguments
+        self.regions = regions
+        self.max_price = max_price
+        self.fast_dates = fast_dates
+        self.extra_date_columns = list(extra_date_columns)
+        self.chunk_size = chunk_size
+        self.aggregation_engine = aggregation_engine
+        self.sketch_relative_accuracy = sketch_relative_accuracy
+
+    def filter(self, df: pandas.DataFrame) -> pandas.DataFrame:
+        """Rows of the regions with prices at or below max_price.
+
+        :param df: raw (or partially filtered) price paid dataframe
+        :return: a filtered copy of the dataframe
+        """
+        is_below_max_price = df["price_gbp"] <= self.max_price
+        if self.regions is None:
+            return df.loc[is_below_max_price].copy()
+        is_in_regions = df["address_county_1"].isin(self.regions)
+        return df.loc[is_in_regions & is_below_max_price].copy()
+
+    def add_date_columns(self, df: pandas.DataFrame) -> Tuple[pandas.DataFrame, bool]:
+        """Parse date_time and add the derived date columns.
+
+        :param df: filtered dataframe with date_time as strings
+        :return: tuple of the dataframe and whether the fast date parser was used
+        """
+        parsed = False
+        if self.fast_dates:
+            try:
+                df = add_fast_date_columns(df, self.extra_date_columns)
+                parsed = True
+            except ValueError:
+                LOGGER.warning("Unexpected date format, falling back to to_datetime.")
+        if not parsed:
+            df["date_time"] = pandas.to_datetime(df["date_time"])
+            df["year"] = df["date_time"].dt.year
+            df["month"] = df["date_time"].dt.month
+            df["day"] = df["date_time"].dt.day
+            df["epoch_seconds"] = epoch_seconds(df["date_time"])
+        df["address_county_1"] = df["address_county_1"].astype("category")
+        return df, parsed
+
+    def prepare(self, df: pandas.DataFrame) -> pandas.DataFrame:
+        """Filter a raw dataframe and add its date columns."""
+        return self.add_date_columns(self.filter(df))[0]
+
+    def region_categories(self, regions: pandas.Series) -> List[str]:
+        """Categories of the region (address_county_1) categoricals.
+
+        :param regions: region of each row
+        :return: the configured regions or, when all are kept, those in the rows (sorted)
+        """
+        if self.regions is not None:
+            return list(self.regions)
+        return sorted(str(region) for region in pandas.unique(regions.dropna()))
+
+    def _cells(self, df: pandas.DataFrame) -> pandas.DataFrame:
+        """Keys and int64 prices of prepared rows, the borough as a region categorical."""
+        return pandas.DataFrame(
+            {
+                "year": numpy.asarray(df["year"].values, dtype=numpy.int16),
+                "month": numpy.asarray(df["month"].values, dtype=numpy.int8),
+                "address_county_1": pandas.Categorical(
+                    df["address_county_1"],
+                    categories=self.region_categories(df["address_county_1"]),
+                ),
+                "price_gbp": df["price_gbp"].values.astype(numpy.int64),
+            }
+        )
+
+    def sketch_aggregates(
+        self, df: pandas.DataFrame
+    ) -> Tuple[pandas.DataFrame, QuantileSketch]:
+        """Mergeable aggregates of prepared rows: price sums and counts plus quantile sketches.
+
+        :param df: prepared dataframe with year, month, address_county_1 and price_gbp
+        :return: tuple of the sums and counts per (year, month, borough) and the sketches
+        """
+        cells = self._cells(df)
+        sums = cells.groupby(BOROUGH_KEYS, observed=True)["price_gbp"].agg(
+            ["sum", "count"]
+        )
+        sums.columns = ["price_gbp_sum", "price_gbp_count"]
+        sketch = QuantileSketch.from_frame(
+            cells, BOROUGH_KEYS, "price_gbp", self.sketch_relative_accuracy
+        )
+        return sums, sketch
+
+    def price_counts(self, df: pandas.DataFrame) -> pandas.Series:
+        """Number of rows of each price per (year, month, borough), the exact partial aggregate.
+
+        :param df: prepared dataframe with year, month, address_county_1 and price_gbp
+        :return: counts indexed by year, month, address_county_1 and price_gbp (sorted)
+        """
+        counts = self._cells(df).groupby(BOROUGH_KEYS + ["price_gbp"], observed=True)
+        return counts.size().rename("count")
+
+    def partial_aggregates(self, df: pandas.DataFrame) -> PartialAggregates:
+        """Price counts (exact engine) or sums and sketches (sketch engine) of prepared rows."""
+        if self.aggregation_engine == "sketch":
+            return self.sketch_aggregates(df)
+        return self.price_counts(df)
+
+
+def merge_price_counts(counts: Sequence[pandas.Series]) -> pandas.Series:
+    """Sum price counts of several shards (or chunks) cell by cell.
+
+    :param counts: price counts, see RowPreparation.price_counts
+    :return: the merged counts, sorted by cell then price
+    """
+    merged = pandas.concat(counts)
+    return merged.groupby(level=list(merged.index.names), observed=True).sum()
+
+
+def price_count_aggregates(
+    counts: pandas.Series, keys: Sequence[str], aggregations: Sequence[str]
+) -> pandas.DataFrame:
+    """Exact mean, median and count of the prices of each cell from its price counts.
+
+    The median of an even number of prices is the mean of the middle two, as in pandas.
+
+    :param counts: price counts indexed by the keys (and maybe more levels) and price_gbp
+    :param keys: levels of the cells aggregated to
+    :param aggregations: any of "mean", "median" and "count"
+    :return: dataframe of price_gbp_<aggregation> columns indexed by the keys
+    """
+    counts = counts.groupby(level=list(keys) + ["price_gbp"], observed=True).sum()
+    prices = counts.index.get_level_values("price_gbp").values.astype(numpy.int64)
+    price_counts = counts.values.astype(numpy.int64)
+    cells = counts.groupby(level=list(keys), observed=True).size()
+    starts = numpy.concatenate([[0], numpy.cumsum(cells.values)[:-1]])
+    cumulative = numpy.cumsum(price_counts)
+    rows_before = cumulative[starts] - price_counts[starts]
+    totals = numpy.add.reduceat(price_counts, starts)
+
+    def price_at_rank(rank: numpy.ndarray) -> numpy.ndarray:
+        return prices[numpy.searchsorted(cumulative, rows_before + rank, side="right")]
+
+    columns = dict(
+        mean=numpy.add.reduceat(prices * price_counts, starts) / totals,
+        median=(price_at_rank((totals - 1) // 2) + price_at_rank(totals // 2)) / 2,
+        count=totals,
+    )
+    return pandas.DataFrame(
+        {"price_gbp_" + stat: columns[stat] for stat in aggregations},
+        index=cells.index,
+    )
+
+
+def split_into_byte_ranges(path: str, shards: int) -> List[Tuple[int, int]]:
+    """Split a plain text file into byte ranges that start and end on line boundaries.
+
+    :param path: path of the uncompressed CSV file
+    :param shards: number of ranges wanted (fewer are returned for tiny files)
+    :return: list of (start, end) byte offsets covering the whole file in order
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as csv_file:
+        for i in range(1, shards):
+            csv_file.seek(max(size * i // shards, boundaries[-1]))
+            csv_file.readline()  # move to the start of the next line
+            boundaries.append(min(csv_file.tell(), size))
+    boundaries.append(size)
+    return [
+        (start, end)
+        for start, end in zip(boundaries[:-1], boundaries[1:])
+        if end > start
+    ]
+
+
+def decompress(path: str, directory: str) -> str:
+    """Decompress a gzip file once into a temporary file so it can be split by byte range.
+
+    The temporary file is removed if decompressing fails.
+
+    :param path: path of the gzip file
+    :param directory: directory for the temporary file
+    :return: path of the decompressed file (to be removed by the caller)
+    """
+    handle, decompressed_path = tempfile.mkstemp(suffix=".csv", dir=directory)
+    try:
+        with gzip.open(path, "rb") as compressed, os.fdopen(
+            handle, "wb"
+        ) as decompressed:
+            shutil.copyfileobj(compressed, decompressed, length=1 << 24)
+    except BaseException:
+        os.remove(decompressed_path)
+        raise
+    return decompressed_path
+
+
+def _read_shard(
+    preparation: RowPreparation, path: str, byte_range: Tuple[int, int]
+) -> List[pandas.DataFrame]:
+    """Prepared, non empty chunks of the rows of one byte range."""
+    start, end = byte_range
+    with open(path, "rb") as csv_file:
+        csv_file.seek(start)
+        shard = io.BytesIO(csv_file.read(end - start))
+    read_csv_arguments = dict(preparation.read_csv_arguments, compression=None)
+    chunks = []
+    for chunk in pandas.read_csv(
+        shard,
+        chunksize=preparation.chunk_size or DEFAULT_SHARD_CHUNK_SIZE,
+        **read_csv_arguments
+    ):
+        chunk = preparation.filter(chunk)
+        if len(chunk):
+            chunks.append(preparation.add_date_columns(chunk)[0])
+    return chunks
+
+
+def prepare_shard(
+    preparation: RowPreparation, path: str, byte_range: Tuple[int, int]
+) -> Optional[pandas.DataFrame]:
+    """Read, filter and prepare the rows of one byte range (run in a worker).
+
+    :param preparation: the CSV layout, filter and date handling
+    :param path: path of the uncompressed CSV file
+    :param byte_range: (start, end) byte offsets of the shard
+    :return: the prepared rows of the shard, None if it has none
+    """
+    chunks = _read_shard(preparation, path, byte_range)
+    if not chunks:
+        return None
+    return pandas.concat(chunks)
+
+
+def aggregate_shard(
+    preparation: RowPreparation, path: str, byte_range: Tuple[int, int]
+) -> Optional[PartialAggregates]:
+    """Read, filter and partially aggregate the rows of one byte range (run in a worker).
+
+    Each chunk is aggregated as it is read, so a worker holds one chunk of rows and the
+    (small) partial aggregates.
+
+    :param preparation: the CSV layout, filter, date handling and aggregation engine
+    :param path: path of the uncompressed CSV file
+    :param byte_range: (start, end) byte offsets of the shard
+    :return: the partial aggregates of the shard, None if it has no rows
+    """
+    partials = [
+        preparation.partial_aggregates(chunk)
+        for chunk in _read_shard(preparation, path, byte_range)
+    ]
+    if not partials:
+        return None
+    if preparation.aggregation_engine == "sketch":
+        return merge_sketch_aggregates(partials)
+    return merge_price_counts(partials)
+
+
+def merge_sketch_aggregates(
+    partials: Sequence[Tuple[pandas.DataFrame, QuantileSketch]],
+) -> Tuple[pandas.DataFrame, QuantileSketch]:
+    """Sum the price sums and counts and merge the sketches of several shards (or chunks).
+
+    :param partials: tuples of sums and sketches, see RowPreparation.sketch_aggregates
+    :return: tuple of the merged sums and sketch
+    """
+    sums, sketches = zip(*partials)
+    merged_sums = pandas.concat(sums).groupby(level=[0, 1, 2], observed=True).sum()
+    return merged_sums, sketches[0].merge(*sketches[1:])
+
+
+def _map_shards(
+    function: Callable,
+    preparation: RowPreparation,
+    path: str,
+    workers: int,
+    temporary_directory: Optional[str],
+) -> list:
+    """Apply a shard function to the line aligned byte ranges of a file over a process pool.
+
+    A gzip file is first decompressed to a temporary file, removed whatever happens.
+
+    :param function: prepare_shard or aggregate_shard
+    :param preparation: sent to each worker with its byte range
+    :param path: path of the price paid file (gzip or plain CSV)
+    :param workers: number of worker processes
+    :param temporary_directory: directory of the decompressed file (defaults to that of path)
+    :return: the results of the shards in file order, without those of no rows
+    """
+    decompressed_path = None
+    try:
+        if path.endswith(".gz"):
+            decompressed_path = decompress(
+                path, temporary_directory or os.path.dirname(path)
+            )
+            LOGGER.debug("decompressed %s", path)
+        csv_path = decompressed_path or path
+        byte_ranges = split_into_byte_ranges(csv_path, workers)
+        if not byte_ranges:
+            raise ValueError("{} is empty".format(path))
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(workers, len(byte_ranges))
+        ) as executor:
+            results = list(
+                executor.map(
+                    function,
+                    [preparation] * len(byte_ranges),
+                    [csv_path] * len(byte_ranges),
+                    byte_ranges,
+                )
+            )
+    finally:
+        if decompressed_path is not None:
+            os.remove(decompressed_path)
+    results = [result for result in results if result is not None]
+    if not results:
+        raise ValueError("No rows of the regions in {}".format(path))
+    LOGGER.debug("read %s over %s shards", path, len(byte_ranges))
+    return results
+
+
+def load_london_data_in_parallel(
+    preparation: RowPreparation,
+    path: str,
+    workers: int,
+    temporary_directory: Optional[str] = None,
+) -> pandas.DataFrame:
+    """Prepare the london rows of a price paid file over a pool of worker processes.
+
+    The text is split into one line aligned byte range per worker and each worker filters
+    its range to london and parses the dates. Shards are concatenated in file order so the
+    result is identical to the serial path. Used when the rows themselves are kept (ledger,
+    row store, facets, postcodes), otherwise see aggregate_london_data_in_parallel.
+
+    :param preparation: the CSV layout, london filter and date handling
+    :param path: path of the price paid file (gzip or plain CSV)
+    :param workers: number of worker processes
+    :param temporary_directory: directory of the decompressed gzip file (defaults to that of path)
+    :return: the prepared london dataframe
+    """
+    shards = _map_shards(prepare_shard, preparation, path, workers, temporary_directory)
+    london_df = pandas.concat(shards)
+    # categories differ between shards so concat falls back to object columns
+    for column, dtype in shards[0].dtypes.items():
+        if isinstance(dtype, pandas.CategoricalDtype):
+            london_df[column] = london_df[column].astype("category")
+    return london_df
+
+
+def aggregate_london_data_in_parallel(
+    preparation: RowPreparation,
+    path: str,
+    workers: int,
+    temporary_directory: Optional[str] = None,
+) -> PartialAggregates:
+    """Partial aggregates of the london rows of a price paid file over a pool of workers.
+
+    Each worker filters, prepares and aggregates its byte range; only the partial
+    aggregates (price counts per cell, or sums and sketches) are sent back and merged.
+
+    :param preparation: the CSV layout, london filter, date handling and aggregation engine
+    :param path: path of the price paid file (gzip or plain CSV)
+    :param workers: number of worker processes
+    :param temporary_directory: directory of the decompressed gzip file (defaults to that of path)
+    :return: merged price counts (exact engine) or tuple of sums and sketch (sketch engine)
+    """
+    partials = _map_shards(
+        aggregate_shard, preparation, path, workers, temporary_directory
+    )
+    if preparation.aggregation_engine == "sketch":
+        return merge_sketch_aggregates(partials)
+    counts = merge_price_counts(partials)
+    # with all regions kept each shard has the categories of its own rows
+    county = counts.index.levels[2]
+    return counts.set_axis(
+        counts.index.set_levels(
+            pandas.CategoricalIndex(
+                county, categories=preparation.region_categories(county.to_series())
+            ),
+            level=2,
+        )
+    )
@@ -0,0 +1,16 @@
+import os
+from typing import Optional
+
+
+def resolve_data_directory(data_directory: Optional[str] = None) -> str:
+    """Directory of the source files and caches.
+
+    The default, the data directory next to the working directory (the repo is run from
+    a sibling of data, e.g. borough_map), is resolved when this is called, not on import.
+
+    :param data_directory: directory to use, None for the default
+    :return: the directory
+    """
+    if data_directory is not None:
+        return data_directory
+    return os.path.join(os.getcwd(), "..", "data")
@@ -0,0 +1,120 @@
+from typing import Sequence, Tuple
+
+import numpy
+import pandas
+
+POSTCODE_LEVELS = ("district", "sector")
+# outward code (area letters, district number and optional letter) and inward code
+POSTCODE_PATTERN = r"^([A-Z]{1,2}[0-9][0-9A-Z]?) ?([0-9])[A-Z]{2}$"
+
+
+def postcode_area_codes(post_codes: Sequence[str], level: str) -> numpy.ndarray:
+    """Postcode district ("SW11") or sector ("SW11 1") of each full postcode ("SW11 1AB").
+
+    :param post_codes: full postcodes (missing or malformed ones give "")
+    :param level: "district" or "sector"
+    :return: object array of area codes
+    """
+    if level not in POSTCODE_LEVELS:
+        raise ValueError(
+            "Unknown postcode level {!r}, use one of {}".format(level, POSTCODE_LEVELS)
+        )
+    parts = (
+        pandas.Series(numpy.asarray(post_codes, dtype=object))
+        .fillna("")
+        .str.upper()
+        .str.strip()
+        .str.extract(POSTCODE_PATTERN)
+    )
+    codes = parts[0] if level == "district" else parts[0] + " " + parts[1]
+    return codes.fillna("").to_numpy(dtype=object)
+
+
+class AreaIndex:
+    """Sorted unique area codes with vectorised lookup of code positions.
+
+    The positions are the order of the area axis of the aggregates, so a frame of
+    values for all areas is a contiguous array and looking up the areas of many rows
+    is a binary search over the (few thousand) codes rather than a hash per row.
+    """
+
+    def __init__(self, codes: Sequence[str]):
+        """Instantiate the index.
+
+        :param codes: area codes (duplicates and empty codes are dropped)
+        """
+        codes = numpy.unique(numpy.asarray(codes, dtype=str))
+        self.codes: numpy.ndarray = codes[codes != ""]
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def positions(self, codes: Sequence[str]) -> numpy.ndarray:
+        """Position of each code in the index.
+
+        :param codes: area codes
+        :return: int32 positions, -1 for codes not in the index
+        """
+        codes = numpy.asarray(codes, dtype=str)
+        positions = numpy.searchsorted(self.codes, codes)
+        positions = numpy.minimum(positions, max(len(self.codes) - 1, 0))
+        found = (
+            self.codes[positions] == codes
+            if len(self.codes)
+            else numpy.zeros(len(codes), bool)
+        )
+        return numpy.where(found, positions, -1).astype(numpy.int32)
+
+
+def postcode_areas_of_rows(post_codes: pandas.Series, level: str) -> pandas.Categorical:
+    """Area of each row as a categorical whose categories are the sorted area codes.
+
+    The postcode parsing only runs over the distinct postcodes (the categories).
+
+    :param post_codes: full postcode of each row
+    :param level: "district" or "sector"
+    :return: categorical area codes (NaN for missing or malformed postcodes)
+    """
+    post_codes = post_codes.astype("category")
+    category_areas = postcode_area_codes(post_codes.cat.categories, level)
+    index = AreaIndex(category_areas)
+    category_positions = numpy.append(index.positions(category_areas), -1)
+    # code -1 (a missing postcode) picks the appended -1
+    row_positions = category_positions[post_codes.cat.codes.values]
+    return pandas.Categorical.from_codes(row_positions, categories=index.codes)
+
+
+def load_area_centroids(
+    path: str,
+    level: str,
+    postcode_column: str = "pcds",
+    x_column: str = "oseast1m",
+    y_column: str = "osnrth1m",
+) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """Centroid of each postcode district or sector from a postcode unit coordinate file.
+
+    The defaults are the column names of the ONS Postcode Directory (British National
+    Grid eastings and northings, as the borough shape file). Units without coordinates
+    are ignored.
+
+    :param path: csv file with one row per postcode unit
+    :param level: "district" or "sector"
+    :param postcode_column: column of the full postcodes
+    :param x_column: column of the eastings
+    :param y_column: column of the northings
+    :return: tuple of the sorted area codes and their mean x and y
+    """
+    units = pandas.read_csv(
+        path,
+        usecols=[postcode_column, x_column, y_column],
+        dtype={postcode_column: str, x_column: float, y_column: float},
+    ).dropna()
+    units["area"] = postcode_area_codes(units[postcode_column].values, level)
+    centroids = (
+        units.loc[units["area"] != ""].groupby("area")[[x_column, y_column]].mean()
+    )
+    return (
+        centroids.index.values.astype(str),
+        centroids[x_column].values,
+        centroids[y_column].values,
+    )
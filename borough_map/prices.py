@@ -0,0 +1,18 @@
+import logging
+
+import numpy
+import pandas
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+
+def price_dtype(prices: pandas.Series) -> numpy.dtype:
+    """int32 if every price fits in it (always the case below a max_price of 2**31 - 1),
+    otherwise int64 so no price wraps around.
+    """
+    limits = numpy.iinfo(numpy.int32)
+    if len(prices) == 0 or limits.min <= prices.min() and prices.max() <= limits.max:
+        return numpy.dtype(numpy.int32)
+    LOGGER.info("Prices above the int32 range, kept as int64")
+    return numpy.dtype(numpy.int64)
@@ -0,0 +1,296 @@
+import os
+import json
+import shutil
+import logging
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy
+import pandas
+
+from borough_map.dates import dates, month_starts
+from borough_map.facets import Selector
+from borough_map.postcodes import POSTCODE_LEVELS, postcode_areas_of_rows
+from borough_map.prices import price_dtype
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+ROW_STORE_VERSION = 1
+CATEGORICAL_COLUMNS = (
+    "address_county_1",
+    "property_type",
+    "is_new_build",
+    "estate_type",
+    "post_code",
+)
+DATE_KEYS = ("year", "month", "day")
+DICTIONARY_FILE_NAME = "dictionary.json"
+
+
+def _code_dtype(column: str, categories: int) -> numpy.dtype:
+    """Smallest signed integer holding the codes (-1 is missing) of a categorical column.
+
+    Postcodes are always int32, the other dictionaries int8 unless they have more than
+    127 entries (the districts of the national file need int16).
+    """
+    if column == "post_code":
+        return numpy.dtype(numpy.int32)
+    for dtype in (numpy.int8, numpy.int16, numpy.int32):
+        if categories <= numpy.iinfo(dtype).max:
+            return numpy.dtype(dtype)
+    raise ValueError("Too many categories in {}".format(column))
+
+
+class RowStore:
+    """Parsed price paid rows kept as fixed width binary column files, opened memory mapped.
+
+    The directory holds one raw little endian file per column (price_gbp int32, int64
+    if a price does not fit, days int32 since 1970-01-01, the codes of address_county_1,
+    property_type, is_new_build and estate_type, int8 unless a dictionary is bigger, and
+    post_code int32 codes) and a dictionary.json sidecar with the row count, dtypes and the categories of each
+    coded column. Opening the store maps the files (nothing is read until used), so a
+    new aggregation of the rows costs the groupby alone, not the parsing of the raw
+    file, and processes opening the same store share its pages through the page cache.
+
+    The rows are those kept by the DataLoader that wrote the store (its regions and
+    prices at or below its max_price).
+    """
+
+    def __init__(self, path: str):
+        """Open a store written by write.
+
+        :param path: directory of the store
+        """
+        self.path = path
+        with open(os.path.join(path, DICTIONARY_FILE_NAME)) as dictionary_file:
+            self.dictionary = json.load(dictionary_file)
+        if self.dictionary.get("version") != ROW_STORE_VERSION:
+            raise ValueError(
+                "Row store {} has version {} (expected {})".format(
+                    path, self.dictionary.get("version"), ROW_STORE_VERSION
+                )
+            )
+        self.max_price: float = self.dictionary["max_price"]
+        self._columns: Dict[str, numpy.ndarray] = {}
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        """Checks if a complete store of the current version is at path."""
+        dictionary_path = os.path.join(path, DICTIONARY_FILE_NAME)
+        if not os.path.exists(dictionary_path):
+            return False
+        with open(dictionary_path) as dictionary_file:
+            return json.load(dictionary_file).get("version") == ROW_STORE_VERSION
+
+    @staticmethod
+    def remove(path: str) -> None:
+        """Remove the store at path if it exists."""
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    @classmethod
+    def write(cls, path: str, df: pandas.DataFrame, max_price: float) -> "RowStore":
+        """Write the rows of a prepared dataframe as a store (replacing any store at path).
+
+        :param path: directory of the store
+        :param df: prepared rows with price_gbp, year, month, day and the
+            CATEGORICAL_COLUMNS (post_code is optional)
+        :param max_price: max_price of the loader the rows were filtered with
+        :return: the opened store
+        """
+        cls.remove(path)
+        os.makedirs(path)
+        columns = {
+            "price_gbp": df["price_gbp"].values.astype(price_dtype(df["price_gbp"])),
+            "days": dates(df["year"].values, df["month"].values, df["day"].values)
+            .astype(numpy.int64)
+            .astype(numpy.int32),
+        }
+        categories = {}
+        for column in CATEGORICAL_COLUMNS:
+            if column not in df.columns:
+                continue
+            categorical = pandas.Categorical(df[column])
+            categories[column] = [str(value) for value in categorical.categories]
+            columns[column] = categorical.codes.astype(
+                _code_dtype(column, len(categorical.categories))
+            )
+        for column, values in columns.items():
+            values.astype(values.dtype.newbyteorder("<")).tofile(
+                os.path.join(path, column + ".bin")
+            )
+        dictionary = {
+            "version": ROW_STORE_VERSION,
+            "rows": len(df),
+            "max_price": float(max_price),
+            "dtypes": {column: values.dtype.name for column, values in columns.items()},
+            "categories": categories,
+        }
+        # the dictionary is written last so a partially written store is never opened
+        with open(os.path.join(path, DICTIONARY_FILE_NAME), "w") as dictionary_file:
+            json.dump(dictionary, dictionary_file)
+        LOGGER.debug("wrote a row store of %s rows to %s", len(df), path)
+        return cls(path)
+
+    def __len__(self) -> int:
+        return self.dictionary["rows"]
+
+    @property
+    def columns(self) -> List[str]:
+        """Names of the stored columns."""
+        return list(self.dictionary["dtypes"])
+
+    def column(self, name: str) -> numpy.ndarray:
+        """The memory mapped values (or codes) of a column.
+
+        :param name: price_gbp, days or one of the CATEGORICAL_COLUMNS
+        :return: read only array
+        """
+        if name not in self._columns:
+            if name not in self.dictionary["dtypes"]:
+                raise KeyError(
+                    "No column {!r} in the row store, use one of {}".format(
+                        name, self.columns
+                    )
+                )
+            dtype = numpy.dtype(self.dictionary["dtypes"][name]).newbyteorder("<")
+            if len(self):
+                self._columns[name] = numpy.memmap(
+                    os.path.join(self.path, name + ".bin"), dtype=dtype, mode="r"
+                )
+            else:  # an empty file cannot be mapped
+                self._columns[name] = numpy.empty(0, dtype=dtype)
+        return self._columns[name]
+
+    def categories(self, name: str) -> List[str]:
+        """Categories of a coded column (the value of code i is categories[i])."""
+        return self.dictionary["categories"][name]
+
+    @property
+    def keys(self) -> List[str]:
+        """Names of the columns to_frame and aggregate can give: the stored columns,
+        year, month and day and, with postcodes, postcode_district and postcode_sector.
+        """
+        keys = self.columns + list(DATE_KEYS)
+        if "post_code" in keys:
+            keys.extend("postcode_" + level for level in POSTCODE_LEVELS)
+        return keys
+
+    def _date_parts(self, is_selected: numpy.ndarray) -> Dict[str, numpy.ndarray]:
+        """Year (int16), month and day (int8) of the selected rows."""
+        days = self.column("days")[is_selected].astype("datetime64[D]")
+        months = days.astype("datetime64[M]")
+        month_numbers = months.astype(numpy.int64)
+        return {
+            "year": (month_numbers // 12 + 1970).astype(numpy.int16),
+            "month": (month_numbers % 12 + 1).astype(numpy.int8),
+            "day": ((days - months).astype(numpy.int64) + 1).astype(numpy.int8),
+        }
+
+    def _values(
+        self, column: str, is_selected: numpy.ndarray
+    ) -> Union[numpy.ndarray, pandas.Categorical]:
+        """Values of a stored or postcode area column for the selected rows."""
+        if column.startswith("postcode_"):
+            post_codes = pandas.Series(self._values("post_code", is_selected))
+            return postcode_areas_of_rows(post_codes, column[len("postcode_") :])
+        if column in CATEGORICAL_COLUMNS:
+            return pandas.Categorical.from_codes(
+                self.column(column)[is_selected], self.categories(column)
+            )
+        return numpy.asarray(self.column(column)[is_selected])
+
+    def selected(
+        self, max_price: Optional[float] = None, **selectors: Selector
+    ) -> numpy.ndarray:
+        """Mask of the rows at or below max_price matching all selectors.
+
+        :param max_price: highest price kept (None keeps all rows)
+        :param selectors: values (or lists of values) of the CATEGORICAL_COLUMNS to keep,
+            e.g. property_type="F" or address_county_1=["CAMDEN", "ISLINGTON"]
+        :return: boolean mask of the rows
+        """
+        is_selected = numpy.ones(len(self), dtype=bool)
+        if max_price is not None and max_price < self.max_price:
+            is_selected &= self.column("price_gbp") <= max_price
+        for key, values in selectors.items():
+            if key not in CATEGORICAL_COLUMNS:
+                raise ValueError(
+                    "Cannot select on {!r}, use one of {}".format(
+                        key, CATEGORICAL_COLUMNS
+                    )
+                )
+            values = [values] if isinstance(values, str) else list(values)
+            positions = {value: code for code, value in enumerate(self.categories(key))}
+            codes = [positions[value] for value in values if value in positions]
+            is_selected &= numpy.isin(self.column(key), codes)
+        return is_selected
+
+    def to_frame(
+        self,
+        columns: Sequence[str] = ("price_gbp", "year", "month", "day")
+        + CATEGORICAL_COLUMNS,
+        max_price: Optional[float] = None,
+        **selectors: Selector
+    ) -> pandas.DataFrame:
+        """The selected rows as a dataframe (year, month and day derived from days).
+
+        :param columns: columns of the dataframe, any of keys (others, e.g. post_code
+            in a store written without postcodes, are left out)
+        :param max_price: highest price kept (None keeps all rows)
+        :param selectors: see selected
+        :return: dataframe with categorical columns for the coded columns
+        """
+        is_selected = self.selected(max_price, **selectors)
+        keys = self.keys
+        date_parts = (
+            self._date_parts(is_selected)
+            if any(column in DATE_KEYS for column in columns)
+            else {}
+        )
+        return pandas.DataFrame(
+            {
+                column: (
+                    date_parts[column]
+                    if column in DATE_KEYS
+                    else self._values(column, is_selected)
+                )
+                for column in columns
+                if column in keys
+            }
+        )
+
+    def aggregate(
+        self,
+        keys: Sequence[str],
+        stats: Sequence[str] = ("mean", "median", "count"),
+        max_price: Optional[float] = None,
+        **selectors: Selector
+    ) -> pandas.DataFrame:
+        """Aggregate the prices of the selected rows by some keys.
+
+        e.g. aggregate(["year", "postcode_district"], max_price=1e6, property_type="F")
+        gives the yearly flat prices of each postcode district, leaving out sales above
+        a million.
+
+        :param keys: any of keys (e.g. year, month, address_county_1, property_type or
+            postcode_district), the index levels in this order
+        :param stats: pandas aggregations of the prices (e.g. mean, median, count, max)
+        :param max_price: highest price kept (None keeps all rows)
+        :param selectors: see selected
+        :return: dataframe indexed by keys with price_gbp_<stat> columns (and date_time
+            when year and month are among the keys)
+        """
+        unknown = [key for key in keys if key not in self.keys]
+        if unknown:
+            raise ValueError(
+                "Unknown keys {}, use any of {}".format(unknown, self.keys)
+            )
+        df = self.to_frame(["price_gbp"] + list(keys), max_price, **selectors)
+        df = df.groupby(list(keys), observed=True)["price_gbp"].aggregate(list(stats))
+        df.columns = ["price_gbp_" + stat for stat in stats]
+        if "year" in keys and "month" in keys:
+            df["date_time"] = month_starts(
+                df.index.get_level_values("year"), df.index.get_level_values("month")
+            )
+        return df
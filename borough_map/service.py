@@ -0,0 +1,307 @@
+import io
+import json
+import time
+import asyncio
+import logging
+import concurrent.futures
+from urllib.parse import parse_qs, urlsplit
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Tuple
+
+import numpy
+
+from borough_map.data_loader import DataLoader
+from borough_map.instrumentation import Instrumentation
+from borough_map.lru import LRUCache
+
+if TYPE_CHECKING:  # matplotlib is only imported for png snapshots
+    from borough_map.map_view import MapView
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+Response = Tuple[int, str, bytes]
+
+STATUS_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Error"}
+
+
+class QueryError(Exception):
+    """A query that cannot be answered (sent back as a json error with the status)."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def _to_json_values(values: numpy.ndarray) -> list:
+    """Floats for json (NaN, a month without transactions, becomes null)."""
+    return [None if numpy.isnan(value) else float(value) for value in values]
+
+
+class QueryService:
+    """Answers json queries (and png snapshots) from the aggregates of a DataLoader.
+
+    The aggregates are loaded once and queries are answered from the (stat, month, borough)
+    cube: a borough time series is a strided view and a month snapshot a contiguous
+    slice. PNG snapshots are drawn on a single map view in a worker thread (matplotlib
+    is not thread safe) and kept in a bounded LRU cache keyed by (year, month, stat).
+
+    GET /boroughs                                   boroughs, statistics and month range
+    GET /series?borough=CAMDEN&stat=median&start=2000-01&end=2005-12
+    GET /snapshot?year=2005&month=6&stat=median     all boroughs in a month
+    GET /snapshot.png?year=2005&month=6&stat=median the map of a month
+    GET /status                                     cache and request counters
+    """
+
+    def __init__(
+        self,
+        data_loader: DataLoader,
+        map_view_factory: Optional[Callable[[], "MapView"]] = None,
+        png_cache_size: int = 128,
+        instrumentation: Optional[Instrumentation] = None,
+    ):
+        """Instantiate the service.
+
+        :param data_loader: data loader (load_prepare_and_aggregate_data is called if needed)
+        :param map_view_factory: function returning the map view used for the png snapshots
+            (called on the first png request, None disables them)
+        :param png_cache_size: number of png snapshots kept
+        :param instrumentation: counts requests and times renders (without keeping events)
+        """
+        self.data_loader = data_loader
+        if data_loader._cube is None:
+            data_loader.load_prepare_and_aggregate_data()
+        self.cube = data_loader._cube
+        self.instrumentation = instrumentation or Instrumentation(keep_events=False)
+        self.png_cache = LRUCache(png_cache_size)
+        self._map_view_factory = map_view_factory
+        self._map_view = None
+        self._line_data = data_loader.get_line_data()
+        # one thread: all png snapshots are drawn on the same figure
+        self._render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._routes = {
+            "/boroughs": self.boroughs,
+            "/series": self.series,
+            "/snapshot": self.snapshot,
+            "/status": self.status,
+        }
+
+    def _parameter(self, query: Dict[str, list], name: str, default=None) -> str:
+        values = query.get(name)
+        if not values:
+            if default is None:
+                raise QueryError("Missing parameter {}".format(name))
+            return default
+        return values[-1]
+
+    def _stat(self, query: Dict[str, list]) -> str:
+        stat = self._parameter(query, "stat", "median")
+        if stat not in self.cube.stats:
+            raise QueryError(
+                "Unknown stat {!r}, use one of {}".format(stat, list(self.cube.stats))
+            )
+        return stat
+
+    def _frame(self, year: str, month: str) -> int:
+        try:
+            return self.cube.frame_index(int(year), int(month))
+        except ValueError:
+            raise QueryError("Invalid year or month {}-{}".format(year, month))
+        except KeyError:
+            raise QueryError("No data for {}-{}".format(year, month), status=404)
+
+    def _month(self, query: Dict[str, list], name: str, default: str) -> int:
+        year, _, month = self._parameter(query, name, default).partition("-")
+        return self._frame(year, month)
+
+    def boroughs(self, query: Dict[str, list]) -> dict:
+        first_year, first_month = self.cube.year_month(0)
+        last_year, last_month = self.cube.year_month(self.cube.n_frames - 1)
+        return dict(
+            boroughs=list(self.cube.boroughs),
+            stats=list(self.cube.stats),
+            start="{}-{:02d}".format(first_year, first_month),
+            end="{}-{:02d}".format(last_year, last_month),
+        )
+
+    def series(self, query: Dict[str, list]) -> dict:
+        borough = self._parameter(query, "borough").upper()
+        if borough not in self.cube.boroughs:
+            raise QueryError("Unknown borough {!r}".format(borough), status=404)
+        stat = self._stat(query)
+        start = self._month(query, "start", "{}-{}".format(*self.cube.year_month(0)))
+        end = self._month(
+            query, "end", "{}-{}".format(*self.cube.year_month(self.cube.n_frames - 1))
+        )
+        values = self.cube.series(stat, borough)[start : end + 1]
+        return dict(
+            borough=borough,
+            stat=stat,
+            months=[
+                "{}-{:02d}".format(*self.cube.year_month(frame))
+                for frame in range(start, end + 1)
+            ],
+            values=_to_json_values(values),
+        )
+
+    def snapshot(self, query: Dict[str, list]) -> dict:
+        frame, stat = self._month_of_query(query), self._stat(query)
+        year, month = self.cube.year_month(frame)
+        return dict(
+            year=year,
+            month=month,
+            stat=stat,
+            boroughs=list(self.cube.boroughs),
+            values=_to_json_values(self.cube.get(stat, year, month)),
+        )
+
+    def status(self, query: Dict[str, list]) -> dict:
+        return dict(
+            png_cache=dict(
+                size=len(self.png_cache),
+                max_size=self.png_cache.max_size,
+                hits=self.png_cache.hits,
+                misses=self.png_cache.misses,
+            ),
+            counters=dict(self.instrumentation.counters),
+        )
+
+    def render_png(self, year: int, month: int, stat: str) -> bytes:
+        """Draw the map of a month (called in the render thread).
+
+        :param year:
+        :param month:
+        :param stat: statistic coloured on the map
+        :return: png image
+        """
+        with self.instrumentation.stage("render_png", year=year, month=month):
+            if self._map_view is None:
+                self._map_view = self._map_view_factory()
+                self._map_view.borough_order = self.cube.boroughs
+                self._map_view.initial_draw()
+            map_view = self._map_view
+            map_view.set_colors_for_patches(self.cube.get(stat, year, month))
+            map_view.draw_text_on_axis(year, month)
+            x_data, y_data = self._line_data
+            frames = self.cube.frame_index(year, month) + 1
+            map_view.plot_line(x_data[:frames], y_data[:frames])
+            image = io.BytesIO()
+            map_view.fig.savefig(image, format="png")
+            return image.getvalue()
+
+    async def snapshot_png(self, query: Dict[str, list]) -> bytes:
+        if self._map_view_factory is None:
+            raise QueryError("PNG snapshots are disabled (no shape file)", status=404)
+        frame, stat = self._month_of_query(query), self._stat(query)
+        year, month = self.cube.year_month(frame)
+        key = (year, month, stat)
+        image = self.png_cache.get(key)
+        if image is None:
+            image = await asyncio.get_running_loop().run_in_executor(
+                self._render_executor, self.render_png, year, month, stat
+            )
+            self.png_cache.put(key, image)
+        return image
+
+    def _month_of_query(self, query: Dict[str, list]) -> int:
+        return self._frame(
+            self._parameter(query, "year"), self._parameter(query, "month")
+        )
+
+    async def respond(self, target: str) -> Response:
+        """Answer a request target (path and query string).
+
+        :param target: e.g. /series?borough=CAMDEN
+        :return: tuple of the status, content type and body
+        """
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        self.instrumentation.count("service.requests")
+        try:
+            if url.path == "/snapshot.png":
+                return 200, "image/png", await self.snapshot_png(query)
+            if url.path not in self._routes:
+                raise QueryError("Unknown path {}".format(url.path), status=404)
+            body = self._routes[url.path](query)
+            return 200, "application/json", json.dumps(body).encode()
+        except QueryError as error:
+            self.instrumentation.count("service.errors")
+            body = json.dumps(dict(error=str(error))).encode()
+            return error.status, "application/json", body
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Serve GET requests of one (keep alive) connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    break
+                start = time.perf_counter()
+                if method != "GET":
+                    status, content_type, body = (
+                        400,
+                        "application/json",
+                        b'{"error": "only GET is supported"}',
+                    )
+                else:
+                    try:
+                        status, content_type, body = await self.respond(target)
+                    except Exception:  # keep serving after a bug in one query
+                        LOGGER.exception("Failed to answer %s", target)
+                        status, content_type, body = (
+                            500,
+                            "application/json",
+                            b'{"error": "internal error"}',
+                        )
+                keep_alive = (
+                    version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                writer.write(
+                    "HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n"
+                    "Connection: {}\r\n\r\n".format(
+                        status,
+                        STATUS_REASONS.get(status, ""),
+                        content_type,
+                        len(body),
+                        "keep-alive" if keep_alive else "close",
+                    ).encode("latin-1")
+                    + body
+                )
+                await writer.drain()
+                LOGGER.debug(
+                    "%s %s %s in %.1f ms",
+                    method,
+                    target,
+                    status,
+                    1000 * (time.perf_counter() - start),
+                )
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080) -> None:
+        """Serve requests until cancelled.
+
+        :param host: interface to listen on
+        :param port: port to listen on
+        """
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        LOGGER.info("Serving the aggregates on http://%s:%s", host, port)
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,181 @@
+from typing import List, Sequence
+
+import numpy
+import pandas
+
+BUCKET = "bucket"
+
+
+def _gamma(relative_accuracy: float) -> float:
+    """Ratio between the bounds of consecutive buckets."""
+    return (1 + relative_accuracy) / (1 - relative_accuracy)
+
+
+def bucket_indices(values, relative_accuracy: float) -> numpy.ndarray:
+    """Logarithmic bucket of each value (values below 1 share the bucket of 1).
+
+    :param values: positive values
+    :param relative_accuracy: relative accuracy of the buckets
+    :return: int32 bucket indices
+    """
+    values = numpy.maximum(numpy.asarray(values, dtype=numpy.float64), 1.0)
+    return numpy.ceil(numpy.log(values) / numpy.log(_gamma(relative_accuracy))).astype(
+        numpy.int32
+    )
+
+
+def bucket_values(buckets, relative_accuracy: float) -> numpy.ndarray:
+    """Value representing each bucket (within relative_accuracy of all its values).
+
+    :param buckets: bucket indices
+    :param relative_accuracy: relative accuracy of the buckets
+    :return: float64 values
+    """
+    gamma = _gamma(relative_accuracy)
+    return 2 * gamma ** numpy.asarray(buckets, dtype=numpy.float64) / (gamma + 1)
+
+
+class QuantileSketch:
+    """Mergeable quantile sketches (logarithmic buckets, as DDSketch) for many cells at once.
+
+    A value v > 0 falls in bucket ceil(log(v) / log(gamma)) with
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy), so every quantile is
+    estimated within relative_accuracy of an actual value at that rank. The sketches
+    are a count per (cell keys..., bucket), held as a pandas Series with a MultiIndex
+    whose last level is the bucket. Because buckets do not depend on the data,
+    sketches of chunks, workers or months are merged by adding the counts, and
+    coarser cells (e.g. all boroughs of a month) are a sum over a key level.
+
+    With a relative accuracy of 1% prices from 1 to 100 million need under a
+    thousand buckets and only non empty buckets are stored.
+    """
+
+    def __init__(self, counts: pandas.Series, relative_accuracy: float = 0.01):
+        """Instantiate the sketches from their bucket counts.
+
+        :param counts: counts indexed by (cell keys..., bucket)
+        :param relative_accuracy: relative accuracy the buckets were built with
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(
+                "relative_accuracy must be in (0, 1), got {}".format(relative_accuracy)
+            )
+        self.counts = counts
+        self.relative_accuracy = relative_accuracy
+
+    @property
+    def key_names(self) -> List[str]:
+        """Names of the cell key levels."""
+        return list(self.counts.index.names[:-1])
+
+    def bucket_indices(self, values) -> numpy.ndarray:
+        """Bucket of each value, see bucket_indices."""
+        return bucket_indices(values, self.relative_accuracy)
+
+    def bucket_values(self, buckets) -> numpy.ndarray:
+        """Value representing each bucket, see bucket_values."""
+        return bucket_values(buckets, self.relative_accuracy)
+
+    @classmethod
+    def from_frame(
+        cls,
+        df: pandas.DataFrame,
+        keys: Sequence[str],
+        value_column: str,
+        relative_accuracy: float = 0.01,
+    ) -> "QuantileSketch":
+        """Build one sketch per cell of a dataframe.
+
+        :param df: dataframe with the key and value columns
+        :param keys: columns identifying a cell (categorical keys keep observed cells only)
+        :param value_column: column of the values to sketch
+        :param relative_accuracy: relative accuracy of the quantiles
+        :return: the sketches
+        """
+        cells = df[list(keys)].assign(
+            **{BUCKET: bucket_indices(df[value_column].values, relative_accuracy)}
+        )
+        counts = cells.groupby(list(keys) + [BUCKET], observed=True).size()
+        return cls(counts.astype(numpy.int64).rename("count"), relative_accuracy)
+
+    def merge(self, *others: "QuantileSketch") -> "QuantileSketch":
+        """Sketches of the union of the values (counts of equal cells and buckets are added).
+
+        :param others: sketches with the same keys and relative accuracy
+        :return: the merged sketches
+        """
+        for other in others:
+            if other.relative_accuracy != self.relative_accuracy:
+                raise ValueError("Cannot merge sketches of different accuracies.")
+        counts = pandas.concat([self.counts] + [other.counts for other in others])
+        levels = list(range(counts.index.nlevels))
+        return QuantileSketch(
+            counts.groupby(level=levels, observed=True).sum(), self.relative_accuracy
+        )
+
+    def rolled_up(self, keys: Sequence[str]) -> "QuantileSketch":
+        """Sketches of coarser cells, merging all cells with the same values of keys.
+
+        :param keys: key levels to keep, e.g. ["year", "month"]
+        :return: the sketches of the coarser cells
+        """
+        counts = self.counts.groupby(level=list(keys) + [BUCKET], observed=True).sum()
+        return QuantileSketch(counts, self.relative_accuracy)
+
+    def quantiles(self, quantiles: Sequence[float]) -> pandas.DataFrame:
+        """Estimate quantiles of every cell.
+
+        As pandas (linear interpolation) the q quantile lies between the values at ranks
+        floor(q * (count - 1)) and ceil(q * (count - 1)), so the median of an even count
+        is the mean of the two middle values. Each of those is estimated within
+        relative_accuracy.
+
+        :param quantiles: quantiles in [0, 1]
+        :return: dataframe indexed by the cell keys with one column per quantile
+        """
+        counts = self.counts.sort_index()
+        key_levels = list(range(counts.index.nlevels - 1))
+        groups = counts.groupby(level=key_levels, observed=True, sort=True)
+        group_codes = groups.ngroup().values
+        cumulative = groups.cumsum().values
+        totals = groups.transform("sum").values
+        buckets = counts.index.get_level_values(-1).values
+        starts = numpy.flatnonzero(
+            numpy.concatenate([[True], group_codes[1:] != group_codes[:-1]])
+        )
+        index = counts.index.droplevel(-1)[starts]
+        cell_totals = totals[starts]
+
+        def value_at_rank(rank: numpy.ndarray) -> numpy.ndarray:
+            # cumulative counts increase within a cell so the bucket holding the rank is
+            # the first one of the cell past it (the last bucket always qualifies)
+            reached = numpy.flatnonzero(cumulative > rank[group_codes])
+            _, first = numpy.unique(group_codes[reached], return_index=True)
+            return self.bucket_values(buckets[reached[first]])
+
+        columns = {}
+        for quantile in quantiles:
+            rank = quantile * (cell_totals - 1)
+            lower, upper = numpy.floor(rank), numpy.ceil(rank)
+            lower_value = value_at_rank(lower)
+            upper_value = value_at_rank(upper)
+            columns[quantile] = lower_value + (rank - lower) * (
+                upper_value - lower_value
+            )
+        return pandas.DataFrame(columns, index=index)
+
+    def to_frame(self) -> pandas.DataFrame:
+        """The counts as a dataframe (for the aggregate cache)."""
+        return self.counts.to_frame("count")
+
+    @classmethod
+    def from_cached_frame(
+        cls, df: pandas.DataFrame, relative_accuracy: float
+    ) -> "QuantileSketch":
+        """Sketches from a dataframe written by to_frame.
+
+        :param df: dataframe with a count column indexed by (cell keys..., bucket)
+        :param relative_accuracy: relative accuracy the sketches were built with
+        :return: the sketches
+        """
+        return cls(df["count"], relative_accuracy)
@@ -0,0 +1,238 @@
+import time
+import logging
+import threading
+from typing import Callable, List, Tuple
+
+import numpy
+
+from matplotlib.widgets import Slider
+
+from borough_map.map_view import MapView
+from borough_map.lru import LRUCache
+
+logging.basicConfig()
+LOGGER = logging.getLogger(__file__)
+
+KEY_STEPS = {"left": -1, "right": 1, "down": -12, "up": 12}
+SLIDER_RECT = (0.1, 0.95, 0.6, 0.02)  # left, bottom, width, height (above the map)
+
+
+class Viewer:
+    """Interactive map with a slider (and arrow keys) to scrub through the months.
+
+    The values of every month are computed once into a (frame, area) cube and the
+    line data is sliced from one array, so a step never queries the data loader. A step
+    restores the static background and only redraws the patch colours, the date text,
+    the line and the slider (blitting). Drawn frames are kept as canvas regions in an LRU
+    cache and a background thread draws the neighbours of the current frame on a
+    headless copy of the map, so scrubbing back and forth mostly restores cached pixels.
+
+    left/right: previous/next month, down/up: previous/next year, home/end: first/last month
+    """
+
+    def __init__(
+        self,
+        map_view: MapView,
+        values: numpy.ndarray,
+        line_data: Tuple[numpy.ndarray, numpy.ndarray],
+        year_month: Callable[[int], Tuple[int, int]],
+        cache_size: int = 64,
+        prefetch: int = 8,
+    ):
+        """Instantiate the viewer (draws the background of map_view).
+
+        :param map_view: map view to draw on, borough_order set (show needs one that is
+            not headless, a headless one can be stepped through with show_frame)
+        :param values: array of shape (frames, len(borough_order)), the colours of a frame
+        :param line_data: x (datetime) and y data of the line, one point per frame
+        :param year_month: year, month of a frame number
+        :param cache_size: number of drawn frames kept (about 2 MB each)
+        :param prefetch: number of frames drawn ahead (and behind) of the current frame
+            in the background (0 disables the prefetch thread)
+        """
+        self.map_view = map_view
+        self.values = values
+        self.line_x, self.line_y = line_data
+        self.year_month = year_month
+        self.n_frames = len(values)
+        self.prefetch = prefetch
+        self.frame = 0
+        self.cache = LRUCache(cache_size)
+        self._cache_lock = threading.Lock()
+
+        fig = map_view.fig
+        self.slider = Slider(
+            fig.add_axes(SLIDER_RECT),
+            "",
+            0,
+            self.n_frames - 1,
+            valinit=0,
+            valstep=1,
+        )
+        self.slider.drawon = False  # drawn by show_frame, not by a full redraw
+        # left out of the background and of the cached frames
+        self.slider.ax.set_animated(True)
+        self.slider.on_changed(lambda value: self.show_frame(int(value)))
+        self.background = map_view.draw_background()
+        # keep the axes where the first draw put them, so every frame drawn (here or on
+        # the headless copy) has the same layout
+        fig.set_constrained_layout(False)
+        self._size = fig.canvas.get_width_height()
+        fig.canvas.mpl_connect("key_press_event", self._on_key)
+        fig.canvas.mpl_connect("draw_event", self._on_draw)
+        manager = fig.canvas.manager
+        if manager is not None and getattr(manager, "key_press_handler_id", None):
+            # the default key bindings use the arrow keys for the navigation history
+            fig.canvas.mpl_disconnect(manager.key_press_handler_id)
+
+        self._wanted: List[int] = []
+        self._wanted_changed = threading.Condition()
+        self._drawing = False
+        self._closed = False
+        self._prefetch_thread = None
+        if prefetch > 0:
+            self._prefetch_view = self._headless_copy(map_view)
+            self._prefetch_thread = threading.Thread(
+                target=self._prefetch_frames, name="viewer-prefetch", daemon=True
+            )
+            self._prefetch_thread.start()
+        self.show_frame(0)
+
+    @staticmethod
+    def _headless_copy(map_view: MapView) -> MapView:
+        """A headless map view drawing the same pixels as map_view (for the prefetch)."""
+        copy = MapView(None, geometry=map_view.geometry, headless=True)
+        copy.fig.set_size_inches(map_view.fig.get_size_inches())
+        copy.fig.set_dpi(map_view.fig.dpi)
+        copy.borough_order = map_view.borough_order
+        copy.allow_missing_areas = map_view.allow_missing_areas
+        copy.fig.add_axes(SLIDER_RECT).set_animated(True)  # never drawn
+        copy.draw_background()
+        copy.fig.set_constrained_layout(False)
+        for axis, copy_axis in zip(map_view.fig.axes, copy.fig.axes):
+            copy_axis.set_position(axis.get_position())
+        copy.fig.canvas.draw()
+        copy.background = copy.fig.canvas.copy_from_bbox(copy.fig.bbox)
+        return copy
+
+    def _update(self, map_view: MapView, i: int) -> None:
+        """Set the patch colours, date text and line of frame i."""
+        map_view.set_colors_for_patches(self.values[i])
+        map_view.draw_text_on_axis(*self.year_month(i))
+        map_view.plot_line(self.line_x[:i], self.line_y[:i])
+
+    def _draw_frame(self, map_view: MapView, background, i: int):
+        """Draw frame i over the background and return the region of the canvas."""
+        map_view.fig.canvas.restore_region(background)
+        self._update(map_view, i)
+        map_view.draw_animated()
+        return map_view.fig.canvas.copy_from_bbox(map_view.fig.bbox)
+
+    def show_frame(self, i: int) -> None:
+        """Draw frame i (from the cache if it was drawn before) and prefetch its neighbours.
+
+        :param i: frame number (clipped to the frames)
+        """
+        i = min(max(i, 0), self.n_frames - 1)
+        self.frame = i
+        canvas = self.map_view.fig.canvas
+        with self._cache_lock:
+            region = self.cache.get(i)
+        if region is not None:
+            canvas.restore_region(region)
+        else:
+            region = self._draw_frame(self.map_view, self.background, i)
+            with self._cache_lock:
+                self.cache.put(i, region)
+        if self.slider.val != i:
+            self.slider.eventson = False
+            self.slider.set_val(i)
+            self.slider.eventson = True
+        self.slider.valtext.set_text("{}-{:02d}".format(*self.year_month(i)))
+        self.map_view.fig.draw_artist(self.slider.ax)
+        canvas.blit(self.map_view.fig.bbox)
+        if self._prefetch_thread is not None:
+            self._request_prefetch(i)
+
+    def step(self, frames: int) -> None:
+        """Move by a number of frames (negative to go back)."""
+        self.show_frame(self.frame + frames)
+
+    def _on_key(self, event) -> None:
+        if event.key in KEY_STEPS:
+            self.step(KEY_STEPS[event.key])
+        elif event.key == "home":
+            self.show_frame(0)
+        elif event.key == "end":
+            self.show_frame(self.n_frames - 1)
+
+    def _on_draw(self, event) -> None:
+        """After a full redraw (e.g. the window opening or a resize) take the background
+        again and draw the current frame over it."""
+        canvas = self.map_view.fig.canvas
+        if canvas.get_width_height() != self._size:
+            # the cached regions and the prefetch copy have the old size
+            self._size = canvas.get_width_height()
+            with self._cache_lock:
+                self.cache = LRUCache(self.cache.max_size)
+            if self._prefetch_thread is not None:
+                LOGGER.info("Canvas resized, frames are no longer prefetched")
+                self.close()
+                self._prefetch_thread = None
+        self.background = canvas.copy_from_bbox(self.map_view.fig.bbox)
+        self._update(self.map_view, self.frame)
+        self.map_view.draw_animated()
+        self.map_view.fig.draw_artist(self.slider.ax)
+
+    def _request_prefetch(self, i: int) -> None:
+        """Replace the frames wanted by the prefetch thread with the neighbours of i."""
+        wanted = []
+        for distance in range(1, self.prefetch + 1):
+            wanted.extend([i + distance, i - distance])
+        with self._wanted_changed:
+            self._wanted = [j for j in wanted if 0 <= j < self.n_frames]
+            self._wanted_changed.notify()
+
+    def _prefetch_frames(self) -> None:
+        """Draw the wanted frames on the headless copy (run in the prefetch thread)."""
+        view = self._prefetch_view
+        while True:
+            with self._wanted_changed:
+                while not self._wanted and not self._closed:
+                    self._wanted_changed.wait()
+                if self._closed:
+                    return
+                i = self._wanted.pop(0)
+                self._drawing = True
+            with self._cache_lock:
+                is_cached = i in self.cache
+            if not is_cached:
+                region = self._draw_frame(view, view.background, i)
+                with self._cache_lock:
+                    self.cache.put(i, region)
+            with self._wanted_changed:
+                self._drawing = False
+
+    def wait_for_prefetch(self, timeout: float = 10.0) -> None:
+        """Block until the prefetch thread has drawn the wanted frames (for benchmarks)."""
+        end = time.perf_counter() + timeout
+        while time.perf_counter() < end:
+            with self._wanted_changed:
+                if not self._wanted and not self._drawing:
+                    return
+            time.sleep(0.001)
+
+    def close(self) -> None:
+        """Stop the prefetch thread (after the frame it is drawing)."""
+        with self._wanted_changed:
+            self._closed = True
+            self._wanted_changed.notify()
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+
+    def show(self) -> None:
+        """Open the window (blocks until it is closed)."""
+        try:
+            self.map_view.show()
+        finally:
+            self.close()
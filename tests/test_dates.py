@@ -0,0 +1,29 @@
+import numpy
+import pandas
+import pytest
+
+from borough_map.parallel import RowPreparation
+
+DATE_STRINGS = ["1995-01-01 00:00", "2000-02-29 00:00", "2019-11-30 00:00"]
+
+
+@pytest.mark.parametrize("fast_dates", [True, False])
+def test_date_columns_agree_with_pandas(fast_dates):
+    preparation = RowPreparation(
+        {}, None, 100e6, fast_dates, extra_date_columns=["day", "epoch_seconds"]
+    )
+    df, parsed = preparation.add_date_columns(
+        pandas.DataFrame(
+            {"date_time": DATE_STRINGS, "address_county_1": ["CAMDEN"] * 3}
+        )
+    )
+
+    expected = pandas.to_datetime(pandas.Series(DATE_STRINGS))
+    assert parsed == fast_dates
+    assert "is_london_borough" not in df.columns  # constant, not sent back by workers
+    numpy.testing.assert_array_equal(df["year"], expected.dt.year)
+    numpy.testing.assert_array_equal(df["month"], expected.dt.month)
+    numpy.testing.assert_array_equal(df["day"], expected.dt.day)
+    numpy.testing.assert_array_equal(
+        df["epoch_seconds"], [788918400, 951782400, 1575072000]
+    )
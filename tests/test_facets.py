@@ -0,0 +1,94 @@
+import csv
+
+import numpy
+import pandas
+import pytest
+
+from benchmarks.synthetic import make_price_paid_chunk
+from borough_map.data_loader import DataLoader
+from borough_map.facets import FacetStore
+
+ROLL_UPS = [
+    (["year", "month"], {}),
+    (["year", "month", "address_county_1"], dict(property_type="F")),
+    (["year", "property_type"], dict(is_new_build="Y")),
+    (["property_type", "estate_type"], dict(address_county_1=["CAMDEN", "HACKNEY"])),
+]
+
+
+@pytest.fixture
+def facet_loader(tmp_path):
+    """A loader with facets of a synthetic file, and the london rows of that file."""
+    rows = make_price_paid_chunk(20000, 0, numpy.random.RandomState(0), 0.5)
+    rows.to_csv(
+        tmp_path / "pp-complete.csv", header=False, index=False, quoting=csv.QUOTE_ALL
+    )
+    data_loader = DataLoader(
+        "pp-complete.csv", data_directory=str(tmp_path), facets=True
+    )
+    data_loader.load_prepare_and_aggregate_data()
+    london = rows.loc[rows["district"].isin(data_loader.boroughs)]
+    dates = pandas.to_datetime(london["date"])
+    expected = pandas.DataFrame(
+        {
+            "year": dates.dt.year.values.astype(numpy.int16),
+            "month": dates.dt.month.values.astype(numpy.int8),
+            "address_county_1": london["district"].values,
+            "property_type": london["property_type"].values,
+            "is_new_build": london["new_build"].values,
+            "estate_type": london["estate_type"].values,
+            "price_gbp": london["price"].values,
+        }
+    )
+    return data_loader, expected
+
+
+@pytest.mark.parametrize("keys, selectors", ROLL_UPS)
+def test_rolled_up_stats_are_those_of_the_rows(facet_loader, keys, selectors):
+    data_loader, rows = facet_loader
+    rolled_up = data_loader.facet_rolled_up(keys, **selectors)
+
+    for key, values in selectors.items():
+        values = [values] if isinstance(values, str) else values
+        rows = rows.loc[rows[key].isin(values)]
+    expected = rows.groupby(keys)["price_gbp"].agg(["mean", "median", "count"])
+    assert len(rolled_up) == len(expected)
+    for stat in ["mean", "median", "count"]:
+        numpy.testing.assert_allclose(
+            rolled_up["price_gbp_" + stat].values, expected[stat].values
+        )
+
+
+def test_rolled_up_medians_are_not_medians_of_cell_medians(facet_loader):
+    data_loader, rows = facet_loader
+    rolled_up = data_loader.facet_rolled_up(["year"], ["median"])
+
+    cell_medians = rows.groupby(["year", "month", "address_county_1", "property_type"])[
+        "price_gbp"
+    ].median()
+    medians_of_cells = cell_medians.groupby(level="year").median()
+    assert not numpy.allclose(
+        rolled_up["price_gbp_median"].values, medians_of_cells.values
+    )
+
+
+def test_prices_above_int32_do_not_wrap():
+    prices = [250000, 3000000000, 4000000000]
+    store = FacetStore.from_frame(
+        pandas.DataFrame(
+            {
+                "year": [2019] * 3,
+                "month": [1] * 3,
+                "address_county_1": ["CAMDEN"] * 3,
+                "property_type": ["D"] * 3,
+                "is_new_build": ["N"] * 3,
+                "estate_type": ["F"] * 3,
+                "price_gbp": prices,
+            }
+        )
+    )
+
+    rolled_up = store.rolled_up(["year"])
+    assert rolled_up["price_gbp_median"].iloc[0] == 3000000000
+    assert rolled_up["price_gbp_mean"].iloc[0] == pytest.approx(numpy.mean(prices))
+    assert FacetStore.from_frame(store.rows).rows["price_gbp"].dtype == numpy.int64
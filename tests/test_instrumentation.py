@@ -0,0 +1,39 @@
+from borough_map.instrumentation import Instrumentation
+
+
+def test_events_are_opt_in():
+    instrumentation = Instrumentation()
+    with instrumentation.stage("load", rows_in=10) as stage:
+        stage["rows_out"] = 5
+    instrumentation.count("cache.hit")
+
+    assert instrumentation.events == []
+    assert instrumentation.counters == {"cache.hit": 1}
+    assert instrumentation.summary()["stages"] == {}
+
+
+def test_kept_events_and_hooks():
+    received = []
+    instrumentation = Instrumentation(keep_events=True)
+    instrumentation.add_hook(received.append)
+    with instrumentation.stage("load", rows_in=10) as stage:
+        stage["rows_out"] = 5
+    instrumentation.count("cache.hit", 2)
+
+    assert received == instrumentation.events
+    stage_event, counter_event = instrumentation.events
+    assert stage_event["name"] == "load"
+    assert (stage_event["rows_in"], stage_event["rows_out"]) == (10, 5)
+    assert counter_event["total"] == 2
+    assert instrumentation.summary()["stages"]["load"]["calls"] == 1
+
+
+def test_a_hook_alone_receives_events():
+    received = []
+    instrumentation = Instrumentation()
+    instrumentation.add_hook(received.append)
+    with instrumentation.stage("render"):
+        pass
+
+    assert [event["name"] for event in received] == ["render"]
+    assert instrumentation.events == []
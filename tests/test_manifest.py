@@ -0,0 +1,136 @@
+import os
+import csv
+import json
+
+import numpy
+import pytest
+
+from benchmarks.synthetic import make_price_paid_chunk
+from borough_map.data_loader import DataLoader
+from borough_map.manifest import SAMPLE_BYTES, CacheManifest
+
+PARAMETERS = {"max_price": 100}
+SECOND_NS = 1000000000
+
+
+@pytest.fixture
+def source(tmp_path):
+    """A source file of 4 MB, so some of its bytes are not in the sampled hash."""
+    path = tmp_path / "source.csv"
+    path.write_bytes(numpy.random.RandomState(0).bytes(4 * SAMPLE_BYTES))
+    return str(path)
+
+
+def rewrite(path: str, offset: int, keep_mtime: bool = False) -> None:
+    """Flip one byte of a file, the same size, and move its mtime (unless keep_mtime)."""
+    stat = os.stat(path)
+    with open(path, "r+b") as source_file:
+        source_file.seek(offset)
+        byte = source_file.read(1)
+        source_file.seek(offset)
+        source_file.write(bytes([byte[0] ^ 0xFF]))
+    mtime_ns = stat.st_mtime_ns if keep_mtime else stat.st_mtime_ns + SECOND_NS
+    os.utime(path, ns=(stat.st_atime_ns, mtime_ns))
+
+
+def touch(path: str) -> None:
+    """Move the mtime of a file without changing it."""
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + SECOND_NS))
+
+
+def test_unchanged_source_is_valid(source, tmp_path):
+    manifest = CacheManifest(str(tmp_path / "manifest.json"))
+    manifest.write(source, PARAMETERS)
+
+    assert manifest.is_valid(source, PARAMETERS)
+    assert manifest.is_valid(source, dict(PARAMETERS))
+
+
+def test_missing_manifest_is_stale(source, tmp_path):
+    assert not CacheManifest(str(tmp_path / "manifest.json")).is_valid(
+        source, PARAMETERS
+    )
+
+
+def test_changed_parameters_are_stale(source, tmp_path):
+    manifest = CacheManifest(str(tmp_path / "manifest.json"))
+    manifest.write(source, PARAMETERS)
+
+    assert not manifest.is_valid(source, {"max_price": 200})
+
+
+def test_changed_size_is_stale(source, tmp_path):
+    manifest = CacheManifest(str(tmp_path / "manifest.json"))
+    manifest.write(source, PARAMETERS)
+    with open(source, "ab") as source_file:
+        source_file.write(b"\n")
+
+    assert not manifest.is_valid(source, PARAMETERS)
+
+
+def test_changed_sampled_content_is_stale(source, tmp_path):
+    manifest = CacheManifest(str(tmp_path / "manifest.json"))
+    manifest.write(source, PARAMETERS)
+    rewrite(source, 0)
+
+    assert not manifest.is_valid(source, PARAMETERS)
+
+
+def test_touched_source_is_valid_and_its_mtime_recorded(source, tmp_path):
+    manifest = CacheManifest(str(tmp_path / "manifest.json"))
+    manifest.write(source, PARAMETERS)
+    touch(source)
+
+    assert manifest.is_valid(source, PARAMETERS)
+    with open(manifest.path) as manifest_file:
+        recorded = json.load(manifest_file)["source"]["mtime_ns"]
+    assert recorded == os.stat(source).st_mtime_ns
+
+
+def test_full_hash_detects_changes_outside_the_samples(source, tmp_path):
+    manifest = CacheManifest(str(tmp_path / "manifest.json"))
+    manifest.write(source, PARAMETERS, with_full_hash=True)
+    rewrite(source, SAMPLE_BYTES + 10)
+
+    assert manifest.is_valid(source, PARAMETERS)  # the sampled hash cannot see it
+    assert not manifest.is_valid(source, PARAMETERS, verify_full_hash=True)
+
+
+def test_full_hash_check_without_a_stored_full_hash_is_stale(source, tmp_path):
+    manifest = CacheManifest(str(tmp_path / "manifest.json"))
+    manifest.write(source, PARAMETERS)
+    rewrite(source, SAMPLE_BYTES + 10, keep_mtime=True)
+
+    assert not manifest.is_valid(source, PARAMETERS, verify_full_hash=True)
+    with open(manifest.path) as manifest_file:
+        assert json.load(manifest_file)["source"]["full_hash"] is None
+
+
+def test_missing_source_trusts_only_a_matching_manifest(source, tmp_path):
+    manifest = CacheManifest(str(tmp_path / "manifest.json"))
+    missing = str(tmp_path / "missing.csv")
+
+    assert not manifest.is_valid(missing, PARAMETERS)
+    manifest.write(source, PARAMETERS)
+    assert manifest.is_valid(missing, PARAMETERS)
+    assert not manifest.is_valid(missing, {"max_price": 200})
+
+
+def test_loader_rebuilds_when_the_source_changes(tmp_path):
+    path = tmp_path / "pp-complete.csv"
+    rows = make_price_paid_chunk(5000, 0, numpy.random.RandomState(0), 0.5)
+    rows.to_csv(path, header=False, index=False, quoting=csv.QUOTE_ALL)
+
+    def cache_counters() -> dict:
+        data_loader = DataLoader("pp-complete.csv", data_directory=str(tmp_path))
+        data_loader.load_prepare_and_aggregate_data()
+        return data_loader.instrumentation.counters
+
+    assert cache_counters()["cache.miss"] == 1
+    assert cache_counters()["cache.hit"] == 1
+    touch(str(path))
+    assert cache_counters()["cache.hit"] == 1
+    rows["price"] = rows["price"] + 1
+    rows.to_csv(path, header=False, index=False, quoting=csv.QUOTE_ALL)
+    assert cache_counters()["cache.miss"] == 1
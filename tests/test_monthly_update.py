@@ -0,0 +1,82 @@
+import csv
+
+import numpy
+import pandas
+import pytest
+
+from benchmarks.synthetic import make_price_paid_chunk
+from borough_map.data_loader import DataLoader
+
+ROWS = 20000
+
+
+def write_rows(path, rows: pandas.DataFrame) -> None:
+    """Write rows in the price paid layout (every field quoted, no header)."""
+    rows.to_csv(path, header=False, index=False, quoting=csv.QUOTE_ALL)
+
+
+@pytest.fixture
+def update(tmp_path):
+    """A complete file, a monthly update of it and the complete file with the update.
+
+    The update adds rows, deletes rows and changes the price (and for some the month)
+    of others.
+    """
+    complete = make_price_paid_chunk(ROWS, 0, numpy.random.RandomState(0), 0.5)
+    added = make_price_paid_chunk(500, ROWS, numpy.random.RandomState(1), 0.5)
+    changed = complete.iloc[:400].copy()
+    changed["price"] = changed["price"] * 2
+    changed.iloc[::2, changed.columns.get_loc("date")] = "2019-11-15 00:00"
+    changed["record_status"] = "C"
+    deleted = complete.iloc[400:800].copy()
+    deleted["record_status"] = "D"
+    write_rows(tmp_path / "pp-complete.csv", complete)
+    write_rows(
+        tmp_path / "pp-monthly-update.csv", pandas.concat([added, changed, deleted])
+    )
+    write_rows(
+        tmp_path / "pp-updated.csv",
+        pandas.concat([complete.iloc[800:], changed.assign(record_status="A"), added]),
+    )
+    return tmp_path
+
+
+@pytest.mark.parametrize("aggregation_engine", ["exact", "sketch"])
+def test_monthly_update_matches_a_rebuild(update, aggregation_engine):
+    data_loader = DataLoader(
+        "pp-complete.csv",
+        data_directory=str(update),
+        keep_transaction_ledger=True,
+        aggregation_engine=aggregation_engine,
+    )
+    data_loader.load_prepare_and_aggregate_data()
+    data_loader.apply_monthly_update("pp-monthly-update.csv")
+    rebuilt = DataLoader(
+        "pp-updated.csv",
+        data_directory=str(update),
+        aggregation_engine=aggregation_engine,
+    )
+    rebuilt.load_prepare_and_aggregate_data()
+
+    pandas.testing.assert_frame_equal(
+        data_loader._borough_data.sort_index(),
+        rebuilt._borough_data.sort_index(),
+        check_exact=False,
+    )
+    pandas.testing.assert_frame_equal(
+        data_loader._aggregated_data.sort_index(),
+        rebuilt._aggregated_data.sort_index(),
+        check_exact=False,
+    )
+
+
+def test_monthly_update_is_applied_once(update):
+    data_loader = DataLoader(
+        "pp-complete.csv", data_directory=str(update), keep_transaction_ledger=True
+    )
+    data_loader.load_prepare_and_aggregate_data()
+    data_loader.apply_monthly_update("pp-monthly-update.csv")
+    borough_data = data_loader._borough_data.copy()
+    data_loader.apply_monthly_update("pp-monthly-update.csv")
+
+    pandas.testing.assert_frame_equal(data_loader._borough_data, borough_data)
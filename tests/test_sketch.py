@@ -0,0 +1,128 @@
+import csv
+
+import numpy
+import pandas
+import pytest
+
+from benchmarks.synthetic import make_price_paid_chunk
+from borough_map.data_loader import DataLoader
+from borough_map.instrumentation import Instrumentation
+from borough_map.sketch import QuantileSketch
+
+KEYS = ["year", "month", "address_county_1"]
+RELATIVE_ACCURACY = 0.01
+
+
+@pytest.fixture
+def prices() -> pandas.DataFrame:
+    """Lognormal prices of a few thousand rows spread over a few hundred cells."""
+    random = numpy.random.RandomState(0)
+    rows = 5000
+    return pandas.DataFrame(
+        {
+            "year": random.randint(2000, 2004, size=rows).astype(numpy.int16),
+            "month": random.randint(1, 13, size=rows).astype(numpy.int8),
+            "address_county_1": pandas.Categorical(
+                numpy.array(["CAMDEN", "HACKNEY", "WESTMINSTER"])[
+                    random.randint(3, size=rows)
+                ]
+            ),
+            "price_gbp": numpy.round(random.lognormal(12.0, 0.7, size=rows)).astype(
+                numpy.int64
+            ),
+        }
+    )
+
+
+def test_merged_sketches_equal_one_pass(prices):
+    whole = QuantileSketch.from_frame(prices, KEYS, "price_gbp", RELATIVE_ACCURACY)
+    parts = [
+        QuantileSketch.from_frame(part, KEYS, "price_gbp", RELATIVE_ACCURACY)
+        for part in (prices.iloc[start::4] for start in range(4))
+    ]
+    merged = parts[0].merge(*parts[1:])
+
+    pandas.testing.assert_series_equal(merged.counts, whole.counts)
+
+
+def test_rolled_up_sketches_equal_sketches_of_coarser_cells(prices):
+    sketch = QuantileSketch.from_frame(prices, KEYS, "price_gbp", RELATIVE_ACCURACY)
+    coarser = QuantileSketch.from_frame(
+        prices, ["year", "month"], "price_gbp", RELATIVE_ACCURACY
+    )
+
+    pandas.testing.assert_series_equal(
+        sketch.rolled_up(["year", "month"]).counts, coarser.counts
+    )
+
+
+def test_merged_quantiles_are_within_the_relative_accuracy(prices):
+    parts = [
+        QuantileSketch.from_frame(part, KEYS, "price_gbp", RELATIVE_ACCURACY)
+        for part in (prices.iloc[start::4] for start in range(4))
+    ]
+    estimates = parts[0].merge(*parts[1:]).quantiles([0.1, 0.5, 0.9])
+    for quantile in [0.1, 0.5, 0.9]:
+        actual = prices.groupby(KEYS, observed=True)["price_gbp"].quantile(quantile)
+        error = (estimates[quantile] / actual.reindex(estimates.index) - 1).abs()
+        assert error.max() <= RELATIVE_ACCURACY + 1e-9
+
+
+@pytest.mark.parametrize(
+    "arguments, stage",
+    [
+        (dict(chunk_size=3000), "aggregate_in_chunks"),
+        (dict(workers=2), "aggregate_in_parallel"),
+    ],
+)
+def test_chunk_and_worker_merges_match_one_pass(tmp_path, arguments, stage):
+    rows = make_price_paid_chunk(20000, 0, numpy.random.RandomState(0), 0.5)
+    rows.to_csv(
+        tmp_path / "pp-complete.csv", header=False, index=False, quoting=csv.QUOTE_ALL
+    )
+    one_pass = DataLoader(
+        "pp-complete.csv", data_directory=str(tmp_path), aggregation_engine="sketch"
+    )
+    one_pass.load_prepare_and_aggregate_data()
+    one_pass._borough_cache.remove()  # so the merged aggregates are built, not loaded
+    merged = DataLoader(
+        "pp-complete.csv",
+        data_directory=str(tmp_path),
+        aggregation_engine="sketch",
+        instrumentation=Instrumentation(keep_events=True),
+        **arguments
+    )
+    merged.load_prepare_and_aggregate_data()
+
+    assert stage in merged.instrumentation.summary()["stages"]
+
+    pandas.testing.assert_series_equal(
+        merged._sketch.counts.sort_index(), one_pass._sketch.counts.sort_index()
+    )
+    pandas.testing.assert_frame_equal(
+        merged._borough_data, one_pass._borough_data, check_exact=False
+    )
+    pandas.testing.assert_frame_equal(
+        merged._aggregated_data, one_pass._aggregated_data, check_exact=False
+    )
+
+
+def test_sketch_engine_reloads_its_csv_cache(tmp_path):
+    rows = make_price_paid_chunk(5000, 0, numpy.random.RandomState(0), 0.5)
+    rows.to_csv(
+        tmp_path / "pp-complete.csv", header=False, index=False, quoting=csv.QUOTE_ALL
+    )
+    arguments = dict(
+        data_directory=str(tmp_path), cache_format="csv", aggregation_engine="sketch"
+    )
+    built = DataLoader("pp-complete.csv", **arguments)
+    built.load_prepare_and_aggregate_data()
+    loaded = DataLoader("pp-complete.csv", **arguments)
+    loaded.load_prepare_and_aggregate_data()
+
+    assert loaded.instrumentation.counters["cache.hit"] == 1
+    pandas.testing.assert_series_equal(
+        loaded._sketch.counts.sort_index(),
+        built._sketch.counts.sort_index(),
+        check_index_type=False,
+    )